@@ -1,27 +1,99 @@
+from django import forms
 from django.contrib import admin
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.db.models import Q
 from biblioteca.models import *
+from biblioteca.pagination import ContagemEstimadaPaginator
+from biblioteca import search
+
+
+class FiltroAutocomplete(admin.RelatedFieldListFilter):
+    # Filtro de FK que não carrega a tabela relacionada na barra lateral: a escolha é feita no select2
+    # do autocomplete do admin, que busca no admin do modelo relacionado
+    template = 'admin/biblioteca/filtro_autocomplete.html'
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        self.admin_site = model_admin.admin_site
+        super().__init__(field, request, params, model, model_admin, field_path)
+
+    def field_choices(self, field, request, model_admin):
+        return []
+
+    def has_output(self):
+        return True
+
+    def id_campo(self):
+        return f'filtro_{self.field_path}'
+
+    def campo(self):
+        # Só o valor selecionado é lido do banco, para mostrar o nome no select
+        relacionado = forms.ModelChoiceField(
+            self.field.remote_field.model._default_manager.all(), required=False,
+            widget=AutocompleteSelect(self.field, self.admin_site),
+        )
+        valor = self.lookup_val[-1] if self.lookup_val else None
+        return relacionado.widget.render(
+            self.lookup_kwarg, valor, attrs={'id': self.id_campo(), 'data-vazio': self.lookup_kwarg_isnull},
+        )
+
+
+class TabelaGrandeAdmin(admin.ModelAdmin):
+    # Modo para tabelas grandes: total estimado em vez do COUNT (e sem o COUNT da tabela inteira ao filtrar),
+    # ordem pelo id e os filtros de FK por autocomplete
+    paginator = ContagemEstimadaPaginator
+    show_full_result_count = False
+    ordering = ['-id']
+
+    @property
+    def media(self):
+        media = super().media
+        for filtro in self.list_filter:
+            if isinstance(filtro, tuple) and issubclass(filtro[1], FiltroAutocomplete):
+                media += AutocompleteSelect(self.model._meta.get_field(filtro[0]), self.admin_site).media
+        return media
+
 
 # Register your models here.
-class LivrosAdmin(admin.ModelAdmin):
+class LivrosAdmin(TabelaGrandeAdmin):
     list_display = ('id', 'titulo', 'data_publicacao', 'categoria', 'autor',)
-    search_fields = ['titulo', 'categoria__nome', 'autor__nome'] # procurar pelo categoria__nome os __ significa acessar o campo de uma relação
-    list_filter = ['categoria', 'autor']
+    list_select_related = ['categoria', 'autor']
+    # A busca vai pelo índice FTS5 (título, descrição, autor e categoria) em get_search_results; search_fields só liga a caixa de busca
+    search_fields = ['titulo']
+    list_filter = [('categoria', FiltroAutocomplete), ('autor', FiltroAutocomplete)]
+    autocomplete_fields = ['categoria', 'autor']
     list_display_links = ['titulo']
     list_editable = ['data_publicacao']
     list_per_page = 10
 
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        return search.filtrar_livros(queryset, search_term), False
+
 admin.site.register(Livro, LivrosAdmin)
 
-class CategoriasAdmin(admin.ModelAdmin):
+class CategoriasAdmin(TabelaGrandeAdmin):
     list_display = ('nome',)
     list_display_links = ['nome']
+    # Uma tabela só, sem join: também serve o autocomplete dos livros
+    search_fields = ['nome']
     list_per_page = 10
 
 admin.site.register(Categoria, CategoriasAdmin)
 
-class AutorAdmin(admin.ModelAdmin):
+class AutorAdmin(TabelaGrandeAdmin):
     list_display = ('nome',)
     list_display_links = ['nome']
+    search_fields = ['nome']
     list_per_page = 10
-    
-admin.site.register(Autor, AutorAdmin)
\ No newline at end of file
+
+    def get_search_results(self, request, queryset, search_term):
+        # Prefixo de palavra no nome, pelo banco: completa e atual (o índice em memória do autocomplete é por
+        # processo e limitado, fica só para as sugestões da API). O LIKE varre o autor_nome_idx, não a
+        # tabela com a biografia
+        termo = search_term.strip()
+        if not termo:
+            return queryset, False
+        return queryset.filter(Q(nome__istartswith=termo) | Q(nome__icontains=f' {termo}')), False
+
+admin.site.register(Autor, AutorAdmin)
@@ -0,0 +1,108 @@
+from django.db import transaction
+from django.db.models import Count, F, Max
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.utils import timezone
+from biblioteca.models import AgregadoCatalogo, Autor, Categoria, Emprestimo, Livro
+
+LIMITE_RANKING = 20
+LIMITE_MAXIMO_RANKING = 1000
+
+# Tipos pequenos (uma linha por categoria, ano ou mês) lidos inteiros; autores e livros vêm só os primeiros do ranking
+TIPOS_COMPLETOS = [
+    AgregadoCatalogo.LIVROS, AgregadoCatalogo.EMPRESTIMOS, AgregadoCatalogo.CATEGORIA,
+    AgregadoCatalogo.ANO, AgregadoCatalogo.MES,
+]
+
+
+def deltas_livros(livros, sinal=1):
+    # Para os caminhos que não passam pelo Livro.save (bulk_create da importação)
+    deltas = {}
+    for livro in livros:
+        for chave in livro.chaves_agregado():
+            deltas[chave] = deltas.get(chave, 0) + sinal
+    return deltas
+
+
+def totais_do_zero():
+    livros = Livro.objects.order_by()
+    emprestimos = Emprestimo.objects.order_by()
+    totais = {
+        (AgregadoCatalogo.LIVROS, 0): livros.count(),
+        (AgregadoCatalogo.EMPRESTIMOS, 0): emprestimos.count(),
+    }
+    for tipo, expressao, queryset in (
+        (AgregadoCatalogo.CATEGORIA, F('categoria_id'), livros),
+        (AgregadoCatalogo.AUTOR, F('autor_id'), livros),
+        (AgregadoCatalogo.ANO, ExtractYear('data_publicacao'), livros),
+        (AgregadoCatalogo.MES, ExtractYear('data_inicio') * 100 + ExtractMonth('data_inicio'), emprestimos),
+        (AgregadoCatalogo.LIVRO, F('livro_id'), emprestimos),
+    ):
+        linhas = queryset.annotate(chave_agregado=expressao).values('chave_agregado').annotate(total=Count('pk'))
+        for linha in linhas:
+            totais[(tipo, linha['chave_agregado'] or 0)] = linha['total']
+    return {chave: total for chave, total in totais.items() if total}
+
+
+def reconstruir():
+    agora = timezone.now()
+    with transaction.atomic():
+        AgregadoCatalogo.objects.all().delete()
+        AgregadoCatalogo.objects.bulk_create(
+            (AgregadoCatalogo(tipo=tipo, chave=chave, valor=valor, atualizado_em=agora) for (tipo, chave), valor in totais_do_zero().items()),
+            batch_size=1000,
+        )
+
+
+def divergencias():
+    esperado = totais_do_zero()
+    atual = {
+        (tipo, chave): valor
+        for tipo, chave, valor in AgregadoCatalogo.objects.exclude(valor=0).values_list('tipo', 'chave', 'valor')
+    }
+    return [
+        (tipo, chave, atual.get((tipo, chave)), esperado.get((tipo, chave)))
+        for tipo, chave in sorted(atual.keys() | esperado.keys())
+        if atual.get((tipo, chave)) != esperado.get((tipo, chave))
+    ]
+
+
+def _ranking(tipo, limite):
+    return list(
+        AgregadoCatalogo.objects.filter(tipo=tipo, valor__gt=0)
+        .order_by('-valor', '-chave')
+        .values_list('chave', 'valor')[:limite]
+    )
+
+
+def resumo(limite=LIMITE_RANKING):
+    # Número fixo de queries, qualquer que seja o tamanho do catálogo
+    atualizado_em = AgregadoCatalogo.objects.aggregate(atualizado_em=Max('atualizado_em'))['atualizado_em']
+    por_tipo = {tipo: [] for tipo in TIPOS_COMPLETOS}
+    for tipo, chave, valor in AgregadoCatalogo.objects.filter(tipo__in=TIPOS_COMPLETOS, valor__gt=0).values_list('tipo', 'chave', 'valor'):
+        por_tipo[tipo].append((chave, valor))
+    por_tipo[AgregadoCatalogo.AUTOR] = _ranking(AgregadoCatalogo.AUTOR, limite)
+    por_tipo[AgregadoCatalogo.LIVRO] = _ranking(AgregadoCatalogo.LIVRO, limite)
+
+    def com_nomes(tipo, queryset, campo, rotulo):
+        linhas = sorted(por_tipo[tipo], key=lambda linha: (-linha[1], -linha[0]))
+        objetos = queryset.only(campo).in_bulk([chave for chave, _ in linhas if chave])
+        return [
+            {'id': chave or None, campo: getattr(objetos[chave], campo) if chave in objetos else None, rotulo: valor}
+            for chave, valor in linhas
+        ]
+
+    return {
+        'atualizado_em': atualizado_em,
+        'total_livros': sum(valor for _, valor in por_tipo[AgregadoCatalogo.LIVROS]),
+        'total_emprestimos': sum(valor for _, valor in por_tipo[AgregadoCatalogo.EMPRESTIMOS]),
+        'livros_por_categoria': com_nomes(AgregadoCatalogo.CATEGORIA, Categoria.objects, 'nome', 'livros'),
+        'livros_por_autor': com_nomes(AgregadoCatalogo.AUTOR, Autor.objects, 'nome', 'livros'),
+        'livros_por_ano': [
+            {'ano': chave or None, 'livros': valor} for chave, valor in sorted(por_tipo[AgregadoCatalogo.ANO])
+        ],
+        'emprestimos_por_mes': [
+            {'mes': f'{chave // 100:04}-{chave % 100:02}', 'emprestimos': valor}
+            for chave, valor in sorted(por_tipo[AgregadoCatalogo.MES])
+        ],
+        'mais_emprestados': com_nomes(AgregadoCatalogo.LIVRO, Livro.objects, 'titulo', 'emprestimos'),
+    }
@@ -0,0 +1,126 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, DateField, DurationField, ExpressionWrapper, F, Sum, Value
+from django.utils import timezone
+from biblioteca.models import Categoria, Emprestimo, Livro, ReferenciaAtrasos, ResumoAtraso
+
+LIMITE_RELATORIO = 100
+LIMITE_MAXIMO_RELATORIO = 1000
+
+CAMPOS_DIMENSAO = {
+    ResumoAtraso.USUARIO: 'usuario_id',
+    ResumoAtraso.LIVRO: 'livro_id',
+    ResumoAtraso.CATEGORIA: 'livro__categoria_id',
+}
+
+
+def totais_em_atraso(data, desde=None):
+    # GROUP BY direto nos empréstimos: abertos com a data prevista antes de `data` (e a partir de `desde`, no virar do dia)
+    atrasados = Emprestimo.objects.filter(devolvido__in=[False], data_prevista_devolucao__lt=data)
+    if desde is not None:
+        atrasados = atrasados.filter(data_prevista_devolucao__gte=desde)
+    dias = ExpressionWrapper(Value(data, DateField()) - F('data_prevista_devolucao'), output_field=DurationField())
+
+    totais = {}
+    for dimensao, campo in CAMPOS_DIMENSAO.items():
+        linhas = atrasados.order_by().values(campo).annotate(quantidade=Count('pk'), dias=Sum(dias))
+        for linha in linhas:
+            totais[(dimensao, linha[campo] or 0)] = (linha['quantidade'], linha['dias'].days)
+    return totais
+
+
+def somar_totais(totais):
+    existentes = []
+    for dimensao in CAMPOS_DIMENSAO:
+        chaves = [chave for (outra, chave) in totais if outra == dimensao]
+        if chaves:
+            existentes.extend(ResumoAtraso.objects.filter(dimensao=dimensao, chave__in=chaves))
+    for linha in existentes:
+        quantidade, dias = totais[(linha.dimensao, linha.chave)]
+        linha.quantidade += quantidade
+        linha.dias += dias
+    ResumoAtraso.objects.bulk_update(existentes, ['quantidade', 'dias'])
+
+    encontradas = {(linha.dimensao, linha.chave) for linha in existentes}
+    ResumoAtraso.objects.bulk_create(
+        ResumoAtraso(dimensao=dimensao, chave=chave, quantidade=quantidade, dias=dias)
+        for (dimensao, chave), (quantidade, dias) in totais.items()
+        if (dimensao, chave) not in encontradas
+    )
+
+
+def reconstruir(data=None):
+    data = data or timezone.localdate()
+    with transaction.atomic():
+        ReferenciaAtrasos.travar()
+        ResumoAtraso.objects.all().delete()
+        somar_totais(totais_em_atraso(data))
+        ReferenciaAtrasos.objects.update_or_create(pk=1, defaults={'data': data})
+    return data
+
+
+def virar_dia(data=None):
+    # Leva o resumo até `data`: quem já estava atrasado ganha os dias que passaram e entram os empréstimos
+    # que venceram desde a última referência (pelo índice de situação e data prevista, sem varrer os empréstimos)
+    data = data or timezone.localdate()
+    # Caminho comum (já virado hoje): uma leitura, sem transação
+    referencia = ReferenciaAtrasos.objects.filter(pk=1).values_list('data', flat=True).first()
+    if referencia is not None and referencia >= data:
+        return referencia
+    with transaction.atomic():
+        referencia = ReferenciaAtrasos.travar()
+        if referencia is None:
+            return reconstruir(data)
+        if referencia >= data:
+            return referencia
+        ResumoAtraso.objects.update(dias=F('dias') + F('quantidade') * (data - referencia).days)
+        somar_totais(totais_em_atraso(data, desde=referencia))
+        ReferenciaAtrasos.objects.filter(pk=1).update(data=data)
+    return data
+
+
+def divergencias(data=None):
+    # Compara o resumo (já virado até `data`) com o GROUP BY feito do zero
+    data = virar_dia(data)
+    esperado = totais_em_atraso(data)
+    atual = {
+        (dimensao, chave): (quantidade, dias)
+        for dimensao, chave, quantidade, dias in ResumoAtraso.objects.values_list('dimensao', 'chave', 'quantidade', 'dias')
+        if quantidade or dias
+    }
+    return [
+        (dimensao, chave, atual.get((dimensao, chave)), esperado.get((dimensao, chave)))
+        for dimensao, chave in sorted(atual.keys() | esperado.keys())
+        if atual.get((dimensao, chave)) != esperado.get((dimensao, chave))
+    ]
+
+
+def relatorio(limite=LIMITE_RELATORIO, data=None):
+    data = virar_dia(data)
+    nomes = {
+        ResumoAtraso.USUARIO: ('username', User.objects.only('username')),
+        ResumoAtraso.LIVRO: ('titulo', Livro.objects.only('titulo')),
+        ResumoAtraso.CATEGORIA: ('nome', Categoria.objects.only('nome')),
+    }
+
+    # Todo empréstimo atrasado aparece uma vez na dimensão de usuários
+    totais = ResumoAtraso.objects.filter(dimensao=ResumoAtraso.USUARIO).aggregate(emprestimos=Sum('quantidade'), dias=Sum('dias'))
+    dados = {'data_referencia': data, 'emprestimos': totais['emprestimos'] or 0, 'dias_em_atraso': totais['dias'] or 0}
+    for dimensao, chave_saida in ((ResumoAtraso.USUARIO, 'usuarios'), (ResumoAtraso.LIVRO, 'livros'), (ResumoAtraso.CATEGORIA, 'categorias')):
+        linhas = list(
+            ResumoAtraso.objects.filter(dimensao=dimensao, quantidade__gt=0)
+            .order_by('-dias', '-quantidade', 'chave')
+            .values_list('chave', 'quantidade', 'dias')[:limite]
+        )
+        campo, queryset = nomes[dimensao]
+        objetos = queryset.in_bulk([chave for chave, _, _ in linhas if chave])
+        dados[chave_saida] = [
+            {
+                'id': chave or None,
+                campo: getattr(objetos[chave], campo) if chave in objetos else None,
+                'emprestimos': quantidade,
+                'dias_em_atraso': dias,
+            }
+            for chave, quantidade, dias in linhas
+        ]
+    return dados
@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+# Campos do usuário mantidos em memória: o que as permissões e as views leem de request.user.
+# Os demais ficam adiados (deferred) e, se alguém acessar, o Django busca no banco
+CAMPOS_USUARIO = ('id', 'username', 'is_superuser', 'is_staff', 'is_active')
+
+
+class CacheLRU:
+    # Dicionário limitado com expiração por entrada; um lock curto por operação
+    def __init__(self, tamanho_maximo):
+        self.tamanho_maximo = tamanho_maximo
+        self.itens = OrderedDict()
+        self.lock = threading.Lock()
+        # Muda a cada remoção: uma leitura do banco que começou antes dela não é guardada
+        self.geracao = 0
+
+    def obter(self, chave):
+        with self.lock:
+            item = self.itens.get(chave)
+            if item is None:
+                return None
+            valor, expira_em = item
+            if expira_em <= time.time():
+                del self.itens[chave]
+                return None
+            self.itens.move_to_end(chave)
+            return valor
+
+    def guardar(self, chave, valor, expira_em, geracao=None):
+        with self.lock:
+            if geracao is not None and geracao != self.geracao:
+                return
+            self.itens[chave] = (valor, expira_em)
+            self.itens.move_to_end(chave)
+            while len(self.itens) > self.tamanho_maximo:
+                self.itens.popitem(last=False)
+
+    def remover(self, chave):
+        with self.lock:
+            self.geracao += 1
+            self.itens.pop(chave, None)
+
+    def limpar(self):
+        with self.lock:
+            self.itens.clear()
+
+
+# Por processo, como as métricas: em outro worker a alteração de um usuário vale depois do TTL
+tokens = CacheLRU(getattr(settings, 'BIBLIOTECA_AUTH_TOKENS_MAX', 4096))
+usuarios = CacheLRU(getattr(settings, 'BIBLIOTECA_AUTH_USUARIOS_MAX', 10000))
+
+
+def invalidar_usuario(pk):
+    usuarios.remover(pk)
+
+
+def campos_usuario(modelo):
+    # Na ordem dos campos do modelo, como o from_db espera. Com CHECK_REVOKE_TOKEN a troca de senha
+    # invalida o token, então o hash também precisa ficar em memória
+    desejados = set(CAMPOS_USUARIO) | ({'password'} if api_settings.CHECK_REVOKE_TOKEN else set())
+    return tuple(campo.attname for campo in modelo._meta.concrete_fields if campo.attname in desejados)
+
+
+class JWTAuthenticationEmCache(JWTAuthentication):
+    # Mesmo comportamento do JWTAuthentication, sem refazer o HMAC de um token já visto
+    # e sem buscar o usuário no banco a cada requisição
+
+    def get_validated_token(self, raw_token):
+        assinatura = raw_token.rsplit(b'.', 1)[-1]
+        item = tokens.obter(assinatura)
+        # O token inteiro é comparado: só a assinatura não garante que o payload é o mesmo
+        if item is not None and item[0] == raw_token:
+            return item[1]
+
+        validated_token = super().get_validated_token(raw_token)
+        expira_em = validated_token.get('exp')
+        if expira_em is not None:
+            tokens.guardar(assinatura, (raw_token, validated_token), expira_em)
+        return validated_token
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        campos = campos_usuario(self.user_model)
+        valores = usuarios.obter(user_id)
+        if valores is None:
+            geracao = usuarios.geracao
+            valores = self.user_model.objects.filter(
+                **{api_settings.USER_ID_FIELD: user_id}
+            ).values_list(*campos).first()
+            if valores is None:
+                raise AuthenticationFailed(_('User not found'), code='user_not_found')
+            ttl = getattr(settings, 'BIBLIOTECA_AUTH_USUARIOS_TTL', 30)
+            usuarios.guardar(user_id, valores, time.time() + ttl, geracao=geracao)
+
+        # Instância nova a cada requisição, com os campos que não estão no cache adiados
+        user = self.user_model.from_db(self.user_model.objects.db, campos, valores)
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
+        return user
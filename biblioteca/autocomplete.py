@@ -0,0 +1,315 @@
+import bisect
+import heapq
+import re
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models import Subquery
+from biblioteca.models import AgregadoCatalogo, Autor, Emprestimo, Livro
+from biblioteca.utils import dobrar_acentos
+
+LIMITE_SUGESTOES = 10
+LIMITE_MAXIMO_SUGESTOES = 50
+# Cada nome entra uma vez por palavra (até PALAVRAS_POR_NOME), com a chave cortada em TAMANHO_CHAVE letras
+PALAVRAS_POR_NOME = 6
+TAMANHO_CHAVE = 40
+FIM_DO_PREFIXO = '\U0010ffff'
+# Prefixos com mais chaves que isso guardam a lista dos mais populares (até MAX_PREFIXOS_GUARDADOS prefixos)
+INTERVALO_GRANDE = 500
+MAX_PREFIXOS_GUARDADOS = 5000
+
+
+def dobrar(nome):
+    return ' '.join(dobrar_acentos(nome).split())
+
+
+def chaves(dobrado):
+    inicios = [palavra.start() for palavra in re.finditer(r'\w+', dobrado)][:PALAVRAS_POR_NOME]
+    return sorted({dobrado[inicio:inicio + TAMANHO_CHAVE] for inicio in inicios})
+
+
+class IndicePrefixos:
+    # Lista ordenada de (chave, id): os nomes com um prefixo formam um intervalo contíguo, achado por bisect.
+    # O tamanho é limitado pelo número de chaves; passando dele, nomes novos ficam de fora até recarregar
+    def __init__(self, max_chaves):
+        self.max_chaves = max_chaves
+        self.entradas = []
+        self.itens = {}  # id -> [nome, popularidade, nome sem acentos, chaves]
+        # Prefixos curtos casam com boa parte do catálogo: os mais populares deles ficam prontos e
+        # são ajustados junto com os itens, em vez de ordenar o intervalo inteiro a cada busca
+        self.melhores = OrderedDict()
+
+    def carregar(self, linhas):
+        # (id, nome, popularidade), dos mais populares para os menos: se não couber tudo, ficam os populares
+        for pk, nome, popularidade in linhas:
+            dobrado = dobrar(nome)
+            chaves_nome = chaves(dobrado)
+            if len(self.entradas) + len(chaves_nome) > self.max_chaves:
+                break
+            self.itens[pk] = [nome, popularidade, dobrado, chaves_nome]
+            self.entradas.extend((chave, pk) for chave in chaves_nome)
+        self.entradas.sort()
+
+    def ordem(self, pk):
+        _, popularidade, dobrado, _ = self.itens[pk]
+        return -popularidade, dobrado, pk
+
+    def prefixos_guardados(self, pk):
+        guardados = set()
+        for chave in self.itens[pk][3]:
+            guardados.update(chave[:tamanho] for tamanho in range(1, len(chave) + 1) if chave[:tamanho] in self.melhores)
+        return guardados
+
+    def _entrar(self, pk):
+        # O item subiu (ou chegou): entra nas listas prontas dos prefixos dele se passar do último
+        for prefixo in self.prefixos_guardados(pk):
+            lista = self.melhores[prefixo]
+            if pk in lista:
+                lista.sort(key=self.ordem)
+            elif self.ordem(pk) < self.ordem(lista[-1]):
+                lista.pop()
+                bisect.insort(lista, pk, key=self.ordem)
+
+    def _sair(self, pk):
+        # O item caiu (ou saiu): quem entra no lugar dele pode estar em qualquer ponto do intervalo
+        for prefixo in self.prefixos_guardados(pk):
+            if pk in self.melhores[prefixo]:
+                del self.melhores[prefixo]
+
+    def guardar(self, pk, nome):
+        item = self.itens.get(pk)
+        if item is not None and item[0] == nome:
+            return
+        popularidade = 0
+        if item is not None:
+            self._sair(pk)
+            self._remover_chaves(pk, item[3])
+            popularidade = item[1]
+            del self.itens[pk]
+        dobrado = dobrar(nome)
+        chaves_nome = chaves(dobrado)
+        if len(self.entradas) + len(chaves_nome) > self.max_chaves:
+            return
+        for chave in chaves_nome:
+            bisect.insort(self.entradas, (chave, pk))
+        self.itens[pk] = [nome, popularidade, dobrado, chaves_nome]
+        self._entrar(pk)
+
+    def remover(self, pk):
+        if pk in self.itens:
+            self._sair(pk)
+            self._remover_chaves(pk, self.itens.pop(pk)[3])
+
+    def _remover_chaves(self, pk, chaves_nome):
+        for chave in chaves_nome:
+            i = bisect.bisect_left(self.entradas, (chave, pk))
+            if i < len(self.entradas) and self.entradas[i] == (chave, pk):
+                del self.entradas[i]
+
+    def popularidade(self, pk):
+        item = self.itens.get(pk)
+        return item[1] if item is not None else 0
+
+    def somar(self, pk, delta):
+        item = self.itens.get(pk)
+        if item is None or not delta:
+            return
+        if delta < 0:
+            self._sair(pk)
+        item[1] += delta
+        if delta > 0:
+            self._entrar(pk)
+
+    def buscar(self, prefixo, limite):
+        prefixo = dobrar(prefixo)[:TAMANHO_CHAVE]
+        if not prefixo:
+            return []
+        lista = self.melhores.get(prefixo)
+        if lista is None:
+            inicio = bisect.bisect_left(self.entradas, (prefixo,))
+            fim = bisect.bisect_left(self.entradas, (prefixo + FIM_DO_PREFIXO,), lo=inicio)
+            encontrados = {pk for _, pk in self.entradas[inicio:fim]}
+            if fim - inicio <= INTERVALO_GRANDE:
+                lista = heapq.nsmallest(limite, encontrados, key=self.ordem)
+            else:
+                lista = self.melhores[prefixo] = heapq.nsmallest(LIMITE_MAXIMO_SUGESTOES, encontrados, key=self.ordem)
+                while len(self.melhores) > MAX_PREFIXOS_GUARDADOS:
+                    self.melhores.popitem(last=False)
+        else:
+            self.melhores.move_to_end(prefixo)
+        return [(pk, self.itens[pk][0], self.itens[pk][1]) for pk in lista[:limite]]
+
+
+class Autocomplete:
+    # Índices de títulos e nomes de autores deste processo, ordenados pelos empréstimos. Carrega na
+    # primeira busca e depois só recebe os ajustes dos sinais (no commit). Alterações feitas por outros
+    # processos entram quando o índice recarrega, depois de BIBLIOTECA_AUTOCOMPLETE_TTL segundos
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.carga = threading.Lock()
+        self.livros = None
+        self.autores = None
+        self.autor_do_livro = {}
+        self.carregado_em = 0
+        # Ajustes que chegam enquanto um índice novo está sendo montado: reaplicados antes da troca, menos os que
+        # a leitura dos empréstimos já contou
+        self.pendentes = None
+
+    def ler_emprestimos(self):
+        # Totais por livro e o maior id de empréstimo na mesma consulta (a mesma leitura do banco): a marca diz quais
+        # empréstimos já estão nos totais. Sem nenhum total, nenhum empréstimo existente foi contado
+        ultimo = Emprestimo.objects.order_by('-pk').values('pk')[:1]
+        linhas = list(
+            AgregadoCatalogo.objects.filter(tipo=AgregadoCatalogo.LIVRO, valor__gt=0)
+            .annotate(marca=Subquery(ultimo)).values_list('chave', 'valor', 'marca')
+        )
+        return {chave: valor for chave, valor, _ in linhas}, linhas[0][2] if linhas else 0
+
+    def montar(self, emprestimos):
+        max_chaves = getattr(settings, 'BIBLIOTECA_AUTOCOMPLETE_MAX_CHAVES', 300_000)
+        livros = sorted(
+            ((pk, titulo, emprestimos.get(pk, 0), autor_id) for pk, titulo, autor_id in Livro.objects.values_list('id', 'titulo', 'autor_id').iterator(chunk_size=5000)),
+            key=lambda livro: -livro[2],
+        )
+        por_autor = {}
+        for _, _, total, autor_id in livros:
+            if autor_id:
+                por_autor[autor_id] = por_autor.get(autor_id, 0) + total
+        autores = sorted(
+            ((pk, nome, por_autor.get(pk, 0)) for pk, nome in Autor.objects.values_list('id', 'nome').iterator(chunk_size=5000)),
+            key=lambda autor: -autor[2],
+        )
+
+        indice_livros = IndicePrefixos(max_chaves)
+        indice_livros.carregar((pk, titulo, total) for pk, titulo, total, _ in livros)
+        indice_autores = IndicePrefixos(max_chaves)
+        indice_autores.carregar(autores)
+        autor_do_livro = {pk: autor_id for pk, _, _, autor_id in livros if pk in indice_livros.itens}
+        return indice_livros, indice_autores, autor_do_livro
+
+    def carregar(self, esperar=True):
+        pedido = time.monotonic()
+        if not self.carga.acquire(blocking=esperar):
+            return  # outra thread já está recarregando; esta segue com o índice atual
+        try:
+            if self.livros is not None and self.carregado_em >= pedido:
+                return  # carregado por outra thread enquanto esta esperava
+            with self.lock:
+                self.pendentes = []
+            try:
+                emprestimos, marca = self.ler_emprestimos()
+                with self.lock:
+                    corte = len(self.pendentes)
+                livros, autores, autor_do_livro = self.montar(emprestimos)
+            except Exception:
+                with self.lock:
+                    self.pendentes = None
+                raise
+            with self.lock:
+                self.livros, self.autores, self.autor_do_livro = livros, autores, autor_do_livro
+                for posicao, (ajuste, args) in enumerate(self.pendentes):
+                    if ajuste == self._emprestimos:
+                        args = (self.fora_da_leitura(*args, marca, posicao >= corte), args[1])
+                    ajuste(*args)
+                self.pendentes = None
+                self.carregado_em = time.monotonic()
+        finally:
+            self.carga.release()
+
+    def garantir_carregado(self):
+        if self.livros is None:
+            self.carregar()
+        elif time.monotonic() - self.carregado_em > getattr(settings, 'BIBLIOTECA_AUTOCOMPLETE_TTL', 300):
+            self.carregar(esperar=False)
+
+    def descartar(self):
+        with self.lock:
+            self.livros = self.autores = None
+            self.autor_do_livro = {}
+
+    def buscar(self, termo, limite=LIMITE_SUGESTOES, tipos=('livros', 'autores')):
+        self.garantir_carregado()
+        with self.lock:
+            return {
+                tipo: (self.livros if tipo == 'livros' else self.autores).buscar(termo, limite)
+                for tipo in tipos
+            }
+
+    @staticmethod
+    def fora_da_leitura(emprestimos, delta, marca, depois_da_leitura):
+        # Ajustes de empréstimos que chegaram durante a recarga e que os totais lidos ainda não contam. Criados até a
+        # marca já foram contados. Numa exclusão o id não diz se a leitura ainda viu o empréstimo: valem as que
+        # chegaram depois dela
+        if delta > 0:
+            return [(pk, livro_id) for pk, livro_id in emprestimos if pk > marca]
+        return [(pk, livro_id) for pk, livro_id in emprestimos if pk > marca or depois_da_leitura]
+
+    def ajustar(self, ajuste, *args):
+        with self.lock:
+            if self.pendentes is not None:
+                self.pendentes.append((ajuste, args))
+            if self.livros is not None:
+                ajuste(*args)
+
+    # Ajustes, sempre chamados com o lock: os sinais passam por ajustar()
+
+    def _livro_salvo(self, pk, titulo, autor_id):
+        anterior = self.autor_do_livro.get(pk)
+        if anterior != autor_id:
+            total = self.livros.popularidade(pk)
+            self.autores.somar(anterior, -total)
+            self.autores.somar(autor_id, total)
+        self.livros.guardar(pk, titulo)
+        if pk in self.livros.itens:
+            self.autor_do_livro[pk] = autor_id
+        else:
+            self.autor_do_livro.pop(pk, None)
+
+    def _livros_salvos(self, livros):
+        for pk, titulo, autor_id in livros:
+            self._livro_salvo(pk, titulo, autor_id)
+
+    def _livro_removido(self, pk):
+        self.autores.somar(self.autor_do_livro.pop(pk, None), -self.livros.popularidade(pk))
+        self.livros.remover(pk)
+
+    def _autor_salvo(self, pk, nome):
+        self.autores.guardar(pk, nome)
+
+    def _autor_removido(self, pk):
+        self.autores.remover(pk)
+
+    def _emprestimos(self, emprestimos, delta):
+        totais = {}
+        for _, livro_id in emprestimos:
+            totais[livro_id] = totais.get(livro_id, 0) + delta
+        for livro_id, total in totais.items():
+            self.livros.somar(livro_id, total)
+            self.autores.somar(self.autor_do_livro.get(livro_id), total)
+
+    def livro_salvo(self, pk, titulo, autor_id):
+        self.ajustar(self._livro_salvo, pk, titulo, autor_id)
+
+    def livros_salvos(self, livros):
+        # Importação em lote: (id, título, autor_id) de cada livro, num ajuste só
+        self.ajustar(self._livros_salvos, livros)
+
+    def livro_removido(self, pk):
+        self.ajustar(self._livro_removido, pk)
+
+    def autor_salvo(self, pk, nome):
+        self.ajustar(self._autor_salvo, pk, nome)
+
+    def autor_removido(self, pk):
+        self.ajustar(self._autor_removido, pk)
+
+    def emprestimos(self, pk, livro_id, delta):
+        self.ajustar(self._emprestimos, [(pk, livro_id)], delta)
+
+    def emprestimos_em_lote(self, emprestimos):
+        # Empréstimos criados em lote: (id, livro_id) de cada um, num ajuste só
+        self.ajustar(self._emprestimos, emprestimos, 1)
+
+
+indice = Autocomplete()
@@ -0,0 +1,434 @@
+import asyncio
+import datetime
+import json
+import math
+import platform
+import random
+import threading
+import time
+import tracemalloc
+import django
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.test import AsyncClient, Client, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.request import Request
+from rest_framework.test import APIClient
+from biblioteca.models import (
+    Livro, Autor, Categoria, Emprestimo, EmprestimosAbertos, LivroEmprestado,
+    LIMITE_LIVROS_POR_CATEGORIA, LIMITE_EMPRESTIMOS_ABERTOS,
+)
+from biblioteca.utils import normalizar_titulo
+from biblioteca import agregados, atrasos, autocomplete, cache, search, throttling
+
+# Tamanhos dos conjuntos de dados; o número de categorias respeita o limite de livros por categoria
+ESCALAS = {
+    'mini': {'livros': 300, 'autores': 30, 'emprestimos': 300},
+    '10k': {'livros': 10_000, 'autores': 1_000, 'emprestimos': 10_000},
+    '100k': {'livros': 100_000, 'autores': 10_000, 'emprestimos': 100_000},
+    '1m': {'livros': 1_000_000, 'autores': 50_000, 'emprestimos': 1_000_000},
+}
+
+# Orçamento por endpoint: consultas SQL por requisição e latência p95 em milissegundos
+ORCAMENTOS_PADRAO = {
+    'api-livros-list': {'queries': 3, 'p95_ms': 250},
+    'api-livros-list-titulo': {'queries': 3, 'p95_ms': 250},
+    'api-livros-list-busca': {'queries': 3, 'p95_ms': 250},
+    'api-livros-list-disponivel': {'queries': 3, 'p95_ms': 250},
+    'api-livros-disponibilidade': {'queries': 1, 'p95_ms': 100},
+    'api-livros-retrieve': {'queries': 2, 'p95_ms': 100},
+    'api-livros-create': {'queries': 17, 'p95_ms': 250},
+    'api-livros-partial_update': {'queries': 12, 'p95_ms': 250},
+    'api-categoria-list': {'queries': 2, 'p95_ms': 250},
+    'api-autores-list': {'queries': 2, 'p95_ms': 500},
+    'api-autores-retrieve': {'queries': 2, 'p95_ms': 100},
+    'api-emprestimos-list': {'queries': 1, 'p95_ms': 250},
+    'api-emprestimos-create': {'queries': 14, 'p95_ms': 250},
+    'relatorio-atrasos': {'queries': 8, 'p95_ms': 100},
+    'estatisticas': {'queries': 7, 'p95_ms': 100},
+    'autocomplete': {'queries': 0, 'p95_ms': 20},
+}
+
+TAMANHO_LOTE = 5000
+PALAVRAS = (
+    'amor guerra noite cidade mar sombra tempo memória viagem silêncio jardim '
+    'rio casa segredo história caminho sonho luz fogo vento terra destino'
+).split()
+
+
+def _em_lotes(objetos, modelo):
+    lote = []
+    for obj in objetos:
+        lote.append(obj)
+        if len(lote) >= TAMANHO_LOTE:
+            modelo.objects.bulk_create(lote)
+            lote = []
+    if lote:
+        modelo.objects.bulk_create(lote)
+
+
+def semear(escala='mini', seed=42):
+    # Gera sempre os mesmos dados para a mesma escala e seed, direto com bulk_create
+    tamanhos = ESCALAS[escala]
+    aleatorio = random.Random(seed)
+    hoje = datetime.date.today()
+
+    with transaction.atomic():
+        admin = User.objects.create_superuser('benchmark', first_name='Bench', last_name='Mark')
+        total_usuarios = max(50, tamanhos['emprestimos'] // 10)
+        _em_lotes((User(username=f'leitor{i}', password='!') for i in range(total_usuarios)), User)
+        usuarios = list(User.objects.filter(username__startswith='leitor').values_list('id', flat=True))
+
+        _em_lotes((
+            Autor(nome=f'Autor {i} {aleatorio.choice(PALAVRAS).title()}', biografia=' '.join(aleatorio.choices(PALAVRAS, k=30)))
+            for i in range(tamanhos['autores'])
+        ), Autor)
+        autores = list(Autor.objects.values_list('id', flat=True))
+
+        total_categorias = math.ceil(tamanhos['livros'] / (LIMITE_LIVROS_POR_CATEGORIA * 0.8))
+        _em_lotes((Categoria(nome=f'Categoria {i}') for i in range(total_categorias)), Categoria)
+        categorias = list(Categoria.objects.values_list('id', flat=True))
+
+        contagem = dict.fromkeys(categorias, 0)
+
+        def livros():
+            for i in range(tamanhos['livros']):
+                categoria = aleatorio.choice(categorias)
+                while contagem[categoria] >= LIMITE_LIVROS_POR_CATEGORIA:
+                    categoria = aleatorio.choice(categorias)
+                contagem[categoria] += 1
+                titulo = f'{aleatorio.choice(PALAVRAS).title()} {aleatorio.choice(PALAVRAS)} {i}'
+                yield Livro(
+                    titulo=titulo, titulo_normalizado=normalizar_titulo(titulo),
+                    descricao=' '.join(aleatorio.choices(PALAVRAS, k=40)),
+                    data_publicacao=hoje - datetime.timedelta(days=aleatorio.randint(30, 365 * 80)),
+                    autor_id=aleatorio.choice(autores), categoria_id=categoria, criador=admin,
+                )
+
+        _em_lotes(livros(), Livro)
+        Categoria.objects.bulk_update(
+            [Categoria(pk=pk, livros_count=total) for pk, total in contagem.items()], ['livros_count'], batch_size=TAMANHO_LOTE
+        )
+        ids_livros = list(Livro.objects.values_list('id', flat=True))
+
+        # Empréstimos antigos já devolvidos e alguns abertos, mantendo as tabelas de controle coerentes
+        abertos_por_usuario = {}
+        livros_emprestados = set()
+
+        def emprestimos():
+            for _ in range(tamanhos['emprestimos']):
+                livro = aleatorio.choice(ids_livros)
+                usuario = aleatorio.choice(usuarios)
+                inicio = hoje - datetime.timedelta(days=aleatorio.randint(1, 720))
+                aberto = (
+                    aleatorio.random() < 0.2 and livro not in livros_emprestados
+                    and abertos_por_usuario.get(usuario, 0) < LIMITE_EMPRESTIMOS_ABERTOS
+                )
+                if aberto:
+                    livros_emprestados.add(livro)
+                    abertos_por_usuario[usuario] = abertos_por_usuario.get(usuario, 0) + 1
+                yield Emprestimo(
+                    livro_id=livro, usuario_id=usuario, data_inicio=inicio,
+                    data_prevista_devolucao=inicio + datetime.timedelta(days=14), devolvido=not aberto,
+                )
+
+        _em_lotes(emprestimos(), Emprestimo)
+        _em_lotes((EmprestimosAbertos(usuario_id=u, quantidade=q) for u, q in abertos_por_usuario.items()), EmprestimosAbertos)
+        _em_lotes((
+            LivroEmprestado(livro_id=livro_id, emprestimo_id=emprestimo_id)
+            for emprestimo_id, livro_id in Emprestimo.objects.filter(devolvido=False).values_list('id', 'livro_id').iterator()
+        ), LivroEmprestado)
+
+        search.reconstruir_indice()
+        atrasos.reconstruir(hoje)
+        agregados.reconstruir()
+    # Dados inseridos com bulk_create (sem sinais): o autocomplete carrega de novo na primeira busca
+    autocomplete.indice.descartar()
+    for modelo in (Livro, Autor, Categoria, User):
+        cache.incrementar_versao(modelo)
+    return admin
+
+
+def _amostra(aleatorio, qs, quantidade):
+    # Sorteio pela seed (e não ORDER BY RANDOM()) para repetir os mesmos ids entre execuções
+    ids = list(qs.order_by('id').values_list('id', flat=True))
+    return aleatorio.sample(ids, min(quantidade, len(ids)))
+
+
+def cenarios(admin, seed=42, repeticoes=20):
+    # Cada cenário: (nome, método, função que monta url e dados a partir do número da repetição)
+    aleatorio = random.Random(seed)
+    ids_livros = _amostra(aleatorio, Livro.objects.all(), 500)
+    ids_autores = _amostra(aleatorio, Autor.objects.all(), 500)
+    # Categorias novas para os livros criados no benchmark, sem esbarrar no limite por categoria
+    categorias = [
+        Categoria.objects.create(nome=f'Benchmark {seed} {i}').pk
+        for i in range(math.ceil((repeticoes + 2) / LIMITE_LIVROS_POR_CATEGORIA))
+    ]
+    paginas = max(1, min(20, Livro.objects.count() // 50))
+    autor = ids_autores[0]
+    livros_livres = _amostra(aleatorio, Livro.objects.filter(emprestimo_atual__isnull=True), 1000)
+    usuarios_livres = list(
+        User.objects.filter(username__startswith='leitor')
+        .filter(Q(emprestimos_abertos__isnull=True) | Q(emprestimos_abertos__quantidade=0))
+        .values_list('id', flat=True)[:1000]
+    )
+    hoje = datetime.date.today()
+
+    def novo_livro(i):
+        return {
+            'titulo': f'Benchmark livro {seed} {i}', 'descricao': 'Descrição gerada para o benchmark.',
+            'data_publicacao': '2020-01-01', 'categoria_id': categorias[i // LIMITE_LIVROS_POR_CATEGORIA], 'autor_id': autor,
+        }
+
+    return [
+        ('api-livros-list', 'get', lambda i: (f'/api/livros/?page={i % paginas + 1}', None)),
+        ('api-livros-list-titulo', 'get', lambda i: (f'/api/livros/?titulo={aleatorio.choice(PALAVRAS)}', None)),
+        ('api-livros-list-busca', 'get', lambda i: (f'/api/livros/?q={aleatorio.choice(PALAVRAS)}', None)),
+        ('api-livros-list-disponivel', 'get', lambda i: (f'/api/livros/?disponivel={"false" if i % 2 else "true"}', None)),
+        ('api-livros-disponibilidade', 'get', lambda i: (f'/api/livros/disponibilidade/?ids={",".join(map(str, ids_livros))}', None)),
+        ('api-livros-retrieve', 'get', lambda i: (f'/api/livros/{ids_livros[i % len(ids_livros)]}/', None)),
+        ('api-livros-create', 'post', lambda i: ('/api/livros/', novo_livro(i))),
+        ('api-livros-partial_update', 'patch', lambda i: (
+            f'/api/livros/{ids_livros[i % len(ids_livros)]}/', {'descricao': f'Descrição atualizada no benchmark {i}.'}
+        )),
+        ('api-categoria-list', 'get', lambda i: ('/api/categorias/', None)),
+        ('api-autores-list', 'get', lambda i: (f'/api/autores/?nome_autor={i}', None)),
+        ('api-autores-retrieve', 'get', lambda i: (f'/api/autores/{ids_autores[i % len(ids_autores)]}/', None)),
+        ('api-emprestimos-list', 'get', lambda i: ('/api/emprestimos/?paginacao=cursor', None)),
+        ('relatorio-atrasos', 'get', lambda i: ('/api/relatorios/atrasos/', None)),
+        ('estatisticas', 'get', lambda i: ('/api/estatisticas/', None)),
+        ('autocomplete', 'get', lambda i: (f'/api/autocomplete/?q={aleatorio.choice(PALAVRAS)[:3]}', None)),
+        ('api-emprestimos-create', 'post', lambda i: ('/api/emprestimos/', {
+            'livro': livros_livres[i % len(livros_livres)], 'usuario': usuarios_livres[i % len(usuarios_livres)],
+            'data_prevista_devolucao': str(hoje + datetime.timedelta(days=14)),
+        })),
+    ]
+
+
+def percentil(valores, p):
+    # Percentil pelo método nearest-rank
+    ordenados = sorted(valores)
+    indice = max(0, math.ceil(p / 100 * len(ordenados)) - 1)
+    return ordenados[indice]
+
+
+def medir(admin, repeticoes=20, seed=42, com_cache=False, filtro=None):
+    client = APIClient()
+    client.force_authenticate(admin)
+    resultados = {}
+    for nome, metodo, montar in cenarios(admin, seed=seed, repeticoes=repeticoes):
+        if filtro and filtro not in nome:
+            continue
+        latencias, queries, status = [], [], set()
+        for i in range(repeticoes + 1):
+            url, dados = montar(i)
+            if not com_cache:
+                cache.get_cache().clear()
+            with CaptureQueriesContext(connection) as capturadas:
+                inicio = time.perf_counter()
+                response = getattr(client, metodo)(url, dados, format='json') if dados else getattr(client, metodo)(url)
+                duracao = time.perf_counter() - inicio
+            status.add(response.status_code)
+            if i == 0:
+                continue  # aquecimento
+            latencias.append(duracao * 1000)
+            queries.append(len(capturadas))
+
+        # Pico de memória medido numa requisição à parte, já que o tracemalloc deixa tudo mais lento
+        url, dados = montar(repeticoes + 1)
+        if not com_cache:
+            cache.get_cache().clear()
+        tracemalloc.start()
+        getattr(client, metodo)(url, dados, format='json') if dados else getattr(client, metodo)(url)
+        _, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        resultados[nome] = {
+            'p50_ms': round(percentil(latencias, 50), 3),
+            'p95_ms': round(percentil(latencias, 95), 3),
+            'p99_ms': round(percentil(latencias, 99), 3),
+            'media_ms': round(sum(latencias) / len(latencias), 3),
+            'queries': round(sorted(queries)[len(queries) // 2], 1),
+            'queries_max': max(queries),
+            'pico_memoria_kb': round(pico / 1024, 1),
+            'status': sorted(status),
+        }
+    return resultados
+
+
+# Listagens servidas pelas ViewSets síncronas (WSGI) e pelas views assíncronas (ASGI)
+ROTAS_CARGA = ('livros/', 'livros/?titulo=amor', 'autores/', 'categorias/')
+
+
+class _PicoDeThreads:
+    # Amostra threading.active_count() enquanto a carga roda
+    def __init__(self):
+        self.pico = threading.active_count()
+        self.parar = threading.Event()
+        self.thread = threading.Thread(target=self.amostrar, daemon=True)
+
+    def amostrar(self):
+        while not self.parar.wait(0.002):
+            self.pico = max(self.pico, threading.active_count())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.parar.set()
+        self.thread.join()
+
+
+def _resumo_carga(latencias, status, duracao):
+    return {
+        'requisicoes': len(latencias),
+        'requisicoes_por_segundo': round(len(latencias) / duracao, 1),
+        'p50_ms': round(percentil(latencias, 50), 3),
+        'p95_ms': round(percentil(latencias, 95), 3),
+        'p99_ms': round(percentil(latencias, 99), 3),
+        'status': sorted(status),
+    }
+
+
+def carga_wsgi(requisicoes=400, concorrencia=32):
+    # Um servidor WSGI com threads: cada requisição ocupa uma thread do começo ao fim
+    status = set()
+
+    def requisitar(i):
+        # O parâmetro _ muda a chave do cache de respostas, então toda requisição vai ao banco
+        url = f'/api/{ROTAS_CARGA[i % len(ROTAS_CARGA)]}'
+        url += ('&' if '?' in url else '?') + f'_={i}'
+        try:
+            inicio = time.perf_counter()
+            status.add(Client().get(url).status_code)
+            return (time.perf_counter() - inicio) * 1000
+        finally:
+            connections.close_all()
+
+    with _PicoDeThreads() as threads, ThreadPoolExecutor(max_workers=concorrencia) as executor:
+        inicio = time.perf_counter()
+        latencias = list(executor.map(requisitar, range(requisicoes)))
+        duracao = time.perf_counter() - inicio
+    return {**_resumo_carga(latencias, status, duracao), 'threads_pico': threads.pico}
+
+
+def carga_asgi(requisicoes=400, concorrencia=32):
+    # As mesmas listagens pelas views assíncronas, com o ASGIHandler num único event loop
+    status = set()
+
+    async def executar():
+        client = AsyncClient()
+        semaforo = asyncio.Semaphore(concorrencia)
+
+        async def requisitar(i):
+            url = f'/api/async/{ROTAS_CARGA[i % len(ROTAS_CARGA)]}'
+            url += ('&' if '?' in url else '?') + f'_={i}'
+            async with semaforo:
+                inicio = time.perf_counter()
+                status.add((await client.get(url)).status_code)
+                return (time.perf_counter() - inicio) * 1000
+
+        return await asyncio.gather(*(requisitar(i) for i in range(requisicoes)))
+
+    with _PicoDeThreads() as threads:
+        inicio = time.perf_counter()
+        latencias = asyncio.run(executar())
+        duracao = time.perf_counter() - inicio
+    connections.close_all()
+    return {**_resumo_carga(latencias, status, duracao), 'threads_pico': threads.pico}
+
+
+def comparar_carga(requisicoes=400, concorrencia=32):
+    return {
+        'concorrencia': concorrencia,
+        'wsgi': carga_wsgi(requisicoes, concorrencia),
+        'asgi': carga_asgi(requisicoes, concorrencia),
+    }
+
+
+def sem_limites():
+    # O throttle continua rodando (e entra na latência), mas com limites que a medição não alcança
+    return override_settings(BIBLIOTECA_THROTTLE_TAXAS={
+        escopo: '1000000000/min' for escopo in getattr(settings, 'BIBLIOTECA_THROTTLE_TAXAS', {})
+    })
+
+
+def medir_throttle(iteracoes=20000):
+    # Custo por requisição do throttle: allow_request de uma leitura anônima com o cache configurado
+    request = Request(RequestFactory().get('/api/livros/', REMOTE_ADDR='203.0.113.1'), authenticators=())
+    throttle = throttling.ThrottlePorEscopo()
+    with override_settings(BIBLIOTECA_THROTTLE_TAXAS={'catalogo-ip': f'{iteracoes * 10}/min'}):
+        throttle.allow_request(request, None)  # aquecimento
+        duracoes = []
+        for _ in range(iteracoes):
+            inicio = time.perf_counter()
+            throttle.allow_request(request, None)
+            duracoes.append((time.perf_counter() - inicio) * 1_000_000)
+    return {
+        'requisicoes': iteracoes,
+        'media_us': round(sum(duracoes) / len(duracoes), 2),
+        'p50_us': round(percentil(duracoes, 50), 2),
+        'p99_us': round(percentil(duracoes, 99), 2),
+        'cache': throttling.get_cache().__class__.__name__,
+    }
+
+
+def verificar_orcamentos(resultados, orcamentos=None, latencia=True):
+    orcamentos = ORCAMENTOS_PADRAO if orcamentos is None else orcamentos
+    violacoes = []
+    for nome, medicao in resultados.items():
+        orcamento = orcamentos.get(nome, {})
+        if 'queries' in orcamento and medicao['queries_max'] > orcamento['queries']:
+            violacoes.append(f"{nome}: {medicao['queries_max']} queries (orçamento {orcamento['queries']})")
+        if latencia and 'p95_ms' in orcamento and medicao['p95_ms'] > orcamento['p95_ms']:
+            violacoes.append(f"{nome}: p95 {medicao['p95_ms']}ms (limite {orcamento['p95_ms']}ms)")
+        if any(codigo >= 400 for codigo in medicao['status']):
+            violacoes.append(f"{nome}: respostas com erro {medicao['status']}")
+    return violacoes
+
+
+def relatorio(escala, seed, repeticoes, resultados, violacoes, carga=None, throttle=None):
+    dados = {
+        'meta': {
+            'escala': escala,
+            'seed': seed,
+            'repeticoes': repeticoes,
+            'data': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'banco': connection.vendor,
+            'debug': settings.DEBUG,
+        },
+        'resultados': resultados,
+        'violacoes': violacoes,
+    }
+    if carga:
+        dados['carga'] = carga
+    if throttle:
+        dados['throttle'] = throttle
+    return dados
+
+
+def comparar(atual, anterior):
+    # Diferença percentual do p95 e das queries em relação a uma execução salva
+    linhas = []
+    for nome, medicao in atual['resultados'].items():
+        antes = anterior.get('resultados', {}).get(nome)
+        if not antes:
+            continue
+        delta = (medicao['p95_ms'] - antes['p95_ms']) / antes['p95_ms'] * 100 if antes['p95_ms'] else 0.0
+        linhas.append(
+            f"{nome}: p95 {antes['p95_ms']} -> {medicao['p95_ms']}ms ({delta:+.1f}%), "
+            f"queries {antes['queries']} -> {medicao['queries']}"
+        )
+    return linhas
+
+
+def salvar(caminho, dados):
+    with open(caminho, 'w', encoding='utf-8') as arquivo:
+        json.dump(dados, arquivo, ensure_ascii=False, indent=2)
@@ -0,0 +1,130 @@
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.response import Response
+
+PREFIXO = 'biblioteca:resposta'
+CHAVE_ACERTOS = f'{PREFIXO}:acertos'
+CHAVE_FALHAS = f'{PREFIXO}:falhas'
+
+
+def get_cache():
+    return caches[getattr(settings, 'BIBLIOTECA_CACHE_ALIAS', 'default')]
+
+
+def chave_versao(modelo):
+    return f'{PREFIXO}:versao:{modelo._meta.label_lower}'
+
+
+def incrementar_versao(modelo):
+    cache = get_cache()
+    chave = chave_versao(modelo)
+    try:
+        cache.incr(chave)
+    except ValueError:
+        # Versão inexistente ou removida do cache: um valor novo invalida as entradas antigas
+        cache.set(chave, time.time_ns(), timeout=None)
+
+
+def versoes(modelos):
+    cache = get_cache()
+    chaves = [chave_versao(modelo) for modelo in modelos]
+    encontradas = cache.get_many(chaves)
+    for chave in chaves:
+        if chave not in encontradas:
+            cache.add(chave, time.time_ns(), timeout=None)
+            encontradas[chave] = cache.get(chave)
+    return [encontradas[chave] for chave in chaves]
+
+
+async def aversoes(modelos):
+    # Versão assíncrona de versoes(), para as views do ORM assíncrono
+    cache = get_cache()
+    chaves = [chave_versao(modelo) for modelo in modelos]
+    encontradas = await cache.aget_many(chaves)
+    for chave in chaves:
+        if chave not in encontradas:
+            await cache.aadd(chave, time.time_ns(), timeout=None)
+            encontradas[chave] = await cache.aget(chave)
+    return [encontradas[chave] for chave in chaves]
+
+
+def normalizar_parametros(query_params):
+    # Ordena chaves e valores e ignora parâmetros vazios, que os filtros também ignoram
+    itens = []
+    for chave in sorted(query_params.keys()):
+        valores = sorted(valor for valor in query_params.getlist(chave) if valor != '')
+        if valores:
+            itens.append((chave, valores))
+    return itens
+
+
+def montar_chave(request, modelos, versoes_modelos=None):
+    if versoes_modelos is None:
+        versoes_modelos = versoes(modelos)
+    partes = [request.build_absolute_uri(request.path), repr(normalizar_parametros(request.query_params)), repr(versoes_modelos)]
+    resumo = hashlib.sha256('|'.join(partes).encode()).hexdigest()
+    return f'{PREFIXO}:{resumo}'
+
+
+def contar(chave):
+    cache = get_cache()
+    if not cache.add(chave, 1, timeout=None):
+        try:
+            cache.incr(chave)
+        except ValueError:
+            cache.set(chave, 1, timeout=None)
+
+
+async def acontar(chave):
+    cache = get_cache()
+    if not await cache.aadd(chave, 1, timeout=None):
+        try:
+            await cache.aincr(chave)
+        except ValueError:
+            await cache.aset(chave, 1, timeout=None)
+
+
+def estatisticas():
+    valores = get_cache().get_many([CHAVE_ACERTOS, CHAVE_FALHAS])
+    acertos = valores.get(CHAVE_ACERTOS, 0)
+    falhas = valores.get(CHAVE_FALHAS, 0)
+    total = acertos + falhas
+    return {
+        'acertos': acertos,
+        'falhas': falhas,
+        'taxa_acerto': round(acertos / total, 4) if total else 0.0,
+    }
+
+
+class RespostaEmCacheMixin:
+    # Modelos cujas escritas invalidam as respostas desta ViewSet
+    cache_modelos = ()
+
+    def list(self, request, *args, **kwargs):
+        return self.responder_com_cache(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.responder_com_cache(super().retrieve, request, *args, **kwargs)
+
+    def responder_com_cache(self, handler, request, *args, **kwargs):
+        if request.method != 'GET':
+            return handler(request, *args, **kwargs)
+
+        cache = get_cache()
+        chave = montar_chave(request, self.cache_modelos)
+        dados = cache.get(chave)
+        if dados is not None:
+            contar(CHAVE_ACERTOS)
+            response = Response(dados, status=status.HTTP_200_OK)
+            response['X-Cache'] = 'HIT'
+            return response
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            cache.set(chave, response.data, timeout=getattr(settings, 'BIBLIOTECA_CACHE_TIMEOUT', 300))
+        contar(CHAVE_FALHAS)
+        response['X-Cache'] = 'MISS'
+        return response
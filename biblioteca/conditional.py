@@ -0,0 +1,85 @@
+import hashlib
+import time
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max
+from django.http import Http404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from biblioteca.cache import normalizar_parametros
+from biblioteca.pagination import cursor_solicitado
+
+
+class RespostaCondicionalMixin:
+    # ETag e Last-Modified saem de uma agregação no banco (COUNT e MAX(updated_at)) sobre o conjunto filtrado, e
+    # não do corpo renderizado nem do cache em memória, que é de cada processo: uma escrita atendida por um
+    # worker muda os validadores de todos. Campos updated_at que entram no MAX (os das relações mostradas na
+    # resposta também; empréstimos e renomes de usuário marcam o updated_at do livro)
+    condicional_campos = ('updated_at',)
+
+    def list(self, request, *args, **kwargs):
+        if cursor_solicitado(request):
+            # A página por cursor é uma consulta só, sem COUNT: a impressão digital custaria mais que ela
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        return self.responder_condicional(queryset, super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            queryset = self.filter_queryset(self.get_queryset()).filter(
+                **{self.lookup_field: kwargs[lookup_url_kwarg]}
+            )
+        except (TypeError, ValueError, ValidationError):
+            # Mesmo tratamento do get_object_or_404 do DRF para chaves inválidas
+            raise Http404
+        return self.responder_condicional(queryset, super().retrieve, request, *args, **kwargs)
+
+    def impressao_digital(self, queryset):
+        # Uma agregação barata (MAX/COUNT) no lugar de serializar o corpo e calcular o hash
+        return self.resumir_agregados(queryset.order_by().aggregate(**self.agregados()))
+
+    async def aimpressao_digital(self, queryset):
+        return self.resumir_agregados(await queryset.order_by().aaggregate(**self.agregados()))
+
+    def agregados(self):
+        agregados = {f'max_{i}': Max(campo) for i, campo in enumerate(self.condicional_campos)}
+        return {'total': Count('pk'), **agregados}
+
+    def resumir_agregados(self, resultado):
+        datas = [resultado[f'max_{i}'] for i in range(len(self.condicional_campos))]
+        datas = [data for data in datas if data is not None]
+        return resultado['total'], max(datas) if datas else None
+
+    def responder_condicional(self, queryset, handler, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return handler(request, *args, **kwargs)
+
+        etag, last_modified = self.validadores(request, *self.impressao_digital(queryset))
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        return self.aplicar_validadores(response, etag, last_modified)
+
+    def validadores(self, request, total, ultima_alteracao):
+        partes = [
+            request.path,
+            repr(normalizar_parametros(request.query_params)),
+            request.accepted_renderer.format,
+            str(total),
+            ultima_alteracao.isoformat() if ultima_alteracao else '',
+        ]
+        etag = quote_etag(hashlib.sha256('|'.join(partes).encode()).hexdigest()[:32])
+        # O Last-Modified é em segundos: só é enviado depois que o segundo da última escrita acabou, senão
+        # outra escrita no mesmo segundo passaria por um If-Modified-Since com a mesma data
+        last_modified = int(ultima_alteracao.timestamp()) if ultima_alteracao else None
+        if last_modified is not None and last_modified >= int(time.time()):
+            last_modified = None
+        return etag, last_modified
+
+    def aplicar_validadores(self, response, etag, last_modified):
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
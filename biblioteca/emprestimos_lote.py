@@ -0,0 +1,265 @@
+import datetime
+from functools import partial
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from biblioteca.models import (
+    AgregadoCatalogo, Emprestimo, EmprestimosAbertos, Livro, LivroEmprestado, ReferenciaAtrasos, ResumoAtraso,
+    LIMITE_EMPRESTIMOS_ABERTOS,
+)
+from biblioteca.validators import EmprestimoValidate
+from biblioteca import atrasos, autocomplete, cache
+
+MAX_ITENS_LOTE = 1000
+
+
+def _inteiro(valor):
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+def _erro(numero, campo, mensagem):
+    return {'linha': numero, 'status': 'erro', 'erros': {campo: [mensagem]}}
+
+
+def _somar_por_usuario(usuarios, sinal):
+    # Um UPDATE só para os contadores de todos os usuários do lote
+    if not usuarios:
+        return
+    EmprestimosAbertos.objects.filter(usuario_id__in=usuarios).update(quantidade=Greatest(
+        Case(*(When(usuario_id=usuario_id, then=F('quantidade') + sinal * quantidade) for usuario_id, quantidade in usuarios.items())),
+        Value(0),
+    ))
+
+
+def _contar(valores):
+    contagem = {}
+    for valor in valores:
+        contagem[valor] = contagem.get(valor, 0) + 1
+    return contagem
+
+
+def _livros_emprestados_mudaram(livro_ids):
+    # bulk_create/update/delete não disparam os sinais: marca os livros e invalida o cache manualmente
+    Livro.marcar_alterados(pk__in=livro_ids)
+    cache.incrementar_versao(LivroEmprestado)
+    transaction.on_commit(lambda: cache.incrementar_versao(LivroEmprestado))
+
+
+def _remover_livros_emprestados(emprestimo_ids):
+    tabela = connection.ops.quote_name(LivroEmprestado._meta.db_table)
+    marcadores = ', '.join(['%s'] * len(emprestimo_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {tabela} WHERE emprestimo_id IN ({marcadores})', emprestimo_ids)
+
+
+def _descontar_atrasos(devolvidos):
+    # Tira do resumo os empréstimos que já contavam como atrasados na data de referência
+    hoje = timezone.localdate()
+    vencidos = [emprestimo for emprestimo in devolvidos if emprestimo['data_prevista_devolucao'] < hoje]
+    if not vencidos:
+        return
+    referencia = ReferenciaAtrasos.travar()
+    totais = {}
+    for emprestimo in vencidos:
+        if referencia is None or emprestimo['data_prevista_devolucao'] >= referencia:
+            continue
+        dias = (referencia - emprestimo['data_prevista_devolucao']).days
+        for chave in ResumoAtraso.chaves(emprestimo['usuario_id'], emprestimo['livro_id'], emprestimo['livro__categoria_id']):
+            quantidade, soma = totais.get(chave, (0, 0))
+            totais[chave] = (quantidade - 1, soma - dias)
+    if totais:
+        atrasos.somar_totais(totais)
+        filtro = Q()
+        for dimensao, chave in totais:
+            filtro |= Q(dimensao=dimensao, chave=chave)
+        ResumoAtraso.objects.filter(filtro, quantidade__lte=0).delete()
+
+
+def devolver_em_lote(ids, usuario=None):
+    # Devolve os empréstimos de `ids` (só os de `usuario`, se informado) e gera o resultado de cada um na ordem de entrada
+    resultados = {}
+    pedidos = {}
+    for numero, pk in enumerate(ids, start=1):
+        pk = _inteiro(pk)
+        if pk is None:
+            resultados[numero] = _erro(numero, 'id', 'O id do empréstimo deve ser um número inteiro.')
+        else:
+            pedidos[numero] = pk
+
+    with transaction.atomic():
+        emprestimos = Emprestimo.objects.filter(pk__in=set(pedidos.values()))
+        if usuario is not None:
+            emprestimos = emprestimos.filter(usuario=usuario)
+        encontrados = {
+            emprestimo['id']: emprestimo
+            for emprestimo in emprestimos.values(
+                'id', 'livro_id', 'usuario_id', 'livro__categoria_id', 'data_inicio', 'data_prevista_devolucao', 'devolvido',
+            )
+        }
+
+        devolvidos = {}
+        for numero, pk in pedidos.items():
+            emprestimo = encontrados.get(pk)
+            if emprestimo is None:
+                resultados[numero] = _erro(numero, 'id', 'Empréstimo não encontrado.')
+                continue
+            if emprestimo['devolvido'] or pk in devolvidos:
+                resultados[numero] = _erro(numero, 'devolvido', 'O empréstimo já foi devolvido.')
+                continue
+            try:
+                EmprestimoValidate(dados={**emprestimo, 'devolvido': True})
+            except ValidationError as e:
+                resultados[numero] = {'linha': numero, 'status': 'erro', 'erros': e.message_dict}
+                continue
+            devolvidos[pk] = emprestimo
+            resultados[numero] = {'linha': numero, 'status': 'devolvido', 'id': pk}
+
+        if devolvidos:
+            # O devolvido__in no filtro mantém a condição do UPDATE no índice de situação
+            Emprestimo.objects.filter(pk__in=devolvidos, devolvido__in=[False]).update(devolvido=True)
+            # DELETE direto pelo cursor: o .delete() do ORM carregaria cada linha para disparar os sinais da
+            # LivroEmprestado (marcar o livro, invalidar o cache) uma vez por linha; _livros_emprestados_mudaram faz
+            # isso para o lote inteiro logo abaixo
+            _remover_livros_emprestados(list(devolvidos))
+            _somar_por_usuario(_contar(emprestimo['usuario_id'] for emprestimo in devolvidos.values()), -1)
+            _descontar_atrasos(devolvidos.values())
+            _livros_emprestados_mudaram({emprestimo['livro_id'] for emprestimo in devolvidos.values()})
+
+    for numero in range(1, len(ids) + 1):
+        yield resultados[numero]
+
+
+def _data(valor):
+    if isinstance(valor, datetime.date):
+        return valor
+    return datetime.date.fromisoformat(str(valor))
+
+
+def validar_emprestimos(itens, hoje):
+    # Devolve os empréstimos válidos do lote e os resultados dos itens rejeitados
+    resultados = {}
+    candidatos = []
+    itens = list(itens)
+    dicionarios = [item for item in itens if isinstance(item, dict)]
+    # Uma consulta para os livros e outra para os usuários do lote inteiro
+    livro_ids = {_inteiro(item.get('livro')) for item in dicionarios} - {None}
+    usuario_ids = {_inteiro(item.get('usuario')) for item in dicionarios} - {None}
+    livros = set(Livro.objects.filter(pk__in=livro_ids).values_list('id', flat=True)) if livro_ids else set()
+    usuarios = set(User.objects.filter(pk__in=usuario_ids).values_list('id', flat=True)) if usuario_ids else set()
+
+    for numero, item in enumerate(itens, start=1):
+        if not isinstance(item, dict):
+            resultados[numero] = _erro(numero, 'linha', 'Linha inválida.')
+            continue
+        erros = {}
+        prevista = item.get('data_prevista_devolucao')
+        if prevista not in (None, ''):
+            try:
+                prevista = _data(prevista)
+            except ValueError:
+                erros['data_prevista_devolucao'] = ['Formato de data inválido para data prevista de devolução.']
+        else:
+            prevista = None
+        if not erros:
+            try:
+                EmprestimoValidate(dados={'data_inicio': hoje, 'data_prevista_devolucao': prevista})
+            except ValidationError as e:
+                erros.update(e.message_dict)
+        livro_id = _inteiro(item.get('livro'))
+        if livro_id not in livros:
+            erros['livro'] = ['O livro informado não existe.']
+        usuario_id = _inteiro(item.get('usuario'))
+        if usuario_id not in usuarios:
+            erros['usuario'] = ['O usuário informado não existe.']
+        if erros:
+            resultados[numero] = {'linha': numero, 'status': 'erro', 'erros': erros}
+            continue
+        candidatos.append((numero, Emprestimo(livro_id=livro_id, usuario_id=usuario_id, data_prevista_devolucao=prevista)))
+    return candidatos, resultados
+
+
+def _aplicar_limites(candidatos, resultados):
+    # Livros já emprestados (ou repetidos no lote) e o limite de empréstimos abertos de cada usuário
+    livro_ids = {emprestimo.livro_id for _, emprestimo in candidatos}
+    usuario_ids = {emprestimo.usuario_id for _, emprestimo in candidatos}
+    emprestados = set(LivroEmprestado.objects.filter(livro_id__in=livro_ids).values_list('livro_id', flat=True))
+    EmprestimosAbertos.objects.bulk_create([EmprestimosAbertos(usuario_id=pk) for pk in usuario_ids], ignore_conflicts=True)
+    # Trava as linhas dos usuários até o fim da transação, como o UPDATE condicional de EmprestimosAbertos.reservar
+    abertos = dict(
+        EmprestimosAbertos.objects.select_for_update().filter(usuario_id__in=usuario_ids).values_list('usuario_id', 'quantidade')
+    )
+    aceitos = []
+    for numero, emprestimo in candidatos:
+        if emprestimo.livro_id in emprestados:
+            resultados[numero] = _erro(numero, 'livro', 'O livro já está emprestado.')
+            continue
+        if abertos[emprestimo.usuario_id] >= LIMITE_EMPRESTIMOS_ABERTOS:
+            resultados[numero] = _erro(numero, 'usuario', f'O usuário já possui {LIMITE_EMPRESTIMOS_ABERTOS} empréstimos não devolvidos.')
+            continue
+        emprestados.add(emprestimo.livro_id)
+        abertos[emprestimo.usuario_id] += 1
+        aceitos.append((numero, emprestimo))
+    return aceitos
+
+
+def _inserir(aceitos, resultados):
+    try:
+        with transaction.atomic():
+            Emprestimo.objects.bulk_create([emprestimo for _, emprestimo in aceitos])
+            LivroEmprestado.objects.bulk_create(
+                [LivroEmprestado(livro_id=emprestimo.livro_id, emprestimo=emprestimo) for _, emprestimo in aceitos]
+            )
+    except IntegrityError:
+        # Outro processo emprestou um dos livros no meio do caminho: insere um a um
+        for numero, emprestimo in aceitos:
+            emprestimo.pk = None
+            try:
+                with transaction.atomic():
+                    Emprestimo.objects.bulk_create([emprestimo])
+                    LivroEmprestado.objects.bulk_create([LivroEmprestado(livro_id=emprestimo.livro_id, emprestimo=emprestimo)])
+            except IntegrityError:
+                resultados[numero] = _erro(numero, 'livro', 'O livro já está emprestado.')
+    inseridos = []
+    for numero, emprestimo in aceitos:
+        if numero not in resultados:
+            resultados[numero] = {'linha': numero, 'status': 'criado', 'id': emprestimo.pk}
+            inseridos.append(emprestimo)
+    return inseridos
+
+
+def emprestar_em_lote(itens):
+    # Cria os empréstimos de `itens` ({livro, usuario, data_prevista_devolucao}) numa transação e gera o
+    # resultado de cada item na ordem de entrada
+    itens = list(itens)
+    with transaction.atomic():
+        candidatos, resultados = validar_emprestimos(itens, timezone.localdate())
+        aceitos = _aplicar_limites(candidatos, resultados) if candidatos else []
+        inseridos = _inserir(aceitos, resultados) if aceitos else []
+        if inseridos:
+            # bulk_create não passa pelo Emprestimo.save nem dispara os sinais: contadores, agregados,
+            # autocomplete e cache são atualizados aqui. Empréstimos novos ainda não vencidos não entram no resumo de atrasos
+            _somar_por_usuario(_contar(emprestimo.usuario_id for emprestimo in inseridos), 1)
+            deltas = {}
+            for emprestimo in inseridos:
+                for chave in emprestimo.chaves_agregado():
+                    deltas[chave] = deltas.get(chave, 0) + 1
+            AgregadoCatalogo.somar(deltas)
+            transaction.on_commit(partial(
+                autocomplete.indice.emprestimos_em_lote, [(emprestimo.pk, emprestimo.livro_id) for emprestimo in inseridos]
+            ))
+            _livros_emprestados_mudaram({emprestimo.livro_id for emprestimo in inseridos})
+
+    for numero in range(1, len(itens) + 1):
+        yield resultados[numero]
+
+
+def resumir(resultados, status):
+    resultados = list(resultados)
+    feitos = sum(1 for resultado in resultados if resultado['status'] == status)
+    return {f'{status}s': feitos, 'erros': len(resultados) - feitos, 'resultados': resultados}
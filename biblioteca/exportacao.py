@@ -0,0 +1,143 @@
+import csv
+import datetime
+import json
+import zlib
+from biblioteca.filters import CRIADOR_NOME, filtrar_livros_por_parametros
+from biblioteca.models import Livro, Autor, Emprestimo
+
+CHUNK_SIZE = 2000
+TAMANHO_BLOCO = 64 * 1024
+FORMATOS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def _livros(params, usuario=None):
+    qs = Livro.objects.annotate(criador_nome=CRIADOR_NOME)
+    return filtrar_livros_por_parametros(qs, params).order_by('-id')
+
+
+def _autores(params, usuario=None):
+    qs = Autor.objects.order_by('-id')
+    nome = params.get('nome_autor', None)
+    if nome:
+        qs = qs.filter(nome__icontains=nome)
+    return qs
+
+
+def _emprestimos(params, usuario=None):
+    # Como na EmprestimoViewSet: quem não é superusuário só exporta os próprios empréstimos (usuario=None é o
+    # terminal, sem restrição)
+    qs = Emprestimo.objects.order_by('-id')
+    situacao = params.get('devolvido', None)
+    livro = params.get('livro', None)
+    username = params.get('usuario', None)
+    if situacao:
+        qs = qs.filter(devolvido=situacao.lower() == 'true')
+    if livro:
+        qs = qs.filter(livro__titulo__icontains=livro)
+    if usuario is not None and not usuario.is_superuser:
+        return qs.filter(usuario=usuario)
+    if username:
+        qs = qs.filter(usuario__username__icontains=username)
+    return qs
+
+
+# recurso -> (queryset filtrado, colunas do arquivo, campos do values_list)
+RECURSOS = {
+    'livros': (
+        _livros,
+        ['id', 'titulo', 'descricao', 'data_publicacao', 'categoria_id', 'autor_id',
+         'categoria_nome', 'autor_nome', 'criador', 'criador_nome'],
+        ['id', 'titulo', 'descricao', 'data_publicacao', 'categoria_id', 'autor_id',
+         'categoria__nome', 'autor__nome', 'criador_id', 'criador_nome'],
+    ),
+    'autores': (
+        _autores,
+        ['id', 'nome', 'biografia'],
+        ['id', 'nome', 'biografia'],
+    ),
+    'emprestimos': (
+        _emprestimos,
+        ['id', 'livro', 'livro_titulo', 'usuario', 'usuario_username',
+         'data_inicio', 'data_prevista_devolucao', 'devolvido'],
+        ['id', 'livro_id', 'livro__titulo', 'usuario_id', 'usuario__username',
+         'data_inicio', 'data_prevista_devolucao', 'devolvido'],
+    ),
+}
+
+
+class _Eco:
+    # "Arquivo" que só devolve o que foi escrito, para usar o csv.writer sem buffer
+    def write(self, valor):
+        return valor
+
+
+def _valor_json(valor):
+    if isinstance(valor, (datetime.date, datetime.datetime)):
+        return valor.isoformat()
+    return str(valor)
+
+
+def _linhas_csv(colunas, linhas):
+    writer = csv.writer(_Eco())
+    yield writer.writerow(colunas)
+    for linha in linhas:
+        yield writer.writerow(linha)
+
+
+def _linhas_ndjson(colunas, linhas):
+    for linha in linhas:
+        yield json.dumps(dict(zip(colunas, linha)), ensure_ascii=False, default=_valor_json) + '\n'
+
+
+def _em_blocos(partes):
+    # Junta as linhas em blocos de ~64KB para não mandar um pedaço por linha
+    bloco, tamanho = [], 0
+    for parte in partes:
+        bloco.append(parte)
+        tamanho += len(parte)
+        if tamanho >= TAMANHO_BLOCO:
+            yield ''.join(bloco).encode('utf-8')
+            bloco, tamanho = [], 0
+    if bloco:
+        yield ''.join(bloco).encode('utf-8')
+
+
+def _gzip(blocos):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+    for bloco in blocos:
+        comprimido = compressor.compress(bloco)
+        if comprimido:
+            yield comprimido
+    yield compressor.flush()
+
+
+def _contando(linhas, ao_ler, intervalo):
+    numero = 0
+    for numero, linha in enumerate(linhas, start=1):
+        yield linha
+        if numero % intervalo == 0:
+            ao_ler(numero)
+    ao_ler(numero)
+
+
+def contar(recurso, params, usuario=None):
+    return RECURSOS[recurso][0](params, usuario).order_by().count()
+
+
+def exportar(recurso, params, formato='csv', gzip=False, chunk_size=CHUNK_SIZE, ao_ler=None, usuario=None):
+    # Gera o arquivo em bytes; iterator() mantém a memória constante qualquer que seja o tamanho da tabela.
+    # ao_ler(linhas) recebe o número de linhas lidas a cada chunk_size (progresso das tarefas de exportação)
+    montar_queryset, colunas, campos = RECURSOS[recurso]
+    linhas = montar_queryset(params, usuario).values_list(*campos).iterator(chunk_size=chunk_size)
+    if ao_ler is not None:
+        linhas = _contando(linhas, ao_ler, chunk_size)
+    partes = _linhas_csv(colunas, linhas) if formato == 'csv' else _linhas_ndjson(colunas, linhas)
+    blocos = _em_blocos(partes)
+    return _gzip(blocos) if gzip else blocos
+
+
+def nome_arquivo(recurso, formato, gzip=False):
+    return f'{recurso}.{formato}' + ('.gz' if gzip else '')
@@ -0,0 +1,43 @@
+from django.db.models import Exists, F, OuterRef, Subquery, Value
+from django.db.models.functions import Concat
+from biblioteca.models import LivroEmprestado
+from biblioteca.search import filtrar_livros
+
+# "Nome Sobrenome (username)" do usuário que cadastrou o livro
+CRIADOR_NOME = Concat(
+    F('criador__first_name'),
+    Value(' '),
+    F('criador__last_name'),
+    Value(' ('),
+    F('criador__username'),
+    Value(')'))
+
+# Disponibilidade pela LivroEmprestado: uma linha por livro emprestado, com o livro como chave primária,
+# então cada livro da página custa uma busca pela chave
+EMPRESTIMO_ATUAL = LivroEmprestado.objects.filter(livro=OuterRef('pk'))
+DISPONIVEL = ~Exists(EMPRESTIMO_ATUAL)
+DATA_PREVISTA_RETORNO = Subquery(EMPRESTIMO_ATUAL.values('emprestimo__data_prevista_devolucao')[:1])
+
+VALORES_BOOLEANOS = {'true': True, '1': True, 'false': False, '0': False}
+
+
+def filtrar_livros_por_parametros(qs, params):
+    # Filtros da listagem de livros, compartilhados pela API e pela exportação
+    titulo = params.get('titulo', None)
+    categoria = params.get('categoria', None)
+    autor = params.get('autor', None)
+    busca = params.get('q', None)
+    disponivel = VALORES_BOOLEANOS.get(params.get('disponivel', '').lower())
+    if busca:
+        qs = filtrar_livros(qs, busca)
+    if categoria:
+        qs = qs.filter(categoria__nome__icontains=categoria)
+    if autor:
+        qs = qs.filter(autor__nome__icontains=autor)
+    if titulo:
+        qs = qs.filter(titulo__icontains=titulo)
+    if disponivel is not None:
+        # IN (SELECT livro_id ...) lê só a chave primária da LivroEmprestado
+        emprestados = LivroEmprestado.objects.values('livro_id')
+        qs = qs.exclude(pk__in=emprestados) if disponivel else qs.filter(pk__in=emprestados)
+    return qs
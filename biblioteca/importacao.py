@@ -0,0 +1,239 @@
+import csv
+import datetime
+import json
+from functools import partial
+from itertools import islice
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from biblioteca.models import AgregadoCatalogo, Livro, Autor, Categoria, LIMITE_LIVROS_POR_CATEGORIA
+from biblioteca.utils import normalizar_titulo
+from biblioteca.validators import LivroValidate
+from biblioteca import agregados, autocomplete, cache, search
+
+TAMANHO_LOTE = 500
+MAX_LINHAS_REQUISICAO = 5000
+
+
+def ler_csv(arquivo):
+    # DictReader lê uma linha por vez, então o arquivo nunca é carregado inteiro
+    yield from csv.DictReader(arquivo)
+
+
+def ler_ndjson(arquivo):
+    for linha in arquivo:
+        linha = linha.strip()
+        if not linha:
+            continue
+        try:
+            yield json.loads(linha)
+        except ValueError:
+            # Linha malformada vira erro no resultado em vez de interromper a importação
+            yield None
+
+
+def em_lotes(linhas, tamanho):
+    linhas = iter(linhas)
+    while lote := list(islice(linhas, tamanho)):
+        yield lote
+
+
+def _inteiro(valor):
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+def _texto(valor):
+    return None if valor is None else str(valor)
+
+
+def _data(valor):
+    if valor in (None, ''):
+        return None
+    if isinstance(valor, datetime.date):
+        return valor
+    return datetime.date.fromisoformat(str(valor))
+
+
+def _resolver_relacionados(modelo, linhas, campo_id, campo_nome):
+    # Uma consulta por id e outra por nome para o lote inteiro
+    linhas = [linha for linha in linhas if isinstance(linha, dict)]
+    ids = {_inteiro(linha.get(campo_id)) for linha in linhas} - {None}
+    nomes = {linha.get(campo_nome) for linha in linhas if linha.get(campo_nome)}
+    por_id, por_nome = {}, {}
+    if ids:
+        por_id = {obj.pk: obj for obj in modelo.objects.filter(pk__in=ids)}
+    if nomes:
+        for obj in modelo.objects.filter(nome__in=nomes).order_by('-id'):
+            por_nome[obj.nome] = obj
+    return por_id, por_nome
+
+
+def _relacionado(linha, campo_id, campo_nome, por_id, por_nome):
+    # Devolve (objeto, informado); autor e categoria são obrigatórios, como no LivroSerializer
+    if linha.get(campo_id) not in (None, ''):
+        return por_id.get(_inteiro(linha.get(campo_id))), True
+    if linha.get(campo_nome):
+        return por_nome.get(linha.get(campo_nome)), True
+    return None, False
+
+
+def validar_lote(linhas, criador, inicio=1):
+    # Devolve os livros válidos do lote e os resultados das linhas rejeitadas
+    resultados = {}
+    candidatos = []
+
+    max_titulo = Livro._meta.get_field('titulo').max_length
+    autores_por_id, autores_por_nome = _resolver_relacionados(Autor, linhas, 'autor_id', 'autor_nome')
+    categorias_por_id, categorias_por_nome = _resolver_relacionados(Categoria, linhas, 'categoria_id', 'categoria_nome')
+
+    for numero, linha in enumerate(linhas, start=inicio):
+        if not isinstance(linha, dict):
+            resultados[numero] = {'linha': numero, 'status': 'erro', 'erros': {'linha': ['Linha inválida.']}}
+            continue
+
+        erros = {}
+        try:
+            dados = {
+                'titulo': _texto(linha.get('titulo')),
+                'descricao': _texto(linha.get('descricao')),
+                'data_publicacao': _data(linha.get('data_publicacao')),
+            }
+        except ValueError:
+            resultados[numero] = {'linha': numero, 'status': 'erro', 'erros': {'data_publicacao': ['Data de publicação inválida.']}}
+            continue
+
+        if any(dados[campo] in (None, '') for campo in dados):
+            resultados[numero] = {
+                'linha': numero, 'status': 'erro',
+                'erros': {'missing_fields': ['Os campos título, descrição e data de publicação são obrigatórios.']},
+            }
+            continue
+
+        try:
+            LivroValidate(dados=dados)
+        except ValidationError as e:
+            erros.update(e.message_dict)
+        if len(dados['titulo']) > max_titulo:
+            erros.setdefault('titulo', []).append(f'O título deve ter no máximo {max_titulo} caracteres.')
+
+        autor, informado = _relacionado(linha, 'autor_id', 'autor_nome', autores_por_id, autores_por_nome)
+        if autor is None:
+            erros['autor'] = ['O autor informado não existe.' if informado else 'O autor é obrigatório.']
+        categoria, informado = _relacionado(linha, 'categoria_id', 'categoria_nome', categorias_por_id, categorias_por_nome)
+        if categoria is None:
+            erros['categoria'] = ['A categoria informada não existe.' if informado else 'A categoria é obrigatória.']
+        if erros:
+            resultados[numero] = {'linha': numero, 'status': 'erro', 'erros': erros}
+            continue
+
+        livro = Livro(
+            titulo=dados['titulo'],
+            titulo_normalizado=normalizar_titulo(dados['titulo']),
+            descricao=dados['descricao'],
+            data_publicacao=dados['data_publicacao'],
+            autor=autor,
+            categoria=categoria,
+            criador=criador,
+        )
+        candidatos.append((numero, livro))
+
+    # Títulos repetidos no próprio lote ou já cadastrados: uma consulta pelo índice único
+    titulos = {livro.titulo_normalizado for _, livro in candidatos}
+    existentes = set(Livro.objects.filter(titulo_normalizado__in=titulos).values_list('titulo_normalizado', flat=True))
+    validos = []
+    for numero, livro in candidatos:
+        if livro.titulo_normalizado in existentes:
+            resultados[numero] = {'linha': numero, 'status': 'erro', 'erros': {'titulo': ['O titulo já está em uso!']}}
+            continue
+        existentes.add(livro.titulo_normalizado)
+        validos.append((numero, livro))
+
+    return validos, resultados
+
+
+def _erro_limite(numero):
+    return {
+        'linha': numero, 'status': 'erro',
+        'erros': {'categoria': [f'A categoria não pode ter mais de {LIMITE_LIVROS_POR_CATEGORIA} livros.']},
+    }
+
+
+def _aplicar_limite_categorias(validos, resultados):
+    # Lê o contador livros_count de todas as categorias do lote em uma consulta
+    ids = {livro.categoria_id for _, livro in validos if livro.categoria_id}
+    totais = dict(Categoria.objects.filter(pk__in=ids).values_list('pk', 'livros_count')) if ids else {}
+    aceitos = []
+    reservas = {}
+    for numero, livro in validos:
+        if livro.categoria_id:
+            if totais[livro.categoria_id] >= LIMITE_LIVROS_POR_CATEGORIA:
+                resultados[numero] = _erro_limite(numero)
+                continue
+            totais[livro.categoria_id] += 1
+            reservas[livro.categoria_id] = reservas.get(livro.categoria_id, 0) + 1
+        aceitos.append((numero, livro))
+
+    # Reserva as vagas com um UPDATE condicional por categoria; se outra escrita ocupou as vagas, rejeita
+    recusadas = {cid for cid, quantidade in reservas.items() if not Categoria.reservar_vagas(cid, quantidade)}
+    if recusadas:
+        for numero, livro in aceitos:
+            if livro.categoria_id in recusadas:
+                resultados[numero] = _erro_limite(numero)
+        aceitos = [(numero, livro) for numero, livro in aceitos if livro.categoria_id not in recusadas]
+    return aceitos
+
+
+def _inserir(aceitos, resultados):
+    try:
+        with transaction.atomic():
+            Livro.objects.bulk_create([livro for _, livro in aceitos])
+    except IntegrityError:
+        # Outro processo cadastrou um dos títulos no meio do caminho: insere um a um
+        for numero, livro in aceitos:
+            livro.pk = None
+            try:
+                with transaction.atomic():
+                    Livro.objects.bulk_create([livro])
+            except IntegrityError:
+                resultados[numero] = {'linha': numero, 'status': 'erro', 'erros': {'titulo': ['O titulo já está em uso!']}}
+    nao_inseridos = {}
+    for numero, livro in aceitos:
+        if numero not in resultados:
+            resultados[numero] = {'linha': numero, 'status': 'criado', 'id': livro.pk}
+        elif livro.categoria_id:
+            nao_inseridos[livro.categoria_id] = nao_inseridos.get(livro.categoria_id, 0) + 1
+    # Devolve as vagas reservadas para os livros que não foram inseridos
+    for categoria_id, quantidade in nao_inseridos.items():
+        Categoria.liberar_vagas(categoria_id, quantidade)
+    return [livro.pk for numero, livro in aceitos if resultados[numero]['status'] == 'criado']
+
+
+def importar_livros(linhas, criador, tamanho_lote=TAMANHO_LOTE):
+    # Gera o resultado de cada linha na ordem de entrada; cada lote roda em uma transação
+    inicio = 1
+    for lote in em_lotes(linhas, tamanho_lote):
+        with transaction.atomic():
+            validos, resultados = validar_lote(lote, criador, inicio=inicio)
+            aceitos = _aplicar_limite_categorias(validos, resultados)
+            criados = _inserir(aceitos, resultados) if aceitos else []
+            if criados:
+                # bulk_create não dispara sinais nem passa pelo save: atualiza a busca, os agregados, o autocomplete e o cache manualmente
+                search.indexar_livros(criados)
+                inseridos = [livro for numero, livro in aceitos if resultados[numero]['status'] == 'criado']
+                AgregadoCatalogo.somar(agregados.deltas_livros(inseridos))
+                transaction.on_commit(partial(
+                    autocomplete.indice.livros_salvos, [(livro.pk, livro.titulo, livro.autor_id) for livro in inseridos]
+                ))
+                cache.incrementar_versao(Livro)
+                transaction.on_commit(lambda: cache.incrementar_versao(Livro))
+        for numero in range(inicio, inicio + len(lote)):
+            yield resultados[numero]
+        inicio += len(lote)
+
+
+def resumir(resultados):
+    resultados = list(resultados)
+    criados = sum(1 for resultado in resultados if resultado['status'] == 'criado')
+    return {'criados': criados, 'erros': len(resultados) - criados, 'resultados': resultados}
@@ -0,0 +1,82 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from biblioteca import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Popula um banco de teste com dados gerados, mede cada ação das ViewSets '
+        '(latência p50/p95/p99, queries por requisição e pico de memória) e falha se algum orçamento for estourado.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--escala', choices=list(benchmark.ESCALAS), default='10k')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--repeticoes', type=int, default=30)
+        parser.add_argument('--saida', help='arquivo JSON com os resultados')
+        parser.add_argument('--comparar', help='arquivo JSON de uma execução anterior')
+        parser.add_argument('--orcamentos', help='arquivo JSON com os orçamentos por endpoint')
+        parser.add_argument('--endpoint', help='mede só os endpoints que contêm este texto')
+        parser.add_argument('--carga', action='store_true', help='compara as listagens síncronas (WSGI) com as assíncronas (ASGI) sob carga')
+        parser.add_argument('--concorrencia', type=int, default=32)
+        parser.add_argument('--requisicoes', type=int, default=400)
+        parser.add_argument('--com-cache', action='store_true', help='não limpa o cache de respostas entre as requisições')
+
+    def handle(self, *args, **options):
+        orcamentos = None
+        if options['orcamentos']:
+            with open(options['orcamentos'], encoding='utf-8') as arquivo:
+                orcamentos = json.load(arquivo)
+
+        # Sempre num banco de teste novo: nada é escrito no banco de desenvolvimento
+        setup_test_environment()
+        bancos = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.stdout.write(f"Populando a escala {options['escala']} (seed {options['seed']})...")
+            admin = benchmark.semear(options['escala'], seed=options['seed'])
+            with benchmark.sem_limites():
+                resultados = benchmark.medir(
+                    admin, repeticoes=options['repeticoes'], seed=options['seed'],
+                    com_cache=options['com_cache'], filtro=options['endpoint'],
+                )
+                carga = None
+                if options['carga']:
+                    carga = benchmark.comparar_carga(options['requisicoes'], options['concorrencia'])
+            throttle = benchmark.medir_throttle()
+        finally:
+            teardown_databases(bancos, verbosity=0)
+            teardown_test_environment()
+
+        violacoes = benchmark.verificar_orcamentos(resultados, orcamentos)
+        dados = benchmark.relatorio(options['escala'], options['seed'], options['repeticoes'], resultados, violacoes, carga, throttle)
+
+        for nome, medicao in resultados.items():
+            self.stdout.write(
+                f"{nome:30} p50 {medicao['p50_ms']:8.2f}ms  p95 {medicao['p95_ms']:8.2f}ms  "
+                f"p99 {medicao['p99_ms']:8.2f}ms  queries {medicao['queries']:4}  "
+                f"memória {medicao['pico_memoria_kb']:9.1f}KB"
+            )
+        if carga:
+            for modo in ('wsgi', 'asgi'):
+                medicao = carga[modo]
+                self.stdout.write(
+                    f"carga {modo} (concorrência {carga['concorrencia']}): {medicao['requisicoes_por_segundo']} req/s  "
+                    f"p50 {medicao['p50_ms']}ms  p95 {medicao['p95_ms']}ms  threads {medicao['threads_pico']}"
+                )
+        self.stdout.write(
+            f"throttle ({throttle['cache']}): média {throttle['media_us']}µs  p50 {throttle['p50_us']}µs  "
+            f"p99 {throttle['p99_us']}µs por requisição"
+        )
+        if options['comparar']:
+            with open(options['comparar'], encoding='utf-8') as arquivo:
+                anterior = json.load(arquivo)
+            for linha in benchmark.comparar(dados, anterior):
+                self.stdout.write(linha)
+        if options['saida']:
+            benchmark.salvar(options['saida'], dados)
+            self.stdout.write(f"Resultados salvos em {options['saida']}")
+
+        if violacoes:
+            raise CommandError('Orçamentos estourados:\n' + '\n'.join(violacoes))
+        self.stdout.write(self.style.SUCCESS('Todos os endpoints dentro do orçamento.'))
@@ -0,0 +1,35 @@
+import sys
+from django.core.management.base import BaseCommand
+from biblioteca import exportacao
+
+
+class Command(BaseCommand):
+    help = 'Exporta livros, autores ou empréstimos em CSV ou NDJSON, em fluxo, sem carregar a tabela na memória.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('recurso', choices=sorted(exportacao.RECURSOS))
+        parser.add_argument('--formato', choices=sorted(exportacao.FORMATOS), default='csv')
+        parser.add_argument('--saida', help='arquivo de saída (padrão: stdout)')
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--chunk-size', type=int, default=exportacao.CHUNK_SIZE)
+        # Mesmos filtros das listagens da API
+        for filtro in ('titulo', 'categoria', 'autor', 'q', 'nome_autor', 'livro', 'usuario', 'devolvido'):
+            parser.add_argument(f'--{filtro}')
+
+    def handle(self, *args, **options):
+        params = {
+            filtro: options[filtro]
+            for filtro in ('titulo', 'categoria', 'autor', 'q', 'nome_autor', 'livro', 'usuario', 'devolvido')
+            if options[filtro]
+        }
+        blocos = exportacao.exportar(
+            options['recurso'], params, formato=options['formato'], gzip=options['gzip'], chunk_size=options['chunk_size']
+        )
+        if options['saida']:
+            with open(options['saida'], 'wb') as arquivo:
+                for bloco in blocos:
+                    arquivo.write(bloco)
+        else:
+            for bloco in blocos:
+                sys.stdout.buffer.write(bloco)
+            sys.stdout.buffer.flush()
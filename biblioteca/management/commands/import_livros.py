@@ -0,0 +1,37 @@
+import json
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from biblioteca.importacao import importar_livros, ler_csv, ler_ndjson, TAMANHO_LOTE
+
+
+class Command(BaseCommand):
+    help = 'Importa livros de um arquivo CSV ou NDJSON, em lotes, informando o resultado de cada linha.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('arquivo')
+        parser.add_argument('--formato', choices=['csv', 'ndjson'], default=None)
+        parser.add_argument('--criador', required=True, help='username do usuário que ficará como criador dos livros')
+        parser.add_argument('--lote', type=int, default=TAMANHO_LOTE)
+        parser.add_argument('--mostrar-criados', action='store_true', help='também imprime as linhas importadas')
+
+    def handle(self, *args, **options):
+        try:
+            criador = User.objects.get(username=options['criador'])
+        except User.DoesNotExist:
+            raise CommandError(f"Usuário '{options['criador']}' não encontrado.")
+
+        formato = options['formato'] or ('csv' if options['arquivo'].endswith('.csv') else 'ndjson')
+        leitor = ler_csv if formato == 'csv' else ler_ndjson
+
+        criados = erros = 0
+        with open(options['arquivo'], encoding='utf-8', newline='') as arquivo:
+            for resultado in importar_livros(leitor(arquivo), criador=criador, tamanho_lote=options['lote']):
+                if resultado['status'] == 'criado':
+                    criados += 1
+                    if not options['mostrar_criados']:
+                        continue
+                else:
+                    erros += 1
+                self.stdout.write(json.dumps(resultado, ensure_ascii=False))
+
+        self.stdout.write(self.style.SUCCESS(f'{criados} livros importados, {erros} linhas com erro.'))
@@ -0,0 +1,33 @@
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from biblioteca.models import Categoria, Livro
+
+
+class Command(BaseCommand):
+    help = 'Confere o contador livros_count das categorias com a contagem real e corrige as divergências.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='apenas lista as divergências')
+
+    def handle(self, *args, **options):
+        totais = Livro.objects.filter(categoria=OuterRef('pk')).order_by().values('categoria').annotate(
+            total=Count('pk')
+        ).values('total')
+        real = Coalesce(Subquery(totais), Value(0))
+
+        with transaction.atomic():
+            divergentes = list(
+                Categoria.objects.annotate(real=real).exclude(livros_count=real).values_list('pk', 'nome', 'livros_count', 'real')
+            )
+            for pk, nome, contador, total in divergentes:
+                self.stdout.write(f'{nome} (id {pk}): livros_count={contador}, real={total}')
+            if divergentes and not options['dry_run']:
+                Categoria.objects.filter(pk__in=[pk for pk, *_ in divergentes]).update(
+                    livros_count=real, updated_at=timezone.now()
+                )
+
+        acao = 'encontradas' if options['dry_run'] else 'corrigidas'
+        self.stdout.write(self.style.SUCCESS(f'{len(divergentes)} categorias {acao}.'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from biblioteca import agregados
+
+
+class Command(BaseCommand):
+    help = 'Confere os agregados de /api/estatisticas/ com contagens feitas do zero e reconstrói se houver divergências.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='apenas lista as divergências')
+
+    def handle(self, *args, **options):
+        divergentes = agregados.divergencias()
+        for tipo, chave, atual, esperado in divergentes:
+            self.stdout.write(f'{tipo} {chave}: agregado={atual}, real={esperado}')
+        if divergentes and not options['dry_run']:
+            agregados.reconstruir()
+
+        acao = 'encontradas' if options['dry_run'] else 'corrigidas'
+        self.stdout.write(self.style.SUCCESS(f'{len(divergentes)} divergências {acao}.'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from biblioteca import atrasos
+
+
+class Command(BaseCommand):
+    help = 'Confere o resumo de empréstimos atrasados com um GROUP BY feito do zero e reconstrói se houver divergências.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='apenas lista as divergências')
+
+    def handle(self, *args, **options):
+        divergentes = atrasos.divergencias()
+        for dimensao, chave, atual, esperado in divergentes:
+            self.stdout.write(f'{dimensao} {chave}: resumo={atual}, real={esperado}')
+        if divergentes and not options['dry_run']:
+            atrasos.reconstruir()
+
+        acao = 'encontradas' if options['dry_run'] else 'corrigidas'
+        self.stdout.write(self.style.SUCCESS(f'{len(divergentes)} divergências {acao}.'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from biblioteca import search
+
+
+class Command(BaseCommand):
+    help = 'Reconstrói o índice de busca textual (FTS5) do catálogo de livros.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        if not search.busca_disponivel(options['database']):
+            self.stdout.write(self.style.WARNING('A busca textual só está disponível no SQLite.'))
+            return
+        total = search.reconstruir_indice(using=options['database'])
+        self.stdout.write(self.style.SUCCESS(f'{total} livros indexados.'))
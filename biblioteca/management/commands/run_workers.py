@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+from django.core.management.base import BaseCommand
+from django.db import connections
+from biblioteca import tarefas
+
+
+def _processo(worker, saida, intervalo, visibilidade, uma_vez):
+    # Processo filho (fork): conexões próprias e parada limpa no SIGTERM, depois da tarefa em andamento. Escreve
+    # no stdout do comando herdado do pai, com flush a cada linha para não misturar os buffers dos processos
+    parar = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: parar.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def ao_executar(tarefa):
+        saida.write(_linha(tarefa))
+        saida.flush()
+
+    tarefas.trabalhar(worker, parar, intervalo, visibilidade, ao_executar=ao_executar, uma_vez=uma_vez)
+
+
+def _linha(tarefa):
+    return f'Tarefa {tarefa.pk} ({tarefa.tipo}): {tarefa.estado}'
+
+
+class Command(BaseCommand):
+    help = 'Executa as tarefas da fila (exportações, importações, reconstruções e exclusões) num pool de threads ou processos.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--modo', choices=['thread', 'processo'], default='thread')
+        parser.add_argument('--intervalo', type=float, default=1.0, help='segundos entre consultas com a fila vazia')
+        parser.add_argument('--visibilidade', type=int, default=None, help='segundos de reserva de cada tarefa (padrão: BIBLIOTECA_TAREFAS_VISIBILIDADE)')
+        parser.add_argument('--uma-vez', action='store_true', help='sai quando a fila esvaziar')
+
+    def handle(self, *args, **options):
+        nome = f'{socket.gethostname()}:{os.getpid()}'
+        argumentos = (options['intervalo'], options['visibilidade'] or tarefas.configuracao('VISIBILIDADE'), options['uma_vez'])
+        self.stdout.write(f'{options["workers"]} workers ({options["modo"]}) em {nome}')
+        if options['modo'] == 'processo':
+            self.em_processos(nome, options['workers'], argumentos)
+        else:
+            self.em_threads(nome, options['workers'], argumentos)
+        self.stdout.write(self.style.SUCCESS('Workers encerrados.'))
+
+    def em_threads(self, nome, quantidade, argumentos):
+        intervalo, visibilidade, uma_vez = argumentos
+        parar = threading.Event()
+        lock = threading.Lock()
+
+        def ao_executar(tarefa):
+            with lock:
+                self.stdout.write(_linha(tarefa))
+
+        threads = [
+            threading.Thread(target=tarefas.trabalhar, args=(f'{nome}:{i}', parar, intervalo, visibilidade, ao_executar, uma_vez))
+            for i in range(quantidade)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            # join com timeout para o Ctrl+C chegar à thread principal
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            self.stdout.write('Parando depois das tarefas em andamento...')
+            parar.set()
+            for thread in threads:
+                thread.join()
+
+    def em_processos(self, nome, quantidade, argumentos):
+        # fork: os filhos herdam o Django já configurado; as conexões abertas não podem ir junto
+        connections.close_all()
+        self.stdout.flush()
+        contexto = multiprocessing.get_context('fork')
+        processos = [
+            contexto.Process(target=_processo, args=(f'{nome}:{i}', self.stdout, *argumentos)) for i in range(quantidade)
+        ]
+        for processo in processos:
+            processo.start()
+        anterior = signal.signal(signal.SIGTERM, lambda *args: [processo.terminate() for processo in processos])
+        try:
+            for processo in processos:
+                processo.join()
+        except KeyboardInterrupt:
+            self.stdout.write('Parando depois das tarefas em andamento...')
+            for processo in processos:
+                processo.terminate()
+            for processo in processos:
+                processo.join()
+        finally:
+            signal.signal(signal.SIGTERM, anterior)
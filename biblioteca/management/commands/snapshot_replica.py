@@ -0,0 +1,47 @@
+import sqlite3
+import time
+from contextlib import closing
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from biblioteca import cache
+from biblioteca.models import Autor, Categoria, Livro
+from biblioteca.routers import ALIAS_PRINCIPAL, ALIAS_REPLICA
+
+
+class Command(BaseCommand):
+    help = 'Copia o banco principal para a réplica de leitura com o backup online do SQLite, sem parar as escritas.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--destino', help='arquivo da réplica (padrão: o NAME do banco "replica")')
+        parser.add_argument('--intervalo', type=float, help='repete a cópia a cada N segundos')
+
+    def handle(self, *args, **options):
+        destino = options['destino'] or settings.DATABASES.get(ALIAS_REPLICA, {}).get('NAME')
+        if not destino:
+            raise CommandError('Defina BIBLIOTECA_DB_REPLICA ou informe --destino.')
+        if connections[ALIAS_PRINCIPAL].vendor != 'sqlite':
+            raise CommandError('O snapshot da réplica só funciona com o SQLite.')
+
+        while True:
+            inicio = time.perf_counter()
+            self.copiar(destino)
+            self.stdout.write(self.style.SUCCESS(
+                f'Réplica {destino} atualizada em {(time.perf_counter() - inicio) * 1000:.0f}ms.'
+            ))
+            if not options['intervalo']:
+                break
+            time.sleep(options['intervalo'])
+
+    def copiar(self, destino):
+        espera = getattr(settings, 'SQLITE_PRAGMAS', {}).get('busy_timeout', 5000) / 1000
+        # Conexão própria: a réplica recebe só o que já foi confirmado, nunca uma transação em andamento
+        origem = connections[ALIAS_PRINCIPAL].settings_dict['NAME']
+        with closing(sqlite3.connect(origem, timeout=espera)) as principal, closing(sqlite3.connect(destino, timeout=espera)) as replica:
+            # Tudo num passo só: no WAL a leitura do principal não bloqueia os escritores, e uma cópia
+            # em vários passos recomeçaria do zero a cada escrita feita no meio dela
+            principal.backup(replica)
+        # Respostas em cache montadas com a réplica atrasada deixam de valer
+        for modelo in (Livro, Autor, Categoria, User):
+            cache.incrementar_versao(modelo)
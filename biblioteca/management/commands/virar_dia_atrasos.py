@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from biblioteca import atrasos
+
+
+class Command(BaseCommand):
+    help = 'Atualiza o resumo de empréstimos atrasados para a data de hoje (rodar uma vez por dia).'
+
+    def handle(self, *args, **options):
+        data = atrasos.virar_dia()
+        self.stdout.write(self.style.SUCCESS(f'Resumo de atrasos atualizado até {data:%d/%m/%Y}.'))
@@ -0,0 +1,195 @@
+import bisect
+import hmac
+import threading
+import time
+from contextlib import ExitStack
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+# Métricas por processo: com vários workers, cada processo expõe as suas e o Prometheus soma
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_QUERIES = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+BUCKETS_TAMANHO = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histograma:
+    def __init__(self, nome, ajuda, buckets):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.buckets = buckets
+        self.series = {}
+
+    def observar(self, rotulos, valor):
+        serie = self.series.get(rotulos)
+        if serie is None:
+            # [contagem por bucket..., +Inf], soma
+            serie = self.series[rotulos] = [[0] * (len(self.buckets) + 1), 0.0]
+        serie[0][bisect.bisect_left(self.buckets, valor)] += 1
+        serie[1] += valor
+
+    def exportar(self, nomes_rotulos):
+        linhas = [f'# HELP {self.nome} {self.ajuda}', f'# TYPE {self.nome} histogram']
+        for rotulos, (contagens, soma) in sorted(self.series.items()):
+            base = _rotulos(nomes_rotulos, rotulos)
+            acumulado = 0
+            for limite, quantidade in zip(self.buckets + ('+Inf',), contagens):
+                acumulado += quantidade
+                linhas.append(f'{self.nome}_bucket{{{base},le="{limite}"}} {acumulado}')
+            linhas.append(f'{self.nome}_sum{{{base}}} {soma}')
+            linhas.append(f'{self.nome}_count{{{base}}} {acumulado}')
+        return linhas
+
+
+class Contador:
+    def __init__(self, nome, ajuda):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.series = {}
+
+    def incrementar(self, rotulos, valor=1):
+        self.series[rotulos] = self.series.get(rotulos, 0) + valor
+
+    def exportar(self, nomes_rotulos):
+        linhas = [f'# HELP {self.nome} {self.ajuda}', f'# TYPE {self.nome} counter']
+        for rotulos, valor in sorted(self.series.items()):
+            linhas.append(f'{self.nome}{{{_rotulos(nomes_rotulos, rotulos)}}} {valor}')
+        return linhas
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _rotulos(nomes, valores):
+    return ','.join(f'{nome}="{_escapar(valor)}"' for nome, valor in zip(nomes, valores))
+
+
+class Registro:
+    ROTULOS_ROTA = ('rota', 'metodo')
+    ROTULOS_REQUISICAO = ('rota', 'metodo', 'status')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requisicoes = Contador('biblioteca_http_requests_total', 'Requisições atendidas por rota, método e status.')
+        self.latencia = Histograma('biblioteca_http_request_duration_seconds', 'Latência das requisições.', BUCKETS_LATENCIA)
+        self.tamanho = Histograma('biblioteca_http_response_size_bytes', 'Tamanho das respostas.', BUCKETS_TAMANHO)
+        self.queries = Histograma('biblioteca_db_queries_per_request', 'Consultas SQL por requisição.', BUCKETS_QUERIES)
+        self.tempo_sql = Contador('biblioteca_db_query_duration_seconds_total', 'Tempo total gasto em SQL.')
+        self.total_queries = Contador('biblioteca_db_queries_total', 'Consultas SQL executadas.')
+
+    def registrar(self, rota, metodo, status, duracao, tamanho, queries, tempo_sql):
+        rotulos = (rota, metodo)
+        # Um único lock curto por requisição; nada é feito de I/O dentro dele
+        with self.lock:
+            self.requisicoes.incrementar((rota, metodo, str(status)))
+            self.latencia.observar(rotulos, duracao)
+            if tamanho is not None:
+                self.tamanho.observar(rotulos, tamanho)
+            self.queries.observar(rotulos, queries)
+            self.total_queries.incrementar(rotulos, queries)
+            self.tempo_sql.incrementar(rotulos, tempo_sql)
+
+    def exportar(self):
+        with self.lock:
+            linhas = self.requisicoes.exportar(self.ROTULOS_REQUISICAO)
+            for metrica in (self.latencia, self.tamanho, self.queries):
+                linhas += metrica.exportar(self.ROTULOS_ROTA)
+            for metrica in (self.total_queries, self.tempo_sql):
+                linhas += metrica.exportar(self.ROTULOS_ROTA)
+        return '\n'.join(linhas) + '\n'
+
+
+registro = Registro()
+
+
+class ContadorQueries:
+    # execute_wrapper: conta as consultas e o tempo gasto no banco durante a requisição
+    def __init__(self):
+        self.quantidade = 0
+        self.tempo = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        inicio = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.tempo += time.perf_counter() - inicio
+            self.quantidade += 1
+
+
+def nome_da_rota(request):
+    # Ex.: api-livros-list, api-emprestimos-create (basename do router + ação da ViewSet)
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'nao_encontrada'
+    acoes = getattr(match.func, 'actions', None)
+    basename = getattr(match.func, 'initkwargs', {}).get('basename')
+    if acoes and basename:
+        acao = acoes.get(request.method.lower())
+        if acao:
+            return f'{basename}-{acao}'
+    return match.url_name or match.route
+
+
+class MetricsMiddleware:
+    # Atende os dois modos: um middleware só síncrono faria o Django rodar as views assíncronas numa thread
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        contador = ContadorQueries()
+        inicio = time.perf_counter()
+        with self.contar_queries(contador):
+            response = self.get_response(request)
+        self.registrar(request, response, time.perf_counter() - inicio, contador)
+        return response
+
+    async def __acall__(self, request):
+        # As conexões são por thread: o wrapper vai para a thread do ORM assíncrono (sync_to_async
+        # thread_sensitive, a mesma durante toda a requisição), não para a do event loop
+        contador = ContadorQueries()
+        inicio = time.perf_counter()
+        stack = await sync_to_async(self.contar_queries)(contador)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        self.registrar(request, response, time.perf_counter() - inicio, contador)
+        return response
+
+    def contar_queries(self, contador):
+        stack = ExitStack()
+        for conexao in connections.all():
+            stack.enter_context(conexao.execute_wrapper(contador))
+        return stack
+
+    def registrar(self, request, response, duracao, contador):
+        tamanho = None if response.streaming else len(response.content)
+        registro.registrar(
+            nome_da_rota(request), request.method, response.status_code,
+            duracao, tamanho, contador.quantidade, contador.tempo,
+        )
+
+
+def acesso_permitido(request):
+    # Só o coletor lê as métricas: pelo token (Authorization: Bearer) ou por um IP da lista. Sem nenhum dos dois
+    # configurado, o endpoint fica fechado
+    token = getattr(settings, 'BIBLIOTECA_METRICS_TOKEN', None)
+    if token and hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return True
+    return request.META.get('REMOTE_ADDR') in getattr(settings, 'BIBLIOTECA_METRICS_IPS', ())
+
+
+def metrics_view(request):
+    if not acesso_permitido(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registro.exportar(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,48 @@
+# Generated by Django 5.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+def preencher_titulo_normalizado(apps, schema_editor):
+    # Mantém a lógica igual a biblioteca.utils.normalizar_titulo
+    Livro = apps.get_model('biblioteca', 'Livro')
+    vistos = set()
+    livros = []
+    for livro in Livro.objects.only('id', 'titulo').order_by('id').iterator(chunk_size=2000):
+        normalizado = ' '.join(livro.titulo.split()).casefold()
+        # Títulos que já estavam duplicados recebem o id para não quebrar a constraint
+        if normalizado in vistos:
+            normalizado = f'{normalizado[:80]}#{livro.pk}'
+        vistos.add(normalizado)
+        livro.titulo_normalizado = normalizado
+        livros.append(livro)
+        if len(livros) >= 2000:
+            Livro.objects.bulk_update(livros, ['titulo_normalizado'])
+            livros = []
+    if livros:
+        Livro.objects.bulk_update(livros, ['titulo_normalizado'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0003_alter_livro_criador'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='livro',
+            name='titulo_normalizado',
+            field=models.CharField(editable=False, max_length=100, null=True),
+        ),
+        migrations.RunPython(preencher_titulo_normalizado, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='livro',
+            name='titulo_normalizado',
+            field=models.CharField(editable=False, max_length=100),
+        ),
+        migrations.AddConstraint(
+            model_name='livro',
+            constraint=models.UniqueConstraint(fields=('titulo_normalizado',), name='livro_titulo_normalizado_unico', violation_error_message='O titulo já está em uso!'),
+        ),
+    ]
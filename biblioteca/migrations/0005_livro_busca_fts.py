@@ -0,0 +1,47 @@
+# Generated by Django 5.1 on 2026-10-18 12:10
+
+from django.db import migrations
+
+# Índice de busca textual (FTS5) do catálogo. O rowid é o id do livro e a
+# sincronização é feita pelos sinais em biblioteca.signals.
+CRIAR_BUSCA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS biblioteca_livro_busca USING fts5(
+        titulo, descricao, autor_nome, categoria_nome,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    # Pesos do bm25 por coluna: título > autor > categoria > descrição
+    "INSERT INTO biblioteca_livro_busca(biblioteca_livro_busca, rank) VALUES('rank', 'bm25(10.0, 1.0, 5.0, 3.0)')",
+    """
+    INSERT INTO biblioteca_livro_busca(rowid, titulo, descricao, autor_nome, categoria_nome)
+    SELECT l.id, l.titulo, COALESCE(l.descricao, ''), COALESCE(a.nome, ''), COALESCE(c.nome, '')
+    FROM biblioteca_livro l
+    LEFT JOIN biblioteca_autor a ON a.id = l.autor_id
+    LEFT JOIN biblioteca_categoria c ON c.id = l.categoria_id
+    """,
+]
+
+
+def criar_busca(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in CRIAR_BUSCA:
+        schema_editor.execute(sql)
+
+
+def remover_busca(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS biblioteca_livro_busca')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0004_livro_titulo_normalizado'),
+    ]
+
+    operations = [
+        migrations.RunPython(criar_busca, remover_busca),
+    ]
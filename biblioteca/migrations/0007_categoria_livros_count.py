@@ -0,0 +1,28 @@
+# Generated by Django 5.1 on 2026-10-18 19:18
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def preencher_livros_count(apps, schema_editor):
+    Categoria = apps.get_model('biblioteca', 'Categoria')
+    Livro = apps.get_model('biblioteca', 'Livro')
+    totais = Livro.objects.filter(categoria=OuterRef('pk')).order_by().values('categoria').annotate(total=Count('pk')).values('total')
+    Categoria.objects.update(livros_count=Coalesce(Subquery(totais), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0006_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='categoria',
+            name='livros_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(preencher_livros_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.1 on 2026-10-18 19:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def preencher_emprestimos_abertos(apps, schema_editor):
+    Emprestimo = apps.get_model('biblioteca', 'Emprestimo')
+    EmprestimosAbertos = apps.get_model('biblioteca', 'EmprestimosAbertos')
+    LivroEmprestado = apps.get_model('biblioteca', 'LivroEmprestado')
+
+    abertos = Emprestimo.objects.filter(devolvido=False)
+    EmprestimosAbertos.objects.bulk_create(
+        EmprestimosAbertos(usuario_id=usuario_id, quantidade=total)
+        for usuario_id, total in abertos.order_by().values('usuario_id').annotate(total=Count('pk')).values_list('usuario_id', 'total')
+    )
+    # Se um livro já estiver em mais de um empréstimo aberto, fica registrado o mais recente
+    livros = {}
+    for emprestimo_id, livro_id in abertos.order_by('id').values_list('id', 'livro_id').iterator():
+        livros[livro_id] = emprestimo_id
+    LivroEmprestado.objects.bulk_create(
+        (LivroEmprestado(livro_id=livro_id, emprestimo_id=emprestimo_id) for livro_id, emprestimo_id in livros.items()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('biblioteca', '0007_categoria_livros_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmprestimosAbertos',
+            fields=[
+                ('usuario', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='emprestimos_abertos', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('quantidade', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LivroEmprestado',
+            fields=[
+                ('livro', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='emprestimo_atual', serialize=False, to='biblioteca.livro')),
+                ('emprestimo', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='biblioteca.emprestimo')),
+            ],
+        ),
+        migrations.RunPython(preencher_emprestimos_abertos, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1 on 2026-10-18 19:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0008_emprestimos_abertos'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='autor',
+            index=models.Index(fields=['nome', 'updated_at'], name='autor_nome_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emprestimo',
+            index=models.Index(fields=['usuario', 'devolvido'], name='emprestimo_usuario_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emprestimo',
+            index=models.Index(fields=['devolvido', 'data_prevista_devolucao'], name='emprestimo_situacao_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='livro',
+            index=models.Index(fields=['titulo', 'updated_at', 'categoria', 'autor', 'criador'], name='livro_listagem_cobre_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1 on 2026-10-18 19:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0009_indices_consultas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferenciaAtrasos',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.DateField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ResumoAtraso',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimensao', models.CharField(choices=[('usuario', 'Usuário'), ('livro', 'Livro'), ('categoria', 'Categoria')], max_length=10)),
+                ('chave', models.BigIntegerField()),
+                ('quantidade', models.IntegerField(default=0)),
+                ('dias', models.IntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('dimensao', 'chave'), name='resumo_atraso_unico')],
+            },
+        ),
+    ]
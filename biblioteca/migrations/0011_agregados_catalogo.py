@@ -0,0 +1,56 @@
+# Generated by Django 5.1 on 2026-10-18 20:01
+
+from django.db import migrations, models
+from django.db.models import Count, F
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.utils import timezone
+
+
+def preencher_agregados(apps, schema_editor):
+    Livro = apps.get_model('biblioteca', 'Livro')
+    Emprestimo = apps.get_model('biblioteca', 'Emprestimo')
+    AgregadoCatalogo = apps.get_model('biblioteca', 'AgregadoCatalogo')
+
+    livros = Livro.objects.order_by()
+    emprestimos = Emprestimo.objects.order_by()
+    totais = {('livros', 0): livros.count(), ('emprestimos', 0): emprestimos.count()}
+    for tipo, expressao, queryset in (
+        ('categoria', F('categoria_id'), livros),
+        ('autor', F('autor_id'), livros),
+        ('ano', ExtractYear('data_publicacao'), livros),
+        ('mes', ExtractYear('data_inicio') * 100 + ExtractMonth('data_inicio'), emprestimos),
+        ('livro', F('livro_id'), emprestimos),
+    ):
+        for linha in queryset.annotate(chave_agregado=expressao).values('chave_agregado').annotate(total=Count('pk')):
+            totais[(tipo, linha['chave_agregado'] or 0)] = linha['total']
+
+    agora = timezone.now()
+    AgregadoCatalogo.objects.bulk_create(
+        (AgregadoCatalogo(tipo=tipo, chave=chave, valor=valor, atualizado_em=agora) for (tipo, chave), valor in totais.items() if valor),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0010_resumo_atrasos'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgregadoCatalogo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.CharField(max_length=12)),
+                ('chave', models.BigIntegerField()),
+                ('valor', models.IntegerField(default=0)),
+                ('atualizado_em', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['tipo', 'valor', 'chave'], name='agregado_catalogo_ranking_idx')],
+                'constraints': [models.UniqueConstraint(fields=('tipo', 'chave'), name='agregado_catalogo_unico')],
+            },
+        ),
+        migrations.RunPython(preencher_agregados, migrations.RunPython.noop),
+    ]
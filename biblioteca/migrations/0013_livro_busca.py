@@ -0,0 +1,27 @@
+# Generated by Django 5.1 on 2026-10-18 20:44
+
+import biblioteca.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0012_tarefas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LivroBusca',
+            fields=[
+                ('livro', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='busca', serialize=False, to='biblioteca.livro')),
+                ('indice', biblioteca.models.ColunaBusca(db_column='biblioteca_livro_busca')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'biblioteca_livro_busca',
+                'managed': False,
+            },
+        ),
+    ]
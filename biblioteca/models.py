@@ -1,34 +1,91 @@
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import F, Q
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 from django.contrib.auth.models import User
+from biblioteca.utils import normalizar_titulo
+
+LIMITE_LIVROS_POR_CATEGORIA = 100
+LIMITE_EMPRESTIMOS_ABERTOS = 5
 
 class Categoria(models.Model):
     nome = models.CharField(max_length=50, null=False, blank=False)
+    livros_count = models.PositiveIntegerField(default=0, editable=False)  # Mantido por reservar_vagas/liberar_vagas
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     
     def __str__(self):
         return self.nome
 
     def clean(self):
         super().clean()
-        num_livros = self.livros.count()
-        if num_livros > 100:
+        if self.livros_count > LIMITE_LIVROS_POR_CATEGORIA:
             raise ValidationError("A categoria não pode ter mais de 100 livros.")
 
+    def save(self, *args, **kwargs):
+        # livros_count só muda pelos UPDATEs com F() de reservar_vagas/liberar_vagas: num UPDATE, o valor em
+        # memória (lido antes de outras escritas) não volta para o banco e é relido depois
+        if self._state.adding or kwargs.get('force_insert'):
+            return super().save(*args, **kwargs)
+        campos = kwargs.get('update_fields')
+        if campos is None:
+            campos = [campo.name for campo in self._meta.concrete_fields if not campo.primary_key]
+        kwargs['update_fields'] = [campo for campo in campos if campo != 'livros_count']
+        super().save(*args, **kwargs)
+        self.refresh_from_db(fields=['livros_count'])
+
+    @staticmethod
+    def reservar_vagas(categoria_id, quantidade=1):
+        # UPDATE condicional: incrementa só se couber no limite, sem COUNT e sem corrida entre inserções
+        return Categoria.objects.filter(
+            pk=categoria_id,
+            livros_count__lte=LIMITE_LIVROS_POR_CATEGORIA - quantidade,
+        ).update(livros_count=F('livros_count') + quantidade, updated_at=timezone.now()) == 1
+
+    @staticmethod
+    def liberar_vagas(categoria_id, quantidade=1):
+        Categoria.objects.filter(pk=categoria_id, livros_count__gte=quantidade).update(
+            livros_count=F('livros_count') - quantidade, updated_at=timezone.now()
+        )
+
 class Autor(models.Model):
     nome = models.CharField(max_length=100, null=False, blank=False)
     biografia = models.TextField(null=False, blank=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # ?nome_autor= e ?autor= nos livros: o LIKE varre o índice, não a tabela com a biografia, e o
+            # MAX(updated_at) do ETag sai do mesmo índice
+            models.Index(fields=['nome', 'updated_at'], name='autor_nome_idx'),
+        ]
     
     def __str__(self):
         return self.nome
 
 class Livro(models.Model):
     titulo = models.CharField(max_length=100, null=False, blank=False)
+    titulo_normalizado = models.CharField(max_length=100, null=False, blank=False, editable=False)
     descricao = models.TextField(null=True, blank=True)
     data_publicacao = models.DateField(null=True, blank=True)
     categoria = models.ForeignKey(Categoria, on_delete=models.CASCADE, null=True, blank=True, related_name='livros')
     autor = models.ForeignKey(Autor, on_delete=models.CASCADE, null=True, blank=True, related_name='livros')
     criador = models.ForeignKey(User, on_delete=models.CASCADE, null=False, blank=False, related_name='livros_criados')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['titulo_normalizado'],
+                name='livro_titulo_normalizado_unico',
+                violation_error_message='O titulo já está em uso!',
+            ),
+        ]
+        indexes = [
+            # Cobre o COUNT da paginação e o agregado do ETag da listagem (com ou sem ?titulo=):
+            # a varredura lê só o índice e faz os JOINs com autor, categoria e criador pela pk
+            models.Index(fields=['titulo', 'updated_at', 'categoria', 'autor', 'criador'], name='livro_listagem_cobre_idx'),
+        ]
+
     def __str__(self):
         return self.titulo
 
@@ -37,9 +94,87 @@ class Livro(models.Model):
         if self.categoria:
             self.categoria.clean()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        livro = super().from_db(db, field_names, values)
+        # Guarda a categoria carregada para saber se o livro mudou de categoria no save
+        livro._categoria_id_original = livro.__dict__.get('categoria_id', models.DEFERRED)
+        if {'categoria_id', 'autor_id', 'data_publicacao'} <= livro.__dict__.keys():
+            livro._agregado_original = livro.chaves_agregado()
+        else:
+            livro._agregado_original = models.DEFERRED
+        return livro
+
+    def disponibilidade(self):
+        # (disponível, data prevista de retorno) pela LivroEmprestado, como as anotações da listagem
+        data_prevista = LivroEmprestado.objects.filter(livro_id=self.pk).values_list(
+            'emprestimo__data_prevista_devolucao', flat=True
+        ).first()
+        return data_prevista is None, data_prevista
+
+    def chaves_agregado(self):
+        return AgregadoCatalogo.chaves_livro(self.categoria_id, self.autor_id, self.data_publicacao)
+
+    @staticmethod
+    def marcar_alterados(using=None, **filtros):
+        # Empréstimos, devoluções e o nome do criador mudam a resposta do livro sem passar pelo save: o updated_at
+        # entra na ETag e no Last-Modified (biblioteca/conditional.py). UPDATE direto, sem os sinais do Livro
+        Livro.objects.db_manager(using).filter(**filtros).update(updated_at=timezone.now())
+
     def save(self, *args, **kwargs):
+        self.titulo_normalizado = normalizar_titulo(self.titulo)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'updated_at'}
+            if 'titulo' in update_fields:
+                kwargs['update_fields'].add('titulo_normalizado')
         self.full_clean()
-        super().save(*args, **kwargs)
+
+        categoria_anterior = None if self._state.adding else getattr(self, '_categoria_id_original', None)
+        agregado_anterior = None if self._state.adding else getattr(self, '_agregado_original', None)
+        with transaction.atomic(using=kwargs.get('using')):
+            if categoria_anterior is models.DEFERRED or agregado_anterior is models.DEFERRED:
+                salvo = Livro.objects.filter(pk=self.pk).values_list('categoria_id', 'autor_id', 'data_publicacao').first()
+                categoria_anterior = salvo[0] if salvo else None
+                agregado_anterior = AgregadoCatalogo.chaves_livro(*salvo) if salvo else None
+            if self.categoria_id != categoria_anterior:
+                if self.categoria_id and not Categoria.reservar_vagas(self.categoria_id):
+                    raise ValidationError("A categoria não pode ter mais de 100 livros.")
+                if categoria_anterior:
+                    Categoria.liberar_vagas(categoria_anterior)
+            adicionando = self._state.adding
+            super().save(*args, **kwargs)
+            if not adicionando and self.categoria_id != categoria_anterior:
+                ResumoAtraso.mover_livro(self.pk, categoria_anterior, self.categoria_id)
+            AgregadoCatalogo.somar(AgregadoCatalogo.diferenca(agregado_anterior, self.chaves_agregado()), using=kwargs.get('using'))
+        self._categoria_id_original = self.categoria_id
+        self._agregado_original = self.chaves_agregado()
+
+class ColunaBusca(models.TextField):
+    # Coluna oculta do FTS5 com o nome da tabela: alvo do MATCH na tabela inteira
+    pass
+
+@ColunaBusca.register_lookup
+class Match(models.Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', [*lhs_params, *rhs_params]
+
+class LivroBusca(models.Model):
+    # Tabela FTS5 criada na migração 0005_livro_busca_fts e mantida por biblioteca.search (rowid = id do livro).
+    # Só serve para o JOIN da busca: Livro.objects.filter(busca__indice__match=...) com o rank na mesma varredura
+    livro = models.OneToOneField(
+        Livro, on_delete=models.DO_NOTHING, primary_key=True, db_column='rowid', db_constraint=False, related_name='busca',
+    )
+    indice = ColunaBusca(db_column='biblioteca_livro_busca')
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'biblioteca_livro_busca'
 
 class Emprestimo(models.Model):
     livro = models.ForeignKey(Livro, null=False, blank=False, on_delete=models.CASCADE, related_name='emprestimos')
@@ -48,14 +183,271 @@ class Emprestimo(models.Model):
     data_prevista_devolucao = models.DateField(null=False, blank=False)
     devolvido = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # Listagem do usuário (staff) com ?devolvido=
+            models.Index(fields=['usuario', 'devolvido'], name='emprestimo_usuario_idx'),
+            # ?devolvido= do superusuário e os atrasados (abertos com data prevista vencida)
+            models.Index(fields=['devolvido', 'data_prevista_devolucao'], name='emprestimo_situacao_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        emprestimo = super().from_db(db, field_names, values)
+        # Guarda o estado carregado para saber no save se o empréstimo abriu, fechou ou mudou
+        if {'livro_id', 'usuario_id', 'devolvido'} <= emprestimo.__dict__.keys():
+            emprestimo._aberto_original = emprestimo._estado_aberto()
+        else:
+            emprestimo._aberto_original = models.DEFERRED
+        if {'livro_id', 'usuario_id', 'devolvido', 'data_prevista_devolucao'} <= emprestimo.__dict__.keys():
+            emprestimo._atraso_original = emprestimo.estado_atraso()
+        else:
+            emprestimo._atraso_original = models.DEFERRED
+        if {'livro_id', 'data_inicio'} <= emprestimo.__dict__.keys():
+            emprestimo._agregado_original = emprestimo.chaves_agregado()
+        else:
+            emprestimo._agregado_original = models.DEFERRED
+        return emprestimo
+
+    def chaves_agregado(self):
+        return AgregadoCatalogo.chaves_emprestimo(self.livro_id, self.data_inicio)
+
+    def _estado_aberto(self):
+        return None if self.devolvido else (self.livro_id, self.usuario_id)
+
+    def estado_atraso(self):
+        # O que o ResumoAtraso precisa para contar (ou descontar) este empréstimo
+        return None if self.devolvido else (self.usuario_id, self.livro_id, self.data_prevista_devolucao)
+
     def clean(self):
         if self.data_prevista_devolucao <= self.data_inicio:
             raise ValidationError("A data prevista de devolução deve ser posterior à data de início do empréstimo.")
-        
-        emprestimos_nao_devolvidos = Emprestimo.objects.filter(usuario=self.usuario, devolvido=False).count()
-        if emprestimos_nao_devolvidos >= 5:
-            raise ValidationError("O usuário já possui 5 empréstimos não devolvidos.")
 
     def save(self, *args, **kwargs):
         self.full_clean()
-        super().save(*args, **kwargs)
+
+        anterior = None if self._state.adding else getattr(self, '_aberto_original', None)
+        atraso_anterior = None if self._state.adding else getattr(self, '_atraso_original', None)
+        agregado_anterior = None if self._state.adding else getattr(self, '_agregado_original', None)
+        novo = self._estado_aberto()
+        atraso_novo = self.estado_atraso()
+        with transaction.atomic(using=kwargs.get('using')):
+            if models.DEFERRED in (anterior, atraso_anterior, agregado_anterior):
+                salvo = Emprestimo.objects.filter(pk=self.pk).first()
+                anterior = salvo._estado_aberto() if salvo else None
+                atraso_anterior = salvo.estado_atraso() if salvo else None
+                agregado_anterior = salvo.chaves_agregado() if salvo else None
+            if anterior != novo and anterior is not None:
+                LivroEmprestado.objects.filter(livro_id=anterior[0], emprestimo_id=self.pk).delete()
+                EmprestimosAbertos.liberar(anterior[1])
+            if anterior != novo and novo is not None:
+                if not EmprestimosAbertos.reservar(self.usuario_id):
+                    raise ValidationError("O usuário já possui 5 empréstimos não devolvidos.")
+            super().save(*args, **kwargs)
+            if anterior != novo and novo is not None:
+                try:
+                    with transaction.atomic(using=kwargs.get('using')):
+                        LivroEmprestado.objects.create(livro_id=self.livro_id, emprestimo=self)
+                except IntegrityError:
+                    raise ValidationError("O livro já está emprestado.")
+            if atraso_anterior != atraso_novo:
+                ResumoAtraso.registrar(atraso_anterior, -1)
+                ResumoAtraso.registrar(atraso_novo, 1)
+            # Depois do super().save(): no cadastro a data_inicio só existe após o auto_now_add
+            AgregadoCatalogo.somar(AgregadoCatalogo.diferenca(agregado_anterior, self.chaves_agregado()), using=kwargs.get('using'))
+        self._aberto_original = novo
+        self._atraso_original = atraso_novo
+        self._agregado_original = self.chaves_agregado()
+
+class EmprestimosAbertos(models.Model):
+    # Quantidade de empréstimos não devolvidos de cada usuário, mantida por Emprestimo.save
+    usuario = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='emprestimos_abertos')
+    quantidade = models.PositiveIntegerField(default=0)
+
+    @staticmethod
+    def reservar(usuario_id):
+        EmprestimosAbertos.objects.bulk_create([EmprestimosAbertos(usuario_id=usuario_id)], ignore_conflicts=True)
+        # O UPDATE condicional trava a linha do usuário e só incrementa se estiver abaixo do limite
+        return EmprestimosAbertos.objects.filter(
+            usuario_id=usuario_id, quantidade__lt=LIMITE_EMPRESTIMOS_ABERTOS
+        ).update(quantidade=F('quantidade') + 1) == 1
+
+    @staticmethod
+    def liberar(usuario_id):
+        EmprestimosAbertos.objects.filter(usuario_id=usuario_id, quantidade__gt=0).update(quantidade=F('quantidade') - 1)
+
+class LivroEmprestado(models.Model):
+    # Uma linha por livro emprestado no momento; a chave primária impede emprestar o mesmo livro duas vezes
+    livro = models.OneToOneField(Livro, on_delete=models.CASCADE, primary_key=True, related_name='emprestimo_atual')
+    emprestimo = models.OneToOneField(Emprestimo, on_delete=models.CASCADE, related_name='+')
+
+class ReferenciaAtrasos(models.Model):
+    # Linha única com a data em que os números do ResumoAtraso valem. Quem altera o resumo trava esta linha antes
+    data = models.DateField()
+
+    @staticmethod
+    def travar():
+        return ReferenciaAtrasos.objects.select_for_update().filter(pk=1).values_list('data', flat=True).first()
+
+class ResumoAtraso(models.Model):
+    # Empréstimos abertos com a data prevista vencida, somados por usuário, livro e categoria na data de
+    # ReferenciaAtrasos. Mantido por Emprestimo.save/delete e pelo virar do dia (biblioteca/atrasos.py)
+    USUARIO = 'usuario'
+    LIVRO = 'livro'
+    CATEGORIA = 'categoria'
+    DIMENSOES = [(USUARIO, 'Usuário'), (LIVRO, 'Livro'), (CATEGORIA, 'Categoria')]
+
+    dimensao = models.CharField(max_length=10, choices=DIMENSOES)
+    chave = models.BigIntegerField()  # id do usuário, do livro ou da categoria (0 = livros sem categoria)
+    quantidade = models.IntegerField(default=0)
+    dias = models.IntegerField(default=0)  # soma dos dias de atraso dos empréstimos
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['dimensao', 'chave'], name='resumo_atraso_unico'),
+        ]
+
+    @staticmethod
+    def chaves(usuario_id, livro_id, categoria_id):
+        return [(ResumoAtraso.USUARIO, usuario_id), (ResumoAtraso.LIVRO, livro_id), (ResumoAtraso.CATEGORIA, categoria_id or 0)]
+
+    @staticmethod
+    def somar(chaves, quantidade, dias):
+        ResumoAtraso.objects.bulk_create(
+            [ResumoAtraso(dimensao=dimensao, chave=chave) for dimensao, chave in chaves], ignore_conflicts=True
+        )
+        filtro = Q()
+        for dimensao, chave in chaves:
+            filtro |= Q(dimensao=dimensao, chave=chave)
+        ResumoAtraso.objects.filter(filtro).update(quantidade=F('quantidade') + quantidade, dias=F('dias') + dias)
+        if quantidade < 0:
+            ResumoAtraso.objects.filter(filtro, quantidade__lte=0).delete()
+
+    @staticmethod
+    def registrar(estado, sinal):
+        # Conta (sinal 1) ou desconta (sinal -1) um empréstimo aberto, se ele já estava atrasado na data de referência
+        if estado is None:
+            return
+        usuario_id, livro_id, prevista = estado
+        if prevista >= timezone.localdate():
+            # Ainda não venceu: o virar do dia inclui o empréstimo quando vencer
+            return
+        referencia = ReferenciaAtrasos.travar()
+        if referencia is None or prevista >= referencia:
+            return
+        categoria_id = Livro.objects.filter(pk=livro_id).values_list('categoria_id', flat=True).first()
+        ResumoAtraso.somar(ResumoAtraso.chaves(usuario_id, livro_id, categoria_id), sinal, sinal * (referencia - prevista).days)
+
+    @staticmethod
+    def mover_livro(livro_id, categoria_anterior, categoria_nova):
+        # Um livro tem no máximo um empréstimo aberto: a linha dele é exatamente o que muda de categoria
+        ReferenciaAtrasos.travar()
+        linha = ResumoAtraso.objects.filter(dimensao=ResumoAtraso.LIVRO, chave=livro_id).values_list('quantidade', 'dias').first()
+        if linha is None:
+            return
+        quantidade, dias = linha
+        ResumoAtraso.somar([(ResumoAtraso.CATEGORIA, categoria_anterior or 0)], -quantidade, -dias)
+        ResumoAtraso.somar([(ResumoAtraso.CATEGORIA, categoria_nova or 0)], quantidade, dias)
+
+class AgregadoCatalogo(models.Model):
+    # Contagens pré-calculadas de /api/estatisticas/, somadas por Livro.save, Emprestimo.save e pelos sinais de exclusão
+    LIVROS = 'livros'
+    CATEGORIA = 'categoria'
+    AUTOR = 'autor'
+    ANO = 'ano'
+    EMPRESTIMOS = 'emprestimos'
+    MES = 'mes'
+    LIVRO = 'livro'
+
+    tipo = models.CharField(max_length=12)
+    chave = models.BigIntegerField()  # id da categoria/autor/livro, ano ou mês (AAAAMM); 0 = total ou sem valor
+    valor = models.IntegerField(default=0)
+    atualizado_em = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tipo', 'chave'], name='agregado_catalogo_unico'),
+        ]
+        indexes = [
+            # Os mais frequentes de um tipo (autores com mais livros, livros mais emprestados) sem ordenar a tabela
+            models.Index(fields=['tipo', 'valor', 'chave'], name='agregado_catalogo_ranking_idx'),
+        ]
+
+    @staticmethod
+    def chaves_livro(categoria_id, autor_id, data_publicacao):
+        return [
+            (AgregadoCatalogo.LIVROS, 0),
+            (AgregadoCatalogo.CATEGORIA, categoria_id or 0),
+            (AgregadoCatalogo.AUTOR, autor_id or 0),
+            (AgregadoCatalogo.ANO, data_publicacao.year if data_publicacao else 0),
+        ]
+
+    @staticmethod
+    def chaves_emprestimo(livro_id, data_inicio):
+        return [
+            (AgregadoCatalogo.EMPRESTIMOS, 0),
+            (AgregadoCatalogo.MES, data_inicio.year * 100 + data_inicio.month),
+            (AgregadoCatalogo.LIVRO, livro_id),
+        ]
+
+    @staticmethod
+    def diferenca(antes, depois):
+        deltas = {}
+        for chave in antes or ():
+            deltas[chave] = deltas.get(chave, 0) - 1
+        for chave in depois or ():
+            deltas[chave] = deltas.get(chave, 0) + 1
+        return {chave: valor for chave, valor in deltas.items() if valor}
+
+    @staticmethod
+    def somar(deltas, using=None):
+        # Um INSERT ... ON CONFLICT para todas as chaves: soma no banco, sem ler a linha antes
+        if not deltas:
+            return
+        conexao = connections[using or 'default']
+        tabela = AgregadoCatalogo._meta.db_table
+        agora = conexao.ops.adapt_datetimefield_value(timezone.now())
+        valores = ', '.join(['(%s, %s, %s, %s)'] * len(deltas))
+        parametros = [valor for (tipo, chave), delta in deltas.items() for valor in (tipo, chave, delta, agora)]
+        with conexao.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {tabela} (tipo, chave, valor, atualizado_em) VALUES {valores} '
+                f'ON CONFLICT (tipo, chave) DO UPDATE SET valor = {tabela}.valor + excluded.valor, '
+                f'atualizado_em = excluded.atualizado_em',
+                parametros,
+            )
+
+class Tarefa(models.Model):
+    # Fila de tarefas pesadas executadas fora da requisição pelo comando run_workers (biblioteca/tarefas.py)
+    PENDENTE = 'pendente'
+    EXECUTANDO = 'executando'
+    CONCLUIDA = 'concluida'
+    FALHOU = 'falhou'
+    ESTADOS = [(PENDENTE, 'Pendente'), (EXECUTANDO, 'Executando'), (CONCLUIDA, 'Concluída'), (FALHOU, 'Falhou')]
+
+    tipo = models.CharField(max_length=40)
+    parametros = models.JSONField(default=dict)
+    estado = models.CharField(max_length=10, choices=ESTADOS, default=PENDENTE)
+    criador = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='tarefas')
+    tentativas = models.PositiveIntegerField(default=0)
+    max_tentativas = models.PositiveIntegerField(default=3)
+    disponivel_em = models.DateTimeField(default=timezone.now)  # a próxima tentativa não começa antes disso
+    # Reserva do worker: passado travada_ate sem renovar, outro worker pode pegar a tarefa de novo
+    travada_ate = models.DateTimeField(null=True, blank=True)
+    reserva = models.CharField(max_length=32, blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    progresso = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(null=True, blank=True)
+    mensagem = models.CharField(max_length=200, blank=True)
+    resultado = models.JSONField(null=True, blank=True)
+    erro = models.TextField(blank=True)
+    criada_em = models.DateTimeField(auto_now_add=True)
+    iniciada_em = models.DateTimeField(null=True, blank=True)
+    concluida_em = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Próxima da fila: pendentes já liberadas e reservas vencidas
+            models.Index(fields=['estado', 'disponivel_em'], name='tarefa_fila_idx'),
+            models.Index(fields=['estado', 'travada_ate'], name='tarefa_reserva_idx'),
+        ]
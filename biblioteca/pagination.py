@@ -0,0 +1,115 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.paginator import InvalidPage, Paginator
+from django.db import connections
+from django.db.models import Max
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, CursorPagination, PageNumberPagination
+from biblioteca import cache
+
+
+def cursor_solicitado(request):
+    # O modo cursor é opcional: ?paginacao=cursor inicia e os links next/previous trazem ?cursor=
+    return request.query_params.get('paginacao') == 'cursor' or 'cursor' in request.query_params
+
+
+class IdCursorPagination(CursorPagination):
+    # Paginação por chave (keyset) no -id: sem COUNT e sem OFFSET crescente
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-id'
+
+
+class CursorOpcionalMixin:
+    cursor_pagination_class = IdCursorPagination
+    cursor_paginator = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if cursor_solicitado(request):
+            self.cursor_paginator = self.cursor_pagination_class()
+            return self.cursor_paginator.paginate_queryset(queryset, request, view)
+        self.cursor_paginator = None
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+
+class LivroViewPagination(CursorOpcionalMixin, PageNumberPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        # Mesmo resultado do paginate_queryset do DRF, com COUNT e página pelo ORM assíncrono
+        if cursor_solicitado(request):
+            # O cursor faz uma única consulta fatiada: roda o caminho síncrono numa thread
+            return await sync_to_async(self.paginate_queryset)(queryset, request, view)
+        self.cursor_paginator = None
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        paginator = self.django_paginator_class(queryset, page_size)
+        paginator.count = await queryset.acount()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=str(exc)))
+        self.page.object_list = [obj async for obj in self.page.object_list.aiterator()]
+
+        if paginator.num_pages > 1 and self.template is not None:
+            self.display_page_controls = True
+        return list(self.page)
+
+
+class EmprestimoViewPagination(CursorOpcionalMixin, BasePagination):
+    # Sem ?paginacao=cursor a listagem de empréstimos continua sem paginação
+    def paginate_queryset(self, queryset, request, view=None):
+        if not cursor_solicitado(request):
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+
+def contagem_estimada(modelo, using='default'):
+    # Linhas da tabela pelas estatísticas do ANALYZE (sqlite_stat1) ou um COUNT guardado no cache por
+    # BIBLIOTECA_ADMIN_CONTAGEM_TTL segundos. As estatísticas ficam paradas até o próximo ANALYZE: só valem se
+    # não estão abaixo do maior id (uma busca no fim da chave primária), senão as inserções depois delas
+    # ficariam fora das últimas páginas
+    tabela = modelo._meta.db_table
+    conexao = connections[using]
+    if conexao.vendor == 'sqlite':
+        with conexao.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone():
+                # stat começa pelo número de linhas do índice (ou da tabela, sem índices)
+                cursor.execute('SELECT MAX(CAST(stat AS INTEGER)) FROM sqlite_stat1 WHERE tbl = %s', [tabela])
+                total = cursor.fetchone()[0]
+                maior_id = modelo._default_manager.using(using).aggregate(maior=Max('pk'))['maior'] or 0
+                if total and total >= maior_id:
+                    return total
+    chave = f'biblioteca:admin:contagem:{using}:{tabela}'
+    total = cache.get_cache().get(chave)
+    if total is None:
+        total = modelo._default_manager.using(using).count()
+        cache.get_cache().set(chave, total, timeout=getattr(settings, 'BIBLIOTECA_ADMIN_CONTAGEM_TTL', 300))
+    return total
+
+
+class ContagemEstimadaPaginator(Paginator):
+    # Admin de tabelas grandes: sem filtro nem busca, o total é estimado; com eles, o COUNT para em
+    # BIBLIOTECA_ADMIN_CONTAGEM_MAXIMA linhas (as páginas além disso não aparecem)
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not hasattr(queryset, 'query'):
+            return super().count
+        if not queryset.query.where:
+            return contagem_estimada(queryset.model, queryset.db)
+        return queryset.order_by()[:getattr(settings, 'BIBLIOTECA_ADMIN_CONTAGEM_MAXIMA', 10_000)].count()
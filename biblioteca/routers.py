@@ -0,0 +1,71 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+ALIAS_PRINCIPAL = 'default'
+ALIAS_REPLICA = 'replica'
+
+# Modelos do catálogo: só as leituras deles vão para a réplica. Usuários e empréstimos
+# (autenticação, limites de empréstimo) sempre leem do principal
+MODELOS_CATALOGO = {'biblioteca.livro', 'biblioteca.autor', 'biblioteca.categoria'}
+METODOS_LEITURA = {'GET', 'HEAD', 'OPTIONS'}
+
+# Ligado pelo middleware durante uma requisição só de leitura. Fora dela (escritas, comandos, shell)
+# tudo fica no principal, então uma escrita nunca valida contra dados atrasados da réplica
+leitura_replica = ContextVar('leitura_replica', default=False)
+
+
+@contextmanager
+def usar_principal():
+    # Para os GETs que também escrevem (o relatório de atrasos vira o dia do resumo antes de ler): as leituras
+    # do bloco ficam no principal e veem o que acabou de ser escrito, não a réplica atrasada
+    token = leitura_replica.set(False)
+    try:
+        yield
+    finally:
+        leitura_replica.reset(token)
+
+
+class ReplicaDeLeituraRouter:
+    def db_for_read(self, model, **hints):
+        if leitura_replica.get() and model._meta.label_lower in MODELOS_CATALOGO:
+            return ALIAS_REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        return ALIAS_PRINCIPAL
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # A réplica é uma cópia do principal: objetos de um e de outro podem se relacionar
+        return {obj1._state.db, obj2._state.db} <= {ALIAS_PRINCIPAL, ALIAS_REPLICA}
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # A réplica recebe o esquema junto com os dados no snapshot
+        return db != ALIAS_REPLICA
+
+
+class ReplicaDeLeituraMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = leitura_replica.set(request.method in METODOS_LEITURA)
+        try:
+            return self.get_response(request)
+        finally:
+            leitura_replica.reset(token)
+
+    async def __acall__(self, request):
+        # O sync_to_async copia o contexto, então as partes síncronas da view também veem o valor
+        token = leitura_replica.set(request.method in METODOS_LEITURA)
+        try:
+            return await self.get_response(request)
+        finally:
+            leitura_replica.reset(token)
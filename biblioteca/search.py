@@ -0,0 +1,85 @@
+import re
+from django.db import connections
+from django.db.models import F, Q
+
+# Tabela FTS5 criada na migração 0005_livro_busca_fts (rowid = id do livro)
+TABELA_BUSCA = 'biblioteca_livro_busca'
+
+SQL_INSERIR = f"""
+    INSERT INTO {TABELA_BUSCA}(rowid, titulo, descricao, autor_nome, categoria_nome)
+    SELECT l.id, l.titulo, COALESCE(l.descricao, ''), COALESCE(a.nome, ''), COALESCE(c.nome, '')
+    FROM biblioteca_livro l
+    LEFT JOIN biblioteca_autor a ON a.id = l.autor_id
+    LEFT JOIN biblioteca_categoria c ON c.id = l.categoria_id
+"""
+
+
+def busca_disponivel(using='default'):
+    return connections[using].vendor == 'sqlite'
+
+
+def montar_consulta(termo):
+    # Cada palavra vira um prefixo entre aspas, evitando que o usuário injete a sintaxe do FTS5
+    palavras = re.findall(r'\w+', termo or '')
+    return ' '.join(f'"{palavra}"*' for palavra in palavras)
+
+
+def indexar_livros(ids, using='default'):
+    ids = list(ids)
+    if not ids or not busca_disponivel(using):
+        return
+    marcadores = ', '.join(['%s'] * len(ids))
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABELA_BUSCA} WHERE rowid IN ({marcadores})', ids)
+        cursor.execute(f'{SQL_INSERIR} WHERE l.id IN ({marcadores})', ids)
+
+
+def remover_livros(ids, using='default'):
+    ids = list(ids)
+    if not ids or not busca_disponivel(using):
+        return
+    marcadores = ', '.join(['%s'] * len(ids))
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABELA_BUSCA} WHERE rowid IN ({marcadores})', ids)
+
+
+def renomear_relacionado(coluna, campo_fk, pk, nome, using='default'):
+    # Atualiza o nome do autor/categoria em todos os livros dele sem reler os livros
+    if not busca_disponivel(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {TABELA_BUSCA} SET {coluna} = %s '
+            f'WHERE rowid IN (SELECT id FROM biblioteca_livro WHERE {campo_fk} = %s)',
+            [nome, pk],
+        )
+
+
+def reconstruir_indice(using='default'):
+    if not busca_disponivel(using):
+        return 0
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABELA_BUSCA}')
+        cursor.execute(SQL_INSERIR)
+        total = cursor.rowcount
+        cursor.execute(f"INSERT INTO {TABELA_BUSCA}({TABELA_BUSCA}) VALUES('optimize')")
+    return total
+
+
+def filtrar_livros(qs, termo):
+    consulta = montar_consulta(termo)
+    if not consulta:
+        return qs.none()
+
+    if not busca_disponivel(qs.db):
+        filtro = Q()
+        for palavra in re.findall(r'\w+', termo):
+            filtro &= (
+                Q(titulo__icontains=palavra) | Q(descricao__icontains=palavra)
+                | Q(autor__nome__icontains=palavra) | Q(categoria__nome__icontains=palavra)
+            )
+        return qs.filter(filtro)
+
+    # JOIN com a tabela FTS (LivroBusca): o rank sai da mesma varredura do MATCH. Uma subconsulta
+    # correlacionada refaria o MATCH (e o bm25) para cada linha, o que é quadrático no número de resultados
+    return qs.filter(busca__indice__match=consulta).annotate(relevancia=F('busca__rank')).order_by('relevancia', '-id')
@@ -1,18 +1,187 @@
 from rest_framework import serializers
-from biblioteca.models import Livro, Categoria, Autor, Emprestimo
+from rest_framework.settings import api_settings
+from biblioteca.models import Livro, Categoria, Autor, Emprestimo, Tarefa
 from biblioteca.validators import LivroValidate, EmprestimoValidate, AuthorValidate
+from biblioteca.filters import CRIADOR_NOME, DATA_PREVISTA_RETORNO, DISPONIVEL
+from biblioteca import tarefas
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
 from django.contrib.auth.password_validation import validate_password
 import re
 import datetime
 
-class LivroSerializer(serializers.ModelSerializer):
+
+def campos_da_requisicao(request):
+    # ?fields=id,titulo&expand=autor -> ({'id', 'titulo'}, {'autor'})
+    def lista(parametro):
+        return {campo.strip() for campo in request.query_params.get(parametro, '').split(',') if campo.strip()}
+    return lista('fields'), lista('expand')
+
+
+class CamposDinamicosMixin:
+    # Campo da API -> caminhos do ORM que ele lê (padrão: o próprio nome do campo)
+    colunas = {}
+    # Campo da API -> anotação necessária para preenchê-lo
+    anotacoes = {}
+
+    def __init__(self, *args, dinamico=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if not dinamico or request is None or request.method != 'GET':
+            return
+        campos, expandir = campos_da_requisicao(request)
+        for nome, (relacao, serializer_class) in self.get_expansoes().items():
+            if nome in expandir:
+                # O DRF não aceita source igual ao nome do campo
+                opcoes = {'source': relacao} if relacao != nome else {}
+                self.fields[nome] = serializer_class(read_only=True, dinamico=False, **opcoes)
+        if campos:
+            for nome in set(self.fields) - campos - (expandir & set(self.get_expansoes())):
+                self.fields.pop(nome)
+
+    @classmethod
+    def get_expansoes(cls):
+        # Nome em ?expand= -> (relação no modelo, serializer aninhado)
+        return {}
+
+    @classmethod
+    def caminhos(cls, campos):
+        caminhos = set()
+        for campo in campos:
+            caminhos.update(cls.colunas.get(campo, [campo]))
+        return caminhos
+
+    @classmethod
+    def planejar_queryset(cls, qs, request):
+        # Carrega só as colunas dos campos pedidos e faz exatamente os joins que a expansão precisa
+        campos, expandir = campos_da_requisicao(request)
+        declarados = list(cls.Meta.fields)
+        campos = [campo for campo in declarados if campo in campos] if campos else declarados
+        expansoes = {nome: valor for nome, valor in cls.get_expansoes().items() if nome in expandir}
+
+        caminhos = cls.caminhos(campo for campo in campos if campo not in cls.anotacoes)
+        for relacao, serializer_class in expansoes.values():
+            caminhos.add(relacao)
+            caminhos.update(f'{relacao}__{caminho}' for caminho in serializer_class.caminhos(serializer_class.Meta.fields))
+
+        relacoes = {caminho.split('__')[0] for caminho in caminhos if '__' in caminho}
+        caminhos.update(relacoes)
+        qs = qs.select_related(None)
+        if relacoes:
+            qs = qs.select_related(*sorted(relacoes))
+        for campo in campos:
+            if campo in cls.anotacoes:
+                qs = qs.annotate(**{campo: cls.anotacoes[campo]})
+        return qs.only(*sorted(caminhos))
+
+
+# (classe do serializer, campos) -> PlanoDeLeitura, montado uma vez por formato de resposta
+_PLANOS = {}
+
+
+class PlanoDeLeitura:
+    # Monta as linhas da listagem direto dos dicts de .values(), com a mesma saída do serializer:
+    # sem instâncias do modelo e sem o get_attribute de cada campo
+    def __init__(self, caminhos, itens):
+        self.caminhos = caminhos
+        self.montar_linha = _montador(itens)
+
+    def montar(self, linhas):
+        return [self.montar_linha(linha) for linha in linhas]
+
+
+def _montador(itens):
+    def montar_linha(linha):
+        saida = {}
+        for nome, chave, converter, aninhado in itens:
+            valor = linha[chave]
+            if valor is None:
+                saida[nome] = None
+            elif aninhado is not None:
+                saida[nome] = aninhado(linha)
+            elif converter is not None:
+                saida[nome] = converter(valor)
+            else:
+                saida[nome] = valor
+        return saida
+    return montar_linha
+
+
+def _compilar(serializer, prefixo=''):
+    # Devolve (caminhos do ORM, itens do montador) ou None quando algum campo não tem equivalente em .values()
+    caminhos, itens = [], []
+    for nome, campo in serializer.fields.items():
+        if campo.write_only:
+            continue
+        if campo.source == '*' or isinstance(campo, (serializers.SerializerMethodField, serializers.ListSerializer)):
+            return None
+        caminho = prefixo + '__'.join(campo.source_attrs)
+        if isinstance(campo, serializers.ModelSerializer):
+            # Expansão: a FK (nula ou não) decide entre None e o objeto aninhado
+            aninhado = _compilar(campo, caminho + '__')
+            if aninhado is None:
+                return None
+            caminhos += [caminho, *aninhado[0]]
+            itens.append((nome, caminho, None, _montador(aninhado[1])))
+        elif isinstance(campo, serializers.PrimaryKeyRelatedField) and campo.pk_field is None:
+            caminhos.append(caminho)
+            itens.append((nome, caminho, None, None))
+        elif isinstance(campo, serializers.SlugRelatedField):
+            caminho = f'{caminho}__{campo.slug_field}'
+            caminhos.append(caminho)
+            itens.append((nome, caminho, None, None))
+        elif isinstance(campo, (serializers.RelatedField, serializers.BaseSerializer)):
+            return None
+        else:
+            caminhos.append(caminho)
+            itens.append((nome, caminho, campo.to_representation, None))
+    return caminhos, itens
+
+
+def plano_de_leitura(serializer):
+    chave = (type(serializer), tuple((nome, type(campo)) for nome, campo in serializer.fields.items()))
+    if chave not in _PLANOS:
+        compilado = _compilar(serializer)
+        _PLANOS[chave] = PlanoDeLeitura(*compilado) if compilado else None
+    return _PLANOS[chave]
+
+
+class LivroResumoSerializer(CamposDinamicosMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Livro
+        fields = ['id', 'titulo']
+
+
+class UsuarioResumoSerializer(CamposDinamicosMixin, serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'first_name', 'last_name']
+
+
+class LivroSerializer(CamposDinamicosMixin, serializers.ModelSerializer):
     class Meta:
         model = Livro
-        fields = ['id', 'titulo', 'descricao', 'data_publicacao', 'categoria_id', 'autor_id', 'categoria_nome', 'autor_nome', 'criador', 'criador_nome']
+        fields = [
+            'id', 'titulo', 'descricao', 'data_publicacao', 'categoria_id', 'autor_id', 'categoria_nome', 'autor_nome',
+            'criador', 'criador_nome', 'disponivel', 'data_prevista_retorno',
+        ]
+    
+    colunas = {
+        'categoria_id': ['categoria'],
+        'autor_id': ['autor'],
+        'categoria_nome': ['categoria__nome'],
+        'autor_nome': ['autor__nome'],
+    }
+    anotacoes = {
+        'criador_nome': CRIADOR_NOME,
+        'disponivel': DISPONIVEL,
+        'data_prevista_retorno': DATA_PREVISTA_RETORNO,
+    }
     
     criador_nome = serializers.CharField(max_length=100, read_only=True)
+    disponivel = serializers.BooleanField(read_only=True)
+    data_prevista_retorno = serializers.DateField(read_only=True)
     categoria_id = serializers.PrimaryKeyRelatedField(queryset=Categoria.objects.all(), source='categoria')
     autor_id = serializers.PrimaryKeyRelatedField(queryset=Autor.objects.all(), source='autor')
     categoria_nome = serializers.SlugRelatedField(
@@ -39,17 +208,53 @@ class LivroSerializer(serializers.ModelSerializer):
                 
         if attrs.get('titulo') is None and self.instance:
             attrs['titulo'] = self.instance.titulo
-        else:
-            if attrs['titulo'] in Livro.objects.values_list('titulo', flat=True):
-                raise serializers.ValidationError('O titulo já está em uso!')
+        # A unicidade do título fica com o full_clean do Livro.save (uma busca pelo índice único) e com a constraint
         
         LivroValidate(dados=attrs, ErrorClass=serializers.ValidationError)
         return attrs
+    
+    @classmethod
+    def get_expansoes(cls):
+        return {'autor': ('autor', AuthorSerializer), 'categoria': ('categoria', CategoriaSerializer)}
+    
+    def to_representation(self, instance):
+        # Livro recém-criado ou alterado não vem do queryset anotado: busca a disponibilidade dele
+        if not hasattr(instance, 'disponivel') and {'disponivel', 'data_prevista_retorno'} & set(self.fields):
+            instance.disponivel, instance.data_prevista_retorno = instance.disponibilidade()
+        return super().to_representation(instance)
+    
+    def create(self, validated_data):
+        # Dois cadastros simultâneos podem passar pelo validate; a constraint do banco decide
+        try:
+            with transaction.atomic():
+                livro = super().create(validated_data)
+        except (IntegrityError, ValidationError) as e:
+            raise serializers.ValidationError(self._mensagens_erro(e))
+        # Livro novo não tem empréstimo: dispensa a consulta do to_representation
+        livro.disponivel, livro.data_prevista_retorno = True, None
+        return livro
+    
+    def update(self, instance, validated_data):
+        try:
+            with transaction.atomic():
+                return super().update(instance, validated_data)
+        except (IntegrityError, ValidationError) as e:
+            raise serializers.ValidationError(self._mensagens_erro(e))
+    
+    def _mensagens_erro(self, erro):
+        # Título repetido: pela validação da constraint no full_clean ou, numa corrida, pelo IntegrityError
+        if isinstance(erro, ValidationError):
+            if 'titulo_normalizado' not in getattr(erro, 'error_dict', {}):
+                return erro.messages
+        elif 'titulo_normalizado' not in str(erro):
+            raise erro
+        return {api_settings.NON_FIELD_ERRORS_KEY: ['O titulo já está em uso!']}
 
-class CategoriaSerializer(serializers.ModelSerializer):
+class CategoriaSerializer(CamposDinamicosMixin, serializers.ModelSerializer):
     class Meta:
         model = Categoria
-        fields = ['id', 'nome']
+        fields = ['id', 'nome', 'livros_count']
+        read_only_fields = ['livros_count']
     
     def validate(self, attrs):
         if self.instance:
@@ -66,7 +271,7 @@ class CategoriaSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('O nome da categoria deve ter no máximo 50 caracteres.')
         return attrs
     
-class AuthorSerializer(serializers.ModelSerializer):
+class AuthorSerializer(CamposDinamicosMixin, serializers.ModelSerializer):
     class Meta:
         model = Autor
         fields = ['id', 'nome', 'biografia']
@@ -126,7 +331,7 @@ class SuperuserSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError({'error_last_name':'O last_name nome deve conter apenas letras.'})
         return super().validate(attrs)
 
-class EmprestimoSerializer(serializers.ModelSerializer):
+class EmprestimoSerializer(CamposDinamicosMixin, serializers.ModelSerializer):
     class Meta:
         model = Emprestimo
         fields = ['id', 'livro', 'usuario', 'data_inicio', 'data_prevista_devolucao', 'devolvido']
@@ -134,6 +339,10 @@ class EmprestimoSerializer(serializers.ModelSerializer):
     livro = serializers.PrimaryKeyRelatedField(queryset=Livro.objects.all())
     usuario = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
     
+    @classmethod
+    def get_expansoes(cls):
+        return {'livro': ('livro', LivroResumoSerializer), 'usuario': ('usuario', UsuarioResumoSerializer)}
+    
     def validate(self, attrs):
         # Data de início é gerada automaticamente pelo modelo, não é necessário no validate.
         # Remova 'data_inicio' de attrs
@@ -145,16 +354,54 @@ class EmprestimoSerializer(serializers.ModelSerializer):
     
     def create(self, validated_data):
         # Definindo data_inicio como hoje, pois é um campo gerado automaticamente.
-        emprestimo = Emprestimo.objects.create(
-            livro=validated_data['livro'],
-            usuario=validated_data['usuario'],
-            data_inicio=datetime.date.today(),  # Data de início é definida como hoje
-            data_prevista_devolucao=validated_data['data_prevista_devolucao']
-        )
+        # O limite de empréstimos e a disponibilidade do livro são garantidos no Emprestimo.save
+        try:
+            emprestimo = Emprestimo.objects.create(
+                livro=validated_data['livro'],
+                usuario=validated_data['usuario'],
+                data_inicio=datetime.date.today(),  # Data de início é definida como hoje
+                data_prevista_devolucao=validated_data['data_prevista_devolucao']
+            )
+        except ValidationError as e:
+            raise serializers.ValidationError(e.messages)
         return emprestimo
     
+    def update(self, instance, validated_data):
+        try:
+            return super().update(instance, validated_data)
+        except ValidationError as e:
+            raise serializers.ValidationError(e.messages)
+    
     def partial_update(self, instance, validated_data):
         instance.devolvido = validated_data.get('devolvido', instance.devolvido)
         instance.data_prevista_devolucao = validated_data.get('data_prevista_devolucao', instance.data_prevista_devolucao)
         instance.save()
-        return instance
\ No newline at end of file
+        return instance
+
+
+class TarefaSerializer(serializers.ModelSerializer):
+    # Situação da tarefa; o resultado sai em /api/tarefas/<id>/resultado/
+    class Meta:
+        model = Tarefa
+        fields = [
+            'id', 'tipo', 'parametros', 'estado', 'criador', 'tentativas', 'max_tentativas', 'progresso', 'total',
+            'mensagem', 'erro', 'criada_em', 'iniciada_em', 'concluida_em', 'disponivel_em',
+        ]
+        read_only_fields = [campo for campo in fields if campo not in ('tipo', 'parametros', 'max_tentativas')]
+
+    max_tentativas = serializers.IntegerField(min_value=1, max_value=10, required=False)
+    parametros = serializers.JSONField(required=False)
+
+    def validate_tipo(self, valor):
+        if not tarefas.pode_enfileirar(valor, self.context['request'].user):
+            raise serializers.ValidationError('Tipo de tarefa inválido ou não permitido para este usuário.')
+        return valor
+
+    def create(self, validated_data):
+        try:
+            return tarefas.enfileirar(
+                validated_data['tipo'], validated_data.get('parametros'), criador=self.context['request'].user,
+                max_tentativas=validated_data.get('max_tentativas'),
+            )
+        except ValidationError as e:
+            raise serializers.ValidationError({'parametros': e.message_dict})
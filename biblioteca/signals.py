@@ -0,0 +1,119 @@
+from functools import partial
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from biblioteca.models import Livro, Autor, Categoria, Emprestimo, EmprestimosAbertos, LivroEmprestado, ResumoAtraso, AgregadoCatalogo
+from biblioteca import authentication, autocomplete, cache, search
+
+
+@receiver(post_save, sender=Livro)
+def indexar_livro(sender, instance, using, **kwargs):
+    search.indexar_livros([instance.pk], using=using)
+
+
+@receiver(post_delete, sender=Livro)
+def remover_livro_do_indice(sender, instance, using, **kwargs):
+    search.remover_livros([instance.pk], using=using)
+
+
+@receiver(post_delete, sender=Livro)
+def liberar_vaga_da_categoria(sender, instance, **kwargs):
+    if instance.categoria_id:
+        Categoria.liberar_vagas(instance.categoria_id)
+
+
+@receiver(post_delete, sender=Emprestimo)
+def liberar_emprestimo_aberto(sender, instance, **kwargs):
+    # A linha de LivroEmprestado é removida pelo CASCADE; falta o contador do usuário e o resumo de atrasos
+    if not instance.devolvido:
+        EmprestimosAbertos.liberar(instance.usuario_id)
+        ResumoAtraso.registrar(instance.estado_atraso(), -1)
+
+
+@receiver(post_delete, sender=Livro)
+@receiver(post_delete, sender=Emprestimo)
+def descontar_dos_agregados(sender, instance, using, **kwargs):
+    AgregadoCatalogo.somar(AgregadoCatalogo.diferenca(instance.chaves_agregado(), None), using=using)
+
+
+# O índice do autocomplete é por processo e não volta atrás num rollback: só recebe o que foi confirmado
+@receiver(post_save, sender=Livro)
+def atualizar_livro_no_autocomplete(sender, instance, using, **kwargs):
+    transaction.on_commit(partial(autocomplete.indice.livro_salvo, instance.pk, instance.titulo, instance.autor_id), using=using)
+
+
+@receiver(post_delete, sender=Livro)
+def remover_livro_do_autocomplete(sender, instance, using, **kwargs):
+    transaction.on_commit(partial(autocomplete.indice.livro_removido, instance.pk), using=using)
+
+
+@receiver(post_save, sender=Autor)
+def atualizar_autor_no_autocomplete(sender, instance, using, **kwargs):
+    transaction.on_commit(partial(autocomplete.indice.autor_salvo, instance.pk, instance.nome), using=using)
+
+
+@receiver(post_delete, sender=Autor)
+def remover_autor_do_autocomplete(sender, instance, using, **kwargs):
+    transaction.on_commit(partial(autocomplete.indice.autor_removido, instance.pk), using=using)
+
+
+@receiver(post_save, sender=Emprestimo)
+def contar_emprestimo_no_autocomplete(sender, instance, created, using, **kwargs):
+    # Popularidade = empréstimos do livro, como no agregado de mais emprestados
+    if created:
+        transaction.on_commit(partial(autocomplete.indice.emprestimos, instance.pk, instance.livro_id, 1), using=using)
+
+
+@receiver(post_delete, sender=Emprestimo)
+def descontar_emprestimo_no_autocomplete(sender, instance, using, **kwargs):
+    transaction.on_commit(partial(autocomplete.indice.emprestimos, instance.pk, instance.livro_id, -1), using=using)
+
+
+@receiver(post_save, sender=Autor)
+def atualizar_autor_no_indice(sender, instance, created, using, **kwargs):
+    if not created:
+        search.renomear_relacionado('autor_nome', 'autor_id', instance.pk, instance.nome, using=using)
+
+
+@receiver(post_save, sender=Categoria)
+def atualizar_categoria_no_indice(sender, instance, created, using, **kwargs):
+    if not created:
+        search.renomear_relacionado('categoria_nome', 'categoria_id', instance.pk, instance.nome, using=using)
+
+
+@receiver(post_save, sender=LivroEmprestado)
+@receiver(post_delete, sender=LivroEmprestado)
+def marcar_livro_emprestado(sender, instance, using, **kwargs):
+    Livro.marcar_alterados(using=using, pk=instance.livro_id)
+
+
+@receiver(post_save, sender=User)
+def marcar_livros_do_criador(sender, instance, created, using, update_fields=None, **kwargs):
+    # O nome do criador aparece nos livros; o login só grava o last_login
+    if not created and update_fields != frozenset(['last_login']):
+        Livro.marcar_alterados(using=using, criador_id=instance.pk)
+
+
+@receiver(post_save, sender=Livro)
+@receiver(post_delete, sender=Livro)
+@receiver(post_save, sender=Autor)
+@receiver(post_delete, sender=Autor)
+@receiver(post_save, sender=Categoria)
+@receiver(post_delete, sender=Categoria)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=LivroEmprestado)
+@receiver(post_delete, sender=LivroEmprestado)
+def invalidar_respostas_em_cache(sender, **kwargs):
+    # Incrementa de novo no commit para descartar respostas montadas com os dados antigos durante a transação
+    cache.incrementar_versao(sender)
+    transaction.on_commit(lambda: cache.incrementar_versao(sender), using=kwargs.get('using'))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidar_usuario_autenticado(sender, instance, **kwargs):
+    # Remove já e de novo no commit, para não guardar a versão lida por outra requisição no meio da transação
+    authentication.invalidar_usuario(instance.pk)
+    transaction.on_commit(lambda: authentication.invalidar_usuario(instance.pk), using=kwargs.get('using'))
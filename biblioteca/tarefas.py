@@ -0,0 +1,334 @@
+import os
+import threading
+import time
+import traceback
+import uuid
+from datetime import timedelta
+from pathlib import Path
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import OperationalError, connections
+from django.db.models import F, Q
+from django.utils import timezone
+from biblioteca.models import Autor, Categoria, Livro, Tarefa
+from biblioteca import agregados, atrasos, exportacao, importacao, search
+
+# Progresso gravado no máximo uma vez por intervalo (segundos), para não disputar o banco com a própria tarefa
+INTERVALO_PROGRESSO = 1.0
+MAX_LINHAS_IMPORTACAO = 100_000
+MAX_REJEITADAS = 1000
+
+# tipo -> (função, validação dos parâmetros, só superusuário)
+TIPOS = {}
+
+
+class TarefaPerdida(Exception):
+    # A reserva venceu e outro worker pegou a tarefa: esta execução para sem gravar o resultado
+    pass
+
+
+class TarefaInvalida(Exception):
+    # A tarefa não tem como rodar (ex.: o criador foi excluído): falha de vez, sem novas tentativas
+    pass
+
+
+def configuracao(nome):
+    padroes = {'VISIBILIDADE': 300, 'TENTATIVAS': 3, 'BACKOFF': 10, 'BACKOFF_MAXIMO': 600}
+    return getattr(settings, f'BIBLIOTECA_TAREFAS_{nome}', padroes[nome])
+
+
+def diretorio():
+    pasta = Path(getattr(settings, 'BIBLIOTECA_TAREFAS_DIR', Path(settings.BASE_DIR) / 'arquivos_tarefas'))
+    pasta.mkdir(parents=True, exist_ok=True)
+    return pasta
+
+
+def tipo(nome, validar=None, superusuario=True):
+    def registrar(funcao):
+        TIPOS[nome] = (funcao, validar, superusuario)
+        return funcao
+    return registrar
+
+
+def pode_enfileirar(nome, usuario):
+    return nome in TIPOS and (usuario.is_superuser or not TIPOS[nome][2])
+
+
+def enfileirar(nome, parametros=None, criador=None, max_tentativas=None):
+    if nome not in TIPOS:
+        raise ValidationError({'tipo': ['Tipo de tarefa inválido.']})
+    parametros = parametros or {}
+    validar = TIPOS[nome][1]
+    if validar is not None:
+        parametros = validar(parametros)
+    return Tarefa.objects.create(
+        tipo=nome, parametros=parametros, criador=criador,
+        max_tentativas=max_tentativas or configuracao('TENTATIVAS'),
+    )
+
+
+def espera_para_nova_tentativa(tentativas):
+    # Backoff exponencial: BACKOFF, 2x, 4x... até BACKOFF_MAXIMO segundos
+    return min(configuracao('BACKOFF_MAXIMO'), configuracao('BACKOFF') * 2 ** max(tentativas - 1, 0))
+
+
+def _livres(agora):
+    return Q(estado=Tarefa.PENDENTE, disponivel_em__lte=agora) | Q(estado=Tarefa.EXECUTANDO, travada_ate__lt=agora)
+
+
+def reservar(worker='', visibilidade=None):
+    # Pega a próxima tarefa com um UPDATE condicional: se outro worker reservou antes, tenta a seguinte
+    visibilidade = visibilidade or configuracao('VISIBILIDADE')
+    agora = timezone.now()
+    candidatas = list(Tarefa.objects.filter(_livres(agora)).order_by('disponivel_em', 'id').values_list('id', flat=True)[:10])
+    for pk in candidatas:
+        reserva = uuid.uuid4().hex
+        reservada = Tarefa.objects.filter(_livres(agora), pk=pk).update(
+            estado=Tarefa.EXECUTANDO, reserva=reserva, worker=worker[:100], tentativas=F('tentativas') + 1,
+            travada_ate=agora + timedelta(seconds=visibilidade), iniciada_em=agora,
+        )
+        if reservada:
+            return Execucao(Tarefa.objects.get(pk=pk), visibilidade)
+    return None
+
+
+class Execucao:
+    # Uma tentativa de uma tarefa reservada por este worker; toda escrita confere a reserva
+    def __init__(self, tarefa, visibilidade):
+        self.tarefa = tarefa
+        self.visibilidade = visibilidade
+        self.ultimo_progresso = 0.0
+
+    def _atualizar(self, **campos):
+        return Tarefa.objects.filter(
+            pk=self.tarefa.pk, reserva=self.tarefa.reserva, estado=Tarefa.EXECUTANDO,
+        ).update(**campos) == 1
+
+    def renovar(self):
+        return self._atualizar(travada_ate=timezone.now() + timedelta(seconds=self.visibilidade))
+
+    def progresso(self, feito, total=None, mensagem=''):
+        agora = time.monotonic()
+        if agora - self.ultimo_progresso < INTERVALO_PROGRESSO and (total is None or feito < total):
+            return
+        self.ultimo_progresso = agora
+        campos = {'progresso': feito, 'mensagem': mensagem[:200], 'travada_ate': timezone.now() + timedelta(seconds=self.visibilidade)}
+        if total is not None:
+            campos['total'] = total
+        if not self._atualizar(**campos):
+            raise TarefaPerdida()
+
+    def concluir(self, resultado):
+        return self._atualizar(
+            estado=Tarefa.CONCLUIDA, resultado=resultado, erro='', reserva='', travada_ate=None, concluida_em=timezone.now(),
+        )
+
+    def falhar(self, erro, definitivo=False):
+        tarefa = self.tarefa
+        if definitivo or tarefa.tentativas >= tarefa.max_tentativas:
+            return self._atualizar(
+                estado=Tarefa.FALHOU, erro=erro, reserva='', travada_ate=None, concluida_em=timezone.now(),
+            )
+        return self._atualizar(
+            estado=Tarefa.PENDENTE, erro=erro, reserva='', travada_ate=None,
+            disponivel_em=timezone.now() + timedelta(seconds=espera_para_nova_tentativa(tarefa.tentativas)),
+        )
+
+
+class Batimento:
+    # Renova a reserva numa thread própria enquanto a tarefa roda, mesmo sem relatar progresso
+    def __init__(self, execucao):
+        self.execucao = execucao
+        self.parar = threading.Event()
+        self.thread = threading.Thread(target=self.bater, daemon=True)
+
+    def bater(self):
+        try:
+            while not self.parar.wait(self.execucao.visibilidade / 3):
+                try:
+                    self.execucao.renovar()
+                except OperationalError:
+                    pass  # banco ocupado pela própria tarefa: tenta no próximo batimento
+        finally:
+            connections.close_all()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.parar.set()
+        self.thread.join()
+
+
+def executar_proxima(worker='', visibilidade=None):
+    # Reserva e executa uma tarefa; devolve a tarefa (None se a fila estava vazia)
+    execucao = reservar(worker, visibilidade)
+    if execucao is None:
+        return None
+    tarefa = execucao.tarefa
+    if tarefa.tentativas > tarefa.max_tentativas:
+        # A reserva venceu na última tentativa: o worker caiu (ou travou) no meio da tarefa
+        execucao.falhar('O worker parou antes de concluir a tarefa.', definitivo=True)
+    elif tarefa.tipo not in TIPOS:
+        execucao.falhar(f'Tipo de tarefa desconhecido: {tarefa.tipo}.', definitivo=True)
+    else:
+        try:
+            with Batimento(execucao):
+                resultado = TIPOS[tarefa.tipo][0](tarefa, execucao)
+        except TarefaPerdida:
+            pass
+        except TarefaInvalida as exc:
+            execucao.falhar(str(exc), definitivo=True)
+        except Exception:
+            execucao.falhar(traceback.format_exc())
+        else:
+            execucao.concluir(resultado)
+    tarefa.refresh_from_db()
+    return tarefa
+
+
+def trabalhar(worker, parar, intervalo=1.0, visibilidade=None, ao_executar=None, uma_vez=False):
+    # Laço de um worker: executa até a fila esvaziar e espera `intervalo` segundos antes de olhar de novo
+    try:
+        while not parar.is_set():
+            tarefa = executar_proxima(worker, visibilidade)
+            if tarefa is not None:
+                if ao_executar is not None:
+                    ao_executar(tarefa)
+            elif uma_vez:
+                break
+            else:
+                parar.wait(intervalo)
+    finally:
+        connections.close_all()
+
+
+def arquivo_do_resultado(tarefa):
+    nome = (tarefa.resultado or {}).get('arquivo') if tarefa.estado == Tarefa.CONCLUIDA else None
+    return diretorio() / nome if nome else None
+
+
+# Tipos de tarefa
+
+def _validar_exportacao(parametros):
+    recurso = parametros.get('recurso')
+    formato = parametros.get('formato', 'csv')
+    filtros = parametros.get('filtros', {})
+    erros = {}
+    if recurso not in exportacao.RECURSOS:
+        erros['recurso'] = [f'Use um destes recursos: {", ".join(sorted(exportacao.RECURSOS))}.']
+    if formato not in exportacao.FORMATOS:
+        erros['formato'] = ['Use formato=csv ou formato=ndjson.']
+    if not isinstance(filtros, dict) or not all(isinstance(valor, str) for valor in filtros.values()):
+        erros['filtros'] = ['Os filtros devem ser um objeto com valores em texto.']
+    if erros:
+        raise ValidationError(erros)
+    return {'recurso': recurso, 'formato': formato, 'gzip': bool(parametros.get('gzip')), 'filtros': filtros}
+
+
+@tipo('exportar', validar=_validar_exportacao, superusuario=False)
+def exportar(tarefa, execucao):
+    parametros = tarefa.parametros
+    recurso, formato, gzip = parametros['recurso'], parametros['formato'], parametros['gzip']
+    # Mesma restrição da exportação pela API, pelo usuário que enfileirou a tarefa. Sem ele (excluído), usuario=None
+    # exportaria tudo, como no terminal
+    if tarefa.criador is None:
+        raise TarefaInvalida('O usuário que enfileirou a exportação foi excluído.')
+    total = exportacao.contar(recurso, parametros['filtros'], usuario=tarefa.criador)
+    execucao.progresso(0, total, 'Exportando')
+    lidas = [0]
+
+    def ao_ler(numero):
+        lidas[0] = numero
+        execucao.progresso(numero, total, 'Exportando')
+
+    nome = f'tarefa-{tarefa.pk}-{exportacao.nome_arquivo(recurso, formato, gzip)}'
+    # Escreve num temporário e renomeia: o arquivo do resultado só aparece completo
+    temporario = diretorio() / f'{nome}.{tarefa.reserva}.tmp'
+    tamanho = 0
+    try:
+        with open(temporario, 'wb') as arquivo:
+            for bloco in exportacao.exportar(
+                recurso, parametros['filtros'], formato=formato, gzip=gzip, ao_ler=ao_ler, usuario=tarefa.criador,
+            ):
+                arquivo.write(bloco)
+                tamanho += len(bloco)
+        os.replace(temporario, diretorio() / nome)
+    finally:
+        temporario.unlink(missing_ok=True)
+    return {
+        'arquivo': nome, 'linhas': lidas[0], 'bytes': tamanho,
+        'content_type': 'application/gzip' if gzip else exportacao.FORMATOS[formato],
+    }
+
+
+def _validar_importacao(parametros):
+    linhas = parametros.get('livros')
+    if not isinstance(linhas, list):
+        raise ValidationError({'livros': ['Envie uma lista de livros.']})
+    if len(linhas) > MAX_LINHAS_IMPORTACAO:
+        raise ValidationError({'livros': [f'Envie no máximo {MAX_LINHAS_IMPORTACAO} livros por tarefa.']})
+    return {'livros': linhas}
+
+
+@tipo('importar_livros', validar=_validar_importacao, superusuario=False)
+def importar_livros(tarefa, execucao):
+    # Cada lote da importação é uma transação: numa nova tentativa, as linhas já gravadas voltam como título repetido
+    if tarefa.criador is None:
+        # Livro.criador é obrigatório: sem isso, cada linha falharia no INSERT como título repetido
+        raise TarefaInvalida('O usuário que enfileirou a importação foi excluído.')
+    linhas = tarefa.parametros['livros']
+    criados, rejeitadas = 0, []
+    for resultado in importacao.importar_livros(linhas, criador=tarefa.criador):
+        if resultado['status'] == 'criado':
+            criados += 1
+        elif len(rejeitadas) < MAX_REJEITADAS:
+            rejeitadas.append(resultado)
+        execucao.progresso(resultado['linha'], len(linhas), 'Importando')
+    return {'criados': criados, 'erros': len(linhas) - criados, 'rejeitadas': rejeitadas}
+
+
+@tipo('reconstruir_atrasos')
+def reconstruir_atrasos(tarefa, execucao):
+    divergentes = atrasos.divergencias()
+    if divergentes:
+        atrasos.reconstruir()
+    return {'divergencias': len(divergentes)}
+
+
+@tipo('reconstruir_agregados')
+def reconstruir_agregados(tarefa, execucao):
+    divergentes = agregados.divergencias()
+    if divergentes:
+        agregados.reconstruir()
+    return {'divergencias': len(divergentes)}
+
+
+@tipo('reindex_livros')
+def reindex_livros(tarefa, execucao):
+    return {'livros': search.reconstruir_indice()}
+
+
+MODELOS_EXCLUSAO = {'livro': Livro, 'autor': Autor, 'categoria': Categoria}
+
+
+def _validar_exclusao(parametros):
+    modelo = parametros.get('modelo')
+    if modelo not in MODELOS_EXCLUSAO:
+        raise ValidationError({'modelo': ['Use modelo=livro, autor ou categoria.']})
+    if not isinstance(parametros.get('id'), int):
+        raise ValidationError({'id': ['O id deve ser um número inteiro.']})
+    return {'modelo': modelo, 'id': parametros['id']}
+
+
+@tipo('excluir', validar=_validar_exclusao)
+def excluir(tarefa, execucao):
+    # Autores e categorias levam os livros e empréstimos junto (CASCADE), com os sinais de cada um.
+    # Repetir a tarefa depois de excluir não faz nada
+    modelo = MODELOS_EXCLUSAO[tarefa.parametros['modelo']]
+    objeto = modelo.objects.filter(pk=tarefa.parametros['id']).first()
+    if objeto is None:
+        return {'excluidos': 0, 'por_modelo': {}}
+    total, por_modelo = objeto.delete()
+    return {'excluidos': total, 'por_modelo': por_modelo}
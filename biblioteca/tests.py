@@ -1,3 +1,1936 @@
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import closing, contextmanager
+from io import StringIO
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.models import Count
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
+from biblioteca import (
+    agregados, atrasos, authentication, autocomplete, benchmark, cache, emprestimos_lote, exportacao, importacao, metrics, routers, search, tarefas, throttling,
+)
+from biblioteca.serializers import CategoriaSerializer
+from biblioteca.views import ListagemRapidaMixin
+from biblioteca.pagination import ContagemEstimadaPaginator
+from biblioteca.models import (
+    AgregadoCatalogo, Autor, Categoria, Livro, Emprestimo, EmprestimosAbertos, LivroEmprestado, ResumoAtraso, Tarefa,
+    LIMITE_EMPRESTIMOS_ABERTOS, LIMITE_LIVROS_POR_CATEGORIA,
+)
 
-# Create your tests here.
+
+def criar_livros(criador, quantidade, prefixo='Livro'):
+    return [
+        Livro.objects.create(
+            titulo=f'{prefixo} {i:05}',
+            descricao='Descrição do livro para os testes.',
+            data_publicacao=datetime.date(2020, 1, 1),
+            criador=criador,
+        )
+        for i in range(quantidade)
+    ]
+
+
+# "SCAN tabela" sem "USING ... INDEX": o SQLite lê a tabela inteira
+VARREDURA_COMPLETA = re.compile(r'^SCAN (\w+)$')
+
+
+def varreduras_completas(queries, permitidas=()):
+    # Roda EXPLAIN QUERY PLAN em cada SELECT capturado e devolve as varreduras completas não permitidas
+    encontradas = []
+    with connection.cursor() as cursor:
+        for query in queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT'):
+                continue
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            plano = [linha[3] for linha in cursor.fetchall()]
+            # Com LIMIT e sem ordenar numa B-tree temporária, a varredura na ordem do índice para na página
+            if ' LIMIT ' in sql and 'USE TEMP B-TREE FOR ORDER BY' not in plano:
+                continue
+            for detalhe in plano:
+                varredura = VARREDURA_COMPLETA.match(detalhe)
+                if varredura and varredura.group(1) not in permitidas:
+                    encontradas.append(f'{varredura.group(1)}: {sql}')
+    return encontradas
+
+
+def emprestar(livro, usuario):
+    hoje = datetime.date.today()
+    return Emprestimo.objects.create(
+        livro=livro, usuario=usuario, data_inicio=hoje, data_prevista_devolucao=hoje + datetime.timedelta(days=7)
+    )
+
+
+@contextmanager
+def no_relogio(instante):
+    # time.time (Last-Modified) e timezone.now (updated_at) no mesmo instante
+    agora = datetime.datetime.fromtimestamp(instante, tz=datetime.timezone.utc)
+    with mock.patch('time.time', return_value=instante), mock.patch('django.utils.timezone.now', return_value=agora):
+        yield
+
+
+def dados_livro(titulo, **extras):
+    return {'titulo': titulo, 'descricao': 'Descrição do livro para os testes.', 'data_publicacao': '2020-01-01', **extras}
+
+
+class TituloUnicoTestCase(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin')
+        self.client.force_authenticate(self.admin)
+        self.categoria = Categoria.objects.create(nome='Romance')
+        self.autor = Autor.objects.create(nome='Machado de Assis', biografia='Biografia do autor.')
+        self.livro = self.criar('Dom  Casmurro')
+
+    def criar(self, titulo):
+        return Livro.objects.create(
+            titulo=titulo, descricao='Descrição do livro para os testes.', data_publicacao=datetime.date(2020, 1, 1),
+            categoria=self.categoria, autor=self.autor, criador=self.admin,
+        )
+
+    def dados(self, titulo):
+        return dados_livro(titulo, categoria_id=self.categoria.pk, autor_id=self.autor.pk)
+
+    def test_recusa_titulo_repetido_com_outras_maiusculas_e_espacos(self):
+        for titulo in ('Dom Casmurro', 'DOM CASMURRO', '  dom   casmurro '):
+            response = self.client.post('/api/livros/', self.dados(titulo), format='json')
+            self.assertEqual(response.status_code, 400, titulo)
+            self.assertEqual(response.data, {'non_field_errors': ['O titulo já está em uso!']})
+        self.assertEqual(Livro.objects.count(), 1)
+
+    def test_patch_mantem_o_proprio_titulo_e_recusa_o_de_outro(self):
+        outro = self.criar('Memórias Póstumas')
+        response = self.client.patch(f'/api/livros/{self.livro.pk}/', {'titulo': 'dom casmurro'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.patch(f'/api/livros/{outro.pk}/', {'titulo': 'Dom Casmurro'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Livro.objects.get(pk=outro.pk).titulo, 'Memórias Póstumas')
+
+    def test_uma_busca_pelo_titulo_por_cadastro(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/livros/', self.dados('Quincas Borba'), format='json')
+        self.assertEqual(response.status_code, 201)
+        buscas = [q['sql'] for q in queries if q['sql'].startswith('SELECT') and 'titulo_normalizado' in q['sql']]
+        self.assertEqual(len(buscas), 1)
+
+    def test_corrida_vira_400_pela_constraint(self):
+        # Sem a validação do full_clean, como quando outro cadastro entra entre a validação e o INSERT
+        with mock.patch.object(Livro, 'validate_constraints'):
+            response = self.client.post('/api/livros/', self.dados('dom casmurro'), format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'non_field_errors': ['O titulo já está em uso!']})
+        self.assertEqual(Livro.objects.count(), 1)
+
+
+class BuscaTextualTestCase(APITestCase):
+    def setUp(self):
+        admin = User.objects.create_superuser('admin')
+        romance = Categoria.objects.create(nome='Romance')
+        autor = Autor.objects.create(nome='José de Alencar', biografia='Biografia do autor.')
+        dados = {'data_publicacao': datetime.date(2020, 1, 1), 'categoria': romance, 'autor': autor, 'criador': admin}
+        self.no_titulo = Livro.objects.create(titulo='Coração de Pedra', descricao='Uma história de família.', **dados)
+        self.na_descricao = Livro.objects.create(titulo='Memórias', descricao='Fala de um coração partido.', **dados)
+        self.sem_termo = Livro.objects.create(titulo='Iracema', descricao='Lenda do Ceará.', **dados)
+
+    def buscar(self, termo):
+        response = self.client.get('/api/livros/', {'q': termo})
+        self.assertEqual(response.status_code, 200)
+        return [livro['id'] for livro in response.data['results']]
+
+    def test_sem_acentos_e_por_prefixo(self):
+        self.assertEqual(set(self.buscar('coracao')), {self.no_titulo.pk, self.na_descricao.pk})
+        self.assertEqual(self.buscar('CEAR'), [self.sem_termo.pk])
+        self.assertEqual(len(self.buscar('jose alencar')), 3)
+        self.assertEqual(self.buscar('"; DROP'), [])
+
+    def test_titulo_pesa_mais_que_a_descricao(self):
+        self.assertEqual(self.buscar('coração'), [self.no_titulo.pk, self.na_descricao.pk])
+
+    def test_rank_no_join_com_a_tabela_fts(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.buscar('coracao')
+        sql = queries[-1]['sql']
+        self.assertIn(f'INNER JOIN "{search.TABELA_BUSCA}"', sql)
+        self.assertEqual(sql.count('MATCH'), 1)
+
+    def test_sem_fts_usa_icontains(self):
+        with mock.patch.object(search, 'busca_disponivel', return_value=False):
+            self.assertEqual(set(self.buscar('Coração')), {self.no_titulo.pk, self.na_descricao.pk})
+            self.assertEqual(self.buscar('iracema ceará'), [self.sem_termo.pk])
+
+
+class PaginacaoCursorTestCase(APITestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.admin = User.objects.create_superuser('admin')
+        self.livros = criar_livros(self.admin, 7)
+
+    def percorrer(self, url):
+        paginas = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            paginas.append(response.data)
+            url = response.data['next']
+        return paginas
+
+    def test_next_e_previous_percorrem_pelo_id(self):
+        paginas = self.percorrer('/api/livros/?paginacao=cursor&page_size=3')
+        self.assertEqual([len(pagina['results']) for pagina in paginas], [3, 3, 1])
+        ids = [livro['id'] for pagina in paginas for livro in pagina['results']]
+        self.assertEqual(ids, sorted((livro.pk for livro in self.livros), reverse=True))
+        self.assertIsNone(paginas[0]['previous'])
+        anterior = self.client.get(paginas[-1]['previous']).data
+        self.assertEqual(anterior['results'], paginas[1]['results'])
+
+    def test_filtros_e_limite_do_page_size(self):
+        paginas = self.percorrer('/api/livros/?paginacao=cursor&page_size=2&titulo=livro 0000')
+        self.assertEqual(len([livro for pagina in paginas for livro in pagina['results']]), 7)
+        self.assertEqual(len(self.percorrer('/api/livros/?paginacao=cursor&titulo=00003')), 1)
+        Livro.objects.bulk_create([
+            Livro(titulo=f'Extra {i}', titulo_normalizado=f'extra {i}', criador=self.admin) for i in range(100)
+        ])
+        response = self.client.get('/api/livros/?paginacao=cursor&page_size=1000')
+        self.assertEqual(len(response.data['results']), 100)
+        self.assertIsNotNone(response.data['next'])
+
+    def test_uma_consulta_e_sem_count(self):
+        for url in ('/api/livros/?paginacao=cursor&page_size=3', '/api/livros/?paginacao=cursor&page_size=3&q=livro'):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(queries), 1)
+            self.assertNotIn('COUNT(', queries[0]['sql'])
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(response.data['next'])
+            self.assertEqual(len(queries), 1)
+
+    def test_emprestimos_por_cursor_sem_count(self):
+        leitor = User.objects.create_user('leitor')
+        for livro in self.livros[:4]:
+            emprestar(livro, leitor)
+        self.client.force_authenticate(self.admin)
+        self.assertIsInstance(self.client.get('/api/emprestimos/').data, list)
+        with CaptureQueriesContext(connection) as queries:
+            paginas = self.percorrer('/api/emprestimos/?paginacao=cursor&page_size=3')
+        self.assertEqual([len(pagina['results']) for pagina in paginas], [3, 1])
+        self.assertFalse([q['sql'] for q in queries if 'COUNT(' in q['sql']])
+
+
+class RespostaEmCacheTestCase(APITestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.admin = User.objects.create_superuser('admin')
+        self.categoria = Categoria.objects.create(nome='Romance')
+        self.autor = Autor.objects.create(nome='Machado de Assis', biografia='Biografia do autor.')
+        self.livro = Livro.objects.create(
+            titulo='Dom Casmurro', descricao='Descrição do livro para os testes.', data_publicacao=datetime.date(2020, 1, 1),
+            categoria=self.categoria, autor=self.autor, criador=self.admin,
+        )
+
+    def get(self, url, esperado):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Cache'], esperado, url)
+        return response.data
+
+    def test_escritas_invalidam_a_proxima_leitura(self):
+        rotas = ['/api/livros/', f'/api/livros/{self.livro.pk}/', '/api/categorias/', '/api/autores/']
+        for url in rotas:
+            self.get(url, 'MISS')
+            self.get(url, 'HIT')
+
+        self.client.force_authenticate(self.admin)
+        self.client.patch(f'/api/livros/{self.livro.pk}/', {'titulo': 'Dom Casmurro (2ª edição)'}, format='json')
+        self.client.force_authenticate(None)
+        self.assertEqual(self.get(f'/api/livros/{self.livro.pk}/', 'MISS')['titulo'], 'Dom Casmurro (2ª edição)')
+        self.assertEqual(self.get('/api/categorias/', 'MISS')[0]['livros_count'], 1)
+        self.get('/api/autores/', 'HIT')
+
+        self.categoria.nome = 'Romances'
+        self.categoria.save()
+        self.assertEqual(self.get('/api/livros/', 'MISS')['results'][0]['categoria_nome'], 'Romances')
+        self.assertEqual(self.get('/api/categorias/', 'MISS')[0]['nome'], 'Romances')
+
+        self.autor.delete()
+        self.assertEqual(self.get('/api/autores/', 'MISS'), [])
+        self.assertEqual(self.get('/api/livros/', 'MISS')['count'], 0)
+        self.assertEqual(self.client.get(f'/api/livros/{self.livro.pk}/').status_code, 404)
+
+    def test_importacao_em_lote_invalida(self):
+        self.get('/api/livros/', 'MISS')
+        self.get('/api/categorias/', 'MISS')
+        self.client.force_authenticate(self.admin)
+        response = self.client.post('/api/livros/bulk/', [
+            dados_livro('Quincas Borba', categoria_id=self.categoria.pk, autor_id=self.autor.pk),
+        ], format='json')
+        self.assertEqual(response.data['criados'], 1)
+        self.assertEqual(self.get('/api/livros/', 'MISS')['count'], 2)
+        self.assertEqual(self.get('/api/categorias/', 'MISS')[0]['livros_count'], 2)
+
+    def test_chave_por_parametros_e_a_mesma_para_todos_os_usuarios(self):
+        self.get('/api/livros/?titulo=dom&page_size=10', 'MISS')
+        self.get('/api/livros/?page_size=10&titulo=dom', 'HIT')
+        self.get('/api/livros/?page_size=10&titulo=dom&autor=', 'HIT')
+        self.assertEqual(self.get('/api/livros/?titulo=memorias&page_size=10', 'MISS')['count'], 0)
+        # As leituras do catálogo são públicas e não dependem do usuário: anônimos e autenticados dividem a entrada
+        self.client.force_authenticate(self.admin)
+        self.get('/api/livros/?titulo=dom&page_size=10', 'HIT')
+
+
+class RespostaCondicionalTestCase(APITestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.admin = User.objects.create_superuser('admin', first_name='Ana')
+        self.autor = Autor.objects.create(nome='Machado de Assis', biografia='Biografia do autor.')
+        criar_livros(self.admin, 3)
+        # Relógio à frente das escritas do setUp: o segundo delas já terminou
+        self.inicio = time.time() + 10
+
+    def no_relogio(self, segundos):
+        return no_relogio(self.inicio + segundos)
+
+    def test_if_none_match_responde_304_so_com_a_agregacao(self):
+        response = self.client.get('/api/autores/')
+        self.assertEqual(response.status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/autores/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('MAX(', queries[0]['sql'])
+        self.assertNotEqual(self.client.get('/api/autores/?nome_autor=machado')['ETag'], response['ETag'])
+
+    def test_validadores_vem_do_banco_e_nao_do_cache(self):
+        # Outro processo não compartilha o cache em memória: a escrita dele só aparece pelo banco
+        response = self.client.get('/api/autores/')
+        Autor.objects.filter(pk=self.autor.pk).update(nome='Machado', updated_at=timezone.now())
+        cache.get_cache().clear()
+        self.assertEqual(self.client.get('/api/autores/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+        response = self.client.get('/api/autores/')
+        self.autor.delete()
+        cache.get_cache().clear()
+        self.assertEqual(self.client.get('/api/autores/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_escrita_muda_etag_e_last_modified(self):
+        with self.no_relogio(0):
+            primeira = self.client.get(f'/api/autores/{self.autor.pk}/')
+        self.assertIn('Last-Modified', primeira)
+        with self.no_relogio(1):
+            response = self.client.get(f'/api/autores/{self.autor.pk}/', HTTP_IF_MODIFIED_SINCE=primeira['Last-Modified'])
+            self.assertEqual(response.status_code, 304)
+            self.autor.nome = 'Machado'
+            self.autor.save()
+        with self.no_relogio(3):
+            response = self.client.get(f'/api/autores/{self.autor.pk}/', HTTP_IF_MODIFIED_SINCE=primeira['Last-Modified'])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['nome'], 'Machado')
+            response = self.client.get(f'/api/autores/{self.autor.pk}/', HTTP_IF_NONE_MATCH=primeira['ETag'])
+            self.assertEqual(response.status_code, 200)
+
+    def test_sem_last_modified_no_segundo_da_escrita(self):
+        with self.no_relogio(0):
+            self.autor.save()
+            response = self.client.get('/api/autores/')
+        self.assertNotIn('Last-Modified', response)
+        self.assertIn('ETag', response)
+
+    def test_usuario_renomeado_muda_o_last_modified_dos_livros(self):
+        with self.no_relogio(0):
+            primeira = self.client.get('/api/livros/')
+        with self.no_relogio(1):
+            self.admin.first_name = 'Beatriz'
+            self.admin.save()
+        with self.no_relogio(3):
+            response = self.client.get('/api/livros/', HTTP_IF_MODIFIED_SINCE=primeira['Last-Modified'])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['results'][0]['criador_nome'].startswith('Beatriz'))
+
+
+class ImportacaoLivrosTestCase(TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.admin = User.objects.create_superuser('admin')
+        self.categoria = Categoria.objects.create(nome='Romance')
+        self.autor = Autor.objects.create(nome='Machado de Assis', biografia='Biografia do autor.')
+        Livro.objects.create(
+            titulo='Dom Casmurro', descricao='Descrição do livro para os testes.', data_publicacao=datetime.date(2020, 1, 1),
+            categoria=self.categoria, criador=self.admin,
+        )
+
+    def importar(self, linhas, **kwargs):
+        return list(importacao.importar_livros(linhas, self.admin, **kwargs))
+
+    def linha(self, titulo, **extras):
+        return dados_livro(titulo, **{'autor_id': self.autor.pk, 'categoria_id': self.categoria.pk, **extras})
+
+    def erros(self, resultados):
+        return {resultado['linha']: sorted(resultado['erros']) for resultado in resultados if resultado['status'] == 'erro'}
+
+    def test_rejeita_so_as_linhas_invalidas(self):
+        resultados = self.importar([
+            self.linha('Quincas Borba', autor_id=None, autor_nome='Machado de Assis'),
+            self.linha('Sem data', data_publicacao='03/02/2001'),
+            {'titulo': 'Sem descrição', 'data_publicacao': '2001-02-03'},
+            self.linha('Autor inexistente', autor_id=9999),
+            self.linha('  DOM casmurro '),
+            self.linha('Helena', categoria_id='', categoria_nome='Romance'),
+            self.linha('helena'),
+            'não é um objeto',
+            dados_livro('Sem autor', categoria_id=self.categoria.pk),
+            dados_livro('Sem autor nem categoria'),
+        ])
+        self.assertEqual([r['linha'] for r in resultados], list(range(1, 11)))
+        self.assertEqual(self.erros(resultados), {
+            2: ['data_publicacao'], 3: ['missing_fields'], 4: ['autor'], 5: ['titulo'], 7: ['titulo'], 8: ['linha'],
+            9: ['autor'], 10: ['autor', 'categoria'],
+        })
+        # As mesmas regras do cadastro pela API
+        self.assertEqual(resultados[8]['erros'], {'autor': ['O autor é obrigatório.']})
+        self.assertEqual(Livro.objects.get(pk=resultados[0]['id']).autor, self.autor)
+        self.assertEqual(Livro.objects.get(pk=resultados[5]['id']).categoria, self.categoria)
+        self.assertEqual(Livro.objects.count(), 3)
+
+    def test_integrity_error_insere_linha_a_linha(self):
+        aplicar = importacao._aplicar_limite_categorias
+
+        def cadastrar_no_meio(validos, resultados):
+            # Outro processo cadastra um dos títulos entre a validação e o INSERT
+            aceitos = aplicar(validos, resultados)
+            Livro.objects.create(
+                titulo='Helena', descricao='Descrição do livro para os testes.', data_publicacao=datetime.date(2020, 1, 1),
+                criador=self.admin,
+            )
+            return aceitos
+
+        linhas = [self.linha(titulo) for titulo in ('Quincas Borba', 'Helena', 'Iaiá Garcia')]
+        with mock.patch.object(importacao, '_aplicar_limite_categorias', cadastrar_no_meio):
+            resultados = self.importar(linhas)
+        self.assertEqual([r['status'] for r in resultados], ['criado', 'erro', 'criado'])
+        self.assertEqual(resultados[1]['erros'], {'titulo': ['O titulo já está em uso!']})
+        # A vaga reservada para a linha recusada volta para a categoria
+        self.assertEqual(Categoria.objects.get(pk=self.categoria.pk).livros_count, 3)
+
+    def test_limite_da_categoria_vale_para_o_lote_e_entre_lotes(self):
+        Categoria.objects.filter(pk=self.categoria.pk).update(livros_count=LIMITE_LIVROS_POR_CATEGORIA - 3)
+        linhas = [self.linha(f'Importado {i}') for i in range(3)]
+        resultados = self.importar(linhas)
+        resultados += self.importar([self.linha(f'Outro {i}') for i in range(2)], tamanho_lote=1)
+        self.assertEqual([r['status'] for r in resultados], ['criado'] * 3 + ['erro'] * 2)
+        self.assertEqual(self.erros(resultados[3:]), {1: ['categoria'], 2: ['categoria']})
+        self.assertEqual(Categoria.objects.get(pk=self.categoria.pk).livros_count, LIMITE_LIVROS_POR_CATEGORIA)
+
+    def test_atualiza_busca_agregados_autocomplete_e_cache(self):
+        versao = cache.versoes([Livro])[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            resultados = self.importar([self.linha('Quincas Borba')])
+        pk = resultados[0]['id']
+        self.assertEqual(list(search.filtrar_livros(Livro.objects.all(), 'quincas').values_list('pk', flat=True)), [pk])
+        self.assertEqual(AgregadoCatalogo.objects.get(tipo='autor', chave=self.autor.pk).valor, 1)
+        self.assertEqual(agregados.divergencias(), [])
+        self.assertIn(pk, [livro for livro, _, _ in autocomplete.indice.buscar('quinc', 10, tipos=('livros',))['livros']])
+        self.assertGreater(cache.versoes([Livro])[0], versao)
+
+    def test_comando_le_csv_e_ndjson(self):
+        with tempfile.TemporaryDirectory() as pasta:
+            csv_path = os.path.join(pasta, 'livros.csv')
+            with open(csv_path, 'w', encoding='utf-8') as arquivo:
+                arquivo.write('titulo,descricao,data_publicacao,categoria_nome,autor_nome\n')
+                arquivo.write('Quincas Borba,Descrição do livro para os testes.,2001-02-03,Romance,Machado de Assis\n')
+                arquivo.write('Dom Casmurro,Descrição do livro para os testes.,2001-02-03,Romance,Machado de Assis\n')
+            ndjson_path = os.path.join(pasta, 'livros.ndjson')
+            with open(ndjson_path, 'w', encoding='utf-8') as arquivo:
+                arquivo.write(json.dumps(self.linha('Helena')) + '\n')
+                arquivo.write('{quebrado\n')
+            saida = StringIO()
+            call_command('import_livros', csv_path, '--criador', 'admin', stdout=saida)
+            call_command('import_livros', ndjson_path, '--criador', 'admin', '--lote', '1', stdout=saida)
+        self.assertIn('1 livros importados, 1 linhas com erro.', saida.getvalue())
+        self.assertIn('O titulo já está em uso!', saida.getvalue())
+        self.assertEqual(set(Livro.objects.values_list('titulo', flat=True)), {'Dom Casmurro', 'Quincas Borba', 'Helena'})
+
+
+class ContadorCategoriaTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin')
+        self.categoria = Categoria.objects.create(nome='Romance')
+
+    def criar(self, titulo):
+        return Livro.objects.create(
+            titulo=titulo, descricao='Descrição do livro para os testes.', data_publicacao=datetime.date(2020, 1, 1),
+            categoria=self.categoria, criador=self.admin,
+        )
+
+    def contador(self):
+        return Categoria.objects.get(pk=self.categoria.pk).livros_count
+
+    def test_save_depois_de_reservar_nao_sobrescreve_o_contador(self):
+        carregada = Categoria.objects.get(pk=self.categoria.pk)
+        self.criar('Dom Casmurro')
+        carregada.nome = 'Romances'
+        carregada.save()
+        self.assertEqual(self.contador(), 1)
+        self.assertEqual(carregada.livros_count, 1)
+        carregada.save(update_fields=['nome', 'livros_count'])
+        self.assertEqual(self.contador(), 1)
+
+    def test_patch_pelo_serializer_nao_sobrescreve_o_contador(self):
+        carregada = Categoria.objects.get(pk=self.categoria.pk)
+        self.criar('Dom Casmurro')
+        self.criar('Quincas Borba')
+        serializer = CategoriaSerializer(carregada, data={'nome': 'Romances'}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        self.assertEqual(self.contador(), 2)
+        self.assertEqual(serializer.data['livros_count'], 2)
+
+    def test_limite_depois_de_um_save_desatualizado(self):
+        Categoria.objects.filter(pk=self.categoria.pk).update(livros_count=LIMITE_LIVROS_POR_CATEGORIA - 1)
+        carregada = Categoria.objects.get(pk=self.categoria.pk)
+        self.criar('Dom Casmurro')
+        carregada.save()
+        with self.assertRaises(ValidationError):
+            self.criar('Quincas Borba')
+        self.assertEqual(self.contador(), LIMITE_LIVROS_POR_CATEGORIA)
+
+    def test_comando_reconcilia_o_contador(self):
+        self.criar('Dom Casmurro')
+        self.criar('Quincas Borba')
+        vazia = Categoria.objects.create(nome='Poesia')
+        Categoria.objects.filter(pk=self.categoria.pk).update(livros_count=7)
+        Categoria.objects.filter(pk=vazia.pk).update(livros_count=3)
+        saida = StringIO()
+        call_command('reconcile_livros_count', '--dry-run', stdout=saida)
+        self.assertIn('Romance (id', saida.getvalue())
+        self.assertIn('2 categorias encontradas.', saida.getvalue())
+        self.assertEqual(self.contador(), 7)
+        call_command('reconcile_livros_count', stdout=StringIO())
+        self.assertEqual(self.contador(), 2)
+        self.assertEqual(Categoria.objects.get(pk=vazia.pk).livros_count, 0)
+
+
+class ContadorCategoriaConcorrenteTestCase(TransactionTestCase):
+    # Cadastros e exclusões em paralelo, cada thread com a sua conexão, no SQLite em modo WAL
+    threads = 8
+
+    def setUp(self):
+        if connection.vendor != 'sqlite' or connection.is_in_memory_db():
+            self.skipTest('O teste de concorrência precisa de um banco SQLite em arquivo.')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA busy_timeout=20000')
+        self.admin = User.objects.create_superuser('admin')
+        self.categoria = Categoria.objects.create(nome='Romance')
+
+    def em_paralelo(self, funcoes):
+        barreira = threading.Barrier(len(funcoes))
+
+        def executar(funcao):
+            try:
+                with connections['default'].cursor() as cursor:
+                    cursor.execute('PRAGMA busy_timeout=20000')
+                barreira.wait()
+                funcao()
+                return True
+            except ValidationError:
+                return False
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=len(funcoes)) as executor:
+            return list(executor.map(executar, funcoes))
+
+    def cadastrar(self, titulo):
+        return lambda: Livro.objects.create(
+            titulo=titulo, descricao='Descrição do livro para os testes.', data_publicacao=datetime.date(2020, 1, 1),
+            categoria_id=self.categoria.pk, criador=self.admin,
+        )
+
+    def test_reservas_em_paralelo_respeitam_o_limite(self):
+        Categoria.objects.filter(pk=self.categoria.pk).update(livros_count=LIMITE_LIVROS_POR_CATEGORIA - 3)
+        resultados = self.em_paralelo([self.cadastrar(f'Livro {i}') for i in range(self.threads)])
+        self.assertEqual(resultados.count(True), 3)
+        self.assertEqual(Livro.objects.filter(categoria=self.categoria).count(), 3)
+        self.assertEqual(Categoria.objects.get(pk=self.categoria.pk).livros_count, LIMITE_LIVROS_POR_CATEGORIA)
+
+    def test_reservas_liberacoes_e_saves_em_paralelo(self):
+        livros = [self.cadastrar(f'Antigo {i}')() for i in range(self.threads)]
+        renomear = Categoria.objects.get(pk=self.categoria.pk)
+
+        def salvar_categoria():
+            renomear.nome = 'Romances'
+            renomear.save()
+
+        funcoes = [livro.delete for livro in livros[:4]] + [self.cadastrar(f'Novo {i}') for i in range(3)] + [salvar_categoria]
+        self.assertEqual(self.em_paralelo(funcoes), [True] * len(funcoes))
+        categoria = Categoria.objects.get(pk=self.categoria.pk)
+        self.assertEqual(categoria.nome, 'Romances')
+        self.assertEqual(categoria.livros_count, Livro.objects.filter(categoria=self.categoria).count())
+        self.assertEqual(categoria.livros_count, self.threads - 4 + 3)
+
+
+class ExportacaoTestCase(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', password='senha')
+        self.staff = User.objects.create_user('balcao', is_staff=True)
+        livros = criar_livros(self.admin, 3)
+        self.do_staff = emprestar(livros[0], self.staff)
+        self.outros = [emprestar(livros[1], self.admin), emprestar(livros[2], User.objects.create_user('leitor'))]
+
+    def baixar(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content)
+
+    def test_staff_exporta_so_os_proprios_emprestimos(self):
+        self.client.force_authenticate(self.staff)
+        _, conteudo = self.baixar('/api/exportar/emprestimos/?formato=ndjson&usuario=leitor')
+        linhas = [json.loads(linha) for linha in conteudo.decode().splitlines()]
+        self.assertEqual([linha['id'] for linha in linhas], [self.do_staff.pk])
+        self.assertEqual(exportacao.contar('emprestimos', {}, usuario=self.staff), 1)
+
+        # Superusuário vê todos e o filtro ?usuario= continua valendo
+        self.client.force_authenticate(self.admin)
+        _, conteudo = self.baixar('/api/exportar/emprestimos/?formato=ndjson')
+        self.assertEqual(len(conteudo.decode().splitlines()), 3)
+        _, conteudo = self.baixar('/api/exportar/emprestimos/?formato=ndjson&usuario=leitor')
+        self.assertEqual([json.loads(linha)['id'] for linha in conteudo.decode().splitlines()], [self.outros[1].pk])
+
+    def test_tarefa_de_exportacao_do_staff_tambem_e_restrita(self):
+        pasta = tempfile.TemporaryDirectory()
+        self.addCleanup(pasta.cleanup)
+        with override_settings(BIBLIOTECA_TAREFAS_DIR=pasta.name):
+            tarefas.enfileirar('exportar', {'recurso': 'emprestimos', 'formato': 'csv', 'gzip': False, 'filtros': {}}, criador=self.staff)
+            tarefa = tarefas.executar_proxima('teste')
+        self.assertEqual((tarefa.estado, tarefa.total, tarefa.resultado['linhas']), ('concluida', 1, 1))
+
+        # Sem o criador não há como restringir: a tarefa falha em vez de exportar tudo
+        with override_settings(BIBLIOTECA_TAREFAS_DIR=pasta.name):
+            tarefas.enfileirar('exportar', {'recurso': 'emprestimos', 'formato': 'csv'}, criador=self.staff)
+            self.staff.delete()
+            tarefa = tarefas.executar_proxima('teste')
+        self.assertEqual((tarefa.estado, tarefa.erro), ('falhou', 'O usuário que enfileirou a exportação foi excluído.'))
+
+    def test_csv_ndjson_e_gzip_em_fluxo(self):
+        self.client.force_authenticate(self.admin)
+        response, conteudo = self.baixar('/api/exportar/livros/')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], exportacao.FORMATOS['csv'])
+        self.assertIn('filename="livros.csv"', response['Content-Disposition'])
+        linhas = list(csv.reader(io.StringIO(conteudo.decode())))
+        self.assertEqual(linhas[0], exportacao.RECURSOS['livros'][1])
+        self.assertEqual([linha[1] for linha in linhas[1:]], ['Livro 00002', 'Livro 00001', 'Livro 00000'])
+
+        response, conteudo = self.baixar('/api/exportar/livros/?formato=ndjson&gzip=true')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        linhas = [json.loads(linha) for linha in gzip.decompress(conteudo).decode().splitlines()]
+        self.assertEqual([linha['titulo'] for linha in linhas], ['Livro 00002', 'Livro 00001', 'Livro 00000'])
+        self.assertEqual(linhas[0]['data_publicacao'], '2020-01-01')
+
+        # Vários blocos: a saída em fluxo não perde nem repete linhas entre um chunk e outro
+        with mock.patch.object(exportacao, 'TAMANHO_BLOCO', 100):
+            blocos = list(exportacao.exportar('livros', {}, chunk_size=2))
+        self.assertGreater(len(blocos), 1)
+        self.assertEqual(len(b''.join(blocos).decode().splitlines()), 4)
+
+        self.assertEqual(self.client.get('/api/exportar/livros/?formato=xml').status_code, 400)
+        self.assertEqual(self.client.get('/api/exportar/nada/').status_code, 404)
+
+
+class EmprestimoCheckoutTestCase(TestCase):
+    def setUp(self):
+        self.usuario = User.objects.create_user('leitor')
+        self.livros = criar_livros(self.usuario, 7)
+
+    def test_nao_empresta_o_mesmo_livro_duas_vezes(self):
+        emprestar(self.livros[0], self.usuario)
+        outro = User.objects.create_user('outro')
+        with self.assertRaises(ValidationError):
+            emprestar(self.livros[0], outro)
+        self.assertFalse(EmprestimosAbertos.objects.filter(usuario=outro, quantidade__gt=0).exists())
+
+    def test_limite_de_emprestimos_abertos(self):
+        for livro in self.livros[:LIMITE_EMPRESTIMOS_ABERTOS]:
+            emprestar(livro, self.usuario)
+        with self.assertRaises(ValidationError):
+            emprestar(self.livros[LIMITE_EMPRESTIMOS_ABERTOS], self.usuario)
+
+    def test_devolucao_libera_livro_e_vaga(self):
+        emprestimo = emprestar(self.livros[0], self.usuario)
+        emprestimo = Emprestimo.objects.get(pk=emprestimo.pk)
+        emprestimo.devolvido = True
+        emprestimo.save()
+        self.assertFalse(LivroEmprestado.objects.filter(livro=self.livros[0]).exists())
+        self.assertEqual(EmprestimosAbertos.objects.get(usuario=self.usuario).quantidade, 0)
+        emprestar(self.livros[0], self.usuario)
+
+    def test_checkout_sem_count(self):
+        emprestar(self.livros[0], self.usuario)
+        with CaptureQueriesContext(connection) as queries:
+            emprestar(self.livros[1], self.usuario)
+        self.assertFalse([q['sql'] for q in queries if 'COUNT(' in q['sql']])
+
+
+class CamposDinamicosTestCase(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', first_name='Admin', last_name='Teste')
+        self.client.force_authenticate(self.admin)
+
+    def criar_catalogo(self, quantidade, inicio=0):
+        for i in range(inicio, inicio + quantidade):
+            autor = Autor.objects.create(nome=f'Autor {i}', biografia='Biografia do autor.')
+            categoria = Categoria.objects.create(nome=f'Categoria {i}')
+            livro = Livro.objects.create(
+                titulo=f'Livro {i:05}', descricao='Descrição do livro para os testes.',
+                data_publicacao=datetime.date(2020, 1, 1), autor=autor, categoria=categoria, criador=self.admin,
+            )
+            leitor = User.objects.create_user(f'leitor{i}')
+            emprestar(livro, leitor)
+
+    def contar_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.data
+
+    def test_emprestimos_expandidos_com_queries_constantes(self):
+        url = '/api/emprestimos/?expand=livro,usuario'
+        self.criar_catalogo(2)
+        poucos, dados = self.contar_queries(url)
+        self.criar_catalogo(6, inicio=2)
+        muitos, dados = self.contar_queries(url)
+        self.assertEqual(poucos, muitos)
+        self.assertEqual(set(dados[0]['livro']), {'id', 'titulo'})
+        self.assertEqual(set(dados[0]['usuario']), {'id', 'username', 'first_name', 'last_name'})
+
+    def test_livros_expandidos_com_queries_constantes(self):
+        url = '/api/livros/?fields=id,titulo,autor,categoria&expand=autor,categoria'
+        self.criar_catalogo(2)
+        poucos, _ = self.contar_queries(url)
+        self.criar_catalogo(10, inicio=2)
+        muitos, dados = self.contar_queries(url)
+        self.assertEqual(poucos, muitos)
+        self.assertEqual(set(dados['results'][0]), {'id', 'titulo', 'autor', 'categoria'})
+
+    def test_fields_carrega_so_as_colunas_pedidas(self):
+        self.criar_catalogo(1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/livros/?fields=id,titulo')
+        self.assertEqual(response.data['results'][0], {'id': 1, 'titulo': 'Livro 00000'})
+        sql = queries[-1]['sql']
+        self.assertNotIn('descricao', sql)
+        self.assertNotIn('JOIN', sql)
+
+
+class EmprestimoConcorrenteTestCase(TransactionTestCase):
+    # Checkouts em paralelo, cada thread com a sua conexão, no SQLite em modo WAL
+    threads = 8
+
+    def setUp(self):
+        if connection.vendor != 'sqlite' or connection.is_in_memory_db():
+            self.skipTest('O teste de concorrência precisa de um banco SQLite em arquivo.')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA busy_timeout=20000')
+        self.usuario = User.objects.create_user('leitor')
+
+    def checkouts_em_paralelo(self, pares):
+        barreira = threading.Barrier(len(pares))
+
+        def tentar(par):
+            livro, usuario = par
+            try:
+                with connections['default'].cursor() as cursor:
+                    cursor.execute('PRAGMA busy_timeout=20000')
+                barreira.wait()
+                emprestar(livro, usuario)
+                return True
+            except ValidationError:
+                return False
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=len(pares)) as executor:
+            return list(executor.map(tentar, pares))
+
+    def test_mesmo_livro_em_paralelo(self):
+        livro = criar_livros(self.usuario, 1)[0]
+        usuarios = [User.objects.create_user(f'leitor{i}') for i in range(self.threads)]
+        resultados = self.checkouts_em_paralelo([(livro, usuario) for usuario in usuarios])
+        self.assertEqual(resultados.count(True), 1)
+        self.assertEqual(Emprestimo.objects.filter(livro=livro, devolvido=False).count(), 1)
+
+    def test_limite_do_usuario_em_paralelo(self):
+        livros = criar_livros(self.usuario, self.threads)
+        resultados = self.checkouts_em_paralelo([(livro, self.usuario) for livro in livros])
+        self.assertEqual(resultados.count(True), LIMITE_EMPRESTIMOS_ABERTOS)
+        self.assertEqual(Emprestimo.objects.filter(usuario=self.usuario, devolvido=False).count(), LIMITE_EMPRESTIMOS_ABERTOS)
+        self.assertEqual(EmprestimosAbertos.objects.get(usuario=self.usuario).quantidade, LIMITE_EMPRESTIMOS_ABERTOS)
+
+
+class BenchmarkTestCase(TestCase):
+    # Escala pequena: só os orçamentos de queries, já que a latência depende da máquina
+    def test_endpoints_dentro_do_orcamento_de_queries(self):
+        admin = benchmark.semear('mini', seed=7)
+        resultados = benchmark.medir(admin, repeticoes=3, seed=7)
+        self.assertEqual(set(resultados), set(benchmark.ORCAMENTOS_PADRAO))
+        self.assertEqual(benchmark.verificar_orcamentos(resultados, latencia=False), [])
+
+    def test_dados_gerados_mantem_contadores_coerentes(self):
+        benchmark.semear('mini', seed=7)
+        for categoria in Categoria.objects.annotate(total=Count('livros')):
+            self.assertEqual(categoria.livros_count, categoria.total)
+            self.assertLessEqual(categoria.total, LIMITE_LIVROS_POR_CATEGORIA)
+        abertos = Emprestimo.objects.filter(devolvido=False)
+        self.assertEqual(LivroEmprestado.objects.count(), abertos.count())
+        for item in abertos.values('usuario').annotate(total=Count('id')):
+            self.assertEqual(EmprestimosAbertos.objects.get(usuario=item['usuario']).quantidade, item['total'])
+
+
+class MetricasTestCase(TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        Categoria.objects.create(nome='Romance')
+        self.registro = metrics.Registro()
+        patch = mock.patch.object(metrics, 'registro', self.registro)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_histograma_acumula_os_buckets(self):
+        histograma = metrics.Histograma('teste', 'Teste.', (1, 5))
+        for valor in (0.5, 1, 3, 10):
+            histograma.observar(('rota',), valor)
+        self.assertEqual(histograma.exportar(('rota',))[2:], [
+            'teste_bucket{rota="rota",le="1"} 2',
+            'teste_bucket{rota="rota",le="5"} 3',
+            'teste_bucket{rota="rota",le="+Inf"} 4',
+            'teste_sum{rota="rota"} 14.5',
+            'teste_count{rota="rota"} 4',
+        ])
+
+    def test_contador_de_queries(self):
+        contador = metrics.ContadorQueries()
+        with connection.execute_wrapper(contador):
+            Categoria.objects.count()
+            list(Categoria.objects.all())
+        self.assertEqual(contador.quantidade, 2)
+        self.assertGreater(contador.tempo, 0)
+
+    def test_middleware_sincrono(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get('/api/categorias/').status_code, 200)
+        self.assertEqual(self.registro.requisicoes.series, {('api-categoria-list', 'GET', '200'): 1})
+        self.assertEqual(self.registro.total_queries.series[('api-categoria-list', 'GET')], len(queries))
+        contagens, _ = self.registro.tamanho.series[('api-categoria-list', 'GET')]
+        self.assertEqual(sum(contagens), 1)
+
+    async def test_middleware_assincrono(self):
+        response = await self.async_client.get('/api/async/categorias/')
+        self.assertEqual(response.status_code, 200)
+        rotulos = ('api-async-categoria-list', 'GET')
+        self.assertEqual(self.registro.requisicoes.series, {(*rotulos, '200'): 1})
+        # As consultas das views assíncronas (sync_to_async) também entram na conta
+        self.assertGreater(self.registro.total_queries.series[rotulos], 0)
+
+    def test_endpoint_so_abre_com_token_ou_ip(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with override_settings(BIBLIOTECA_METRICS_TOKEN='segredo'):
+            self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer errado'}).status_code, 403)
+            response = self.client.get('/metrics', headers={'Authorization': 'Bearer segredo'})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('biblioteca_http_requests_total{rota="metrics",metodo="GET",status="403"} 2', response.content.decode())
+        with override_settings(BIBLIOTECA_METRICS_IPS=['10.0.0.1']):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 200)
+
+
+class LeituraAssincronaTestCase(TestCase):
+    # As views assíncronas devolvem o mesmo corpo das ViewSets síncronas (a não ser pelos links)
+    @classmethod
+    def setUpTestData(cls):
+        benchmark.semear('mini', seed=3)
+
+    def setUp(self):
+        cache.get_cache().clear()
+
+    def comparar(self, rota):
+        sincrona = self.client.get(f'/api/{rota}')
+        assincrona = self.client.get(f'/api/async/{rota}')
+        self.assertEqual(sincrona.status_code, assincrona.status_code)
+        self.assertEqual(sincrona.content, assincrona.content.replace(b'/api/async/', b'/api/'))
+        return assincrona
+
+    def test_listagens_iguais_as_sincronas(self):
+        livro = Livro.objects.order_by('id').first()
+        for rota in (
+            'livros/', 'livros/?page=3&page_size=20', 'livros/?q=amor', 'livros/?paginacao=cursor',
+            'livros/?fields=id,titulo&expand=autor', f'livros/?titulo={livro.titulo[:4]}',
+            'autores/', 'autores/?nome_autor=1', 'categorias/',
+        ):
+            with self.subTest(rota=rota):
+                self.assertEqual(self.comparar(rota).status_code, 200)
+
+    def test_detalhes_e_erros_iguais_aos_sincronos(self):
+        livro = Livro.objects.order_by('id').first()
+        self.assertEqual(self.comparar(f'livros/{livro.pk}/').status_code, 200)
+        self.assertEqual(self.comparar(f'autores/{livro.autor_id}/').status_code, 200)
+        self.assertEqual(self.comparar('livros/999999/').status_code, 404)
+        self.assertEqual(self.comparar('livros/abc/').status_code, 404)
+        self.assertEqual(self.comparar('livros/?page=999').status_code, 404)
+
+    async def test_etag_e_cache_no_caminho_assincrono(self):
+        response = await self.async_client.get('/api/async/categorias/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        condicional = await self.async_client.get('/api/async/categorias/', headers={'If-None-Match': response['ETag']})
+        self.assertEqual(condicional.status_code, 304)
+        self.assertEqual((await self.async_client.get('/api/async/categorias/'))['X-Cache'], 'HIT')
+
+
+class ListagemRapidaTestCase(APITestCase):
+    # A listagem por .values() precisa sair byte a byte igual à dos serializers
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = benchmark.semear('mini', seed=5)
+        Livro.objects.create(
+            titulo='Livro sem autor', descricao='Descrição do livro para os testes.',
+            data_publicacao=datetime.date(2020, 1, 1), criador=cls.admin,
+        )
+
+    def setUp(self):
+        self.client.force_authenticate(self.admin)
+
+    def comparar(self, url):
+        cache.get_cache().clear()
+        rapida = self.client.get(url)
+        cache.get_cache().clear()
+        with mock.patch.object(ListagemRapidaMixin, 'listagem_rapida', False):
+            normal = self.client.get(url)
+        self.assertEqual(rapida.status_code, 200)
+        self.assertEqual(rapida.content, normal.content)
+
+    def test_saida_igual_a_dos_serializers(self):
+        for url in (
+            '/api/livros/', '/api/livros/?page=2&page_size=100', '/api/livros/?q=amor', '/api/livros/?paginacao=cursor',
+            '/api/livros/?fields=id,titulo,categoria_nome', '/api/livros/?expand=autor,categoria',
+            '/api/autores/', '/api/categorias/', '/api/emprestimos/', '/api/emprestimos/?devolvido=false',
+            '/api/emprestimos/?paginacao=cursor&expand=livro,usuario', '/api/async/livros/?expand=autor',
+        ):
+            with self.subTest(url=url):
+                self.comparar(url)
+
+    def test_listagem_nao_instancia_modelos(self):
+        with mock.patch.object(Livro, 'from_db', side_effect=AssertionError('instanciou Livro')):
+            self.assertEqual(self.client.get('/api/livros/').status_code, 200)
+
+
+class AutenticacaoEmCacheTestCase(APITestCase):
+    def setUp(self):
+        authentication.tokens.limpar()
+        authentication.usuarios.limpar()
+        self.admin = User.objects.create_superuser('admin', first_name='Admin', last_name='Teste', email='admin@teste.com')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.admin)}')
+
+    def consultas_de_usuario(self, url='/api/emprestimos/'):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        return response.status_code, [q['sql'] for q in queries if 'auth_user' in q['sql']]
+
+    def test_token_repetido_nao_valida_de_novo_nem_busca_usuario(self):
+        with mock.patch.object(JWTAuthentication, 'get_validated_token', autospec=True, side_effect=JWTAuthentication.get_validated_token) as validar:
+            self.assertEqual(self.consultas_de_usuario()[0], 200)
+            status, consultas = self.consultas_de_usuario()
+        self.assertEqual(status, 200)
+        self.assertEqual(consultas, [])
+        self.assertEqual(validar.call_count, 1)
+
+    def test_alteracao_do_usuario_invalida_o_cache(self):
+        self.consultas_de_usuario()
+        response = self.client.patch('/api/superuser/', {'first_name': 'Outro'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.admin.refresh_from_db()
+        self.assertEqual((self.admin.first_name, self.admin.email), ('Outro', 'admin@teste.com'))
+        self.assertEqual(len(self.consultas_de_usuario()[1]), 1)
+
+        self.admin.is_staff = False
+        self.admin.save()
+        self.assertEqual(self.client.get('/api/emprestimos/').status_code, 403)
+        self.admin.delete()
+        self.assertEqual(self.client.get('/api/emprestimos/').status_code, 401)
+
+    def test_token_adulterado_e_recusado(self):
+        self.consultas_de_usuario()
+        token = str(AccessToken.for_user(self.admin))
+        cabecalho, payload, assinatura = token.split('.')
+        outro = User.objects.create_user('outro')
+        _, payload_outro, _ = str(AccessToken.for_user(outro)).split('.')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {cabecalho}.{payload_outro}.{assinatura}')
+        self.assertEqual(self.client.get('/api/emprestimos/').status_code, 401)
+
+
+class PlanoDeConsultasTestCase(APITestCase):
+    # Cada consulta quente das ViewSets precisa de um índice; varredura completa só onde a resposta é a tabela toda
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = benchmark.semear('mini', seed=11)
+        cls.staff = User.objects.create_user('staff', is_staff=True)
+        cls.livro = Livro.objects.order_by('pk').first()
+        emprestar(Livro.objects.filter(emprestimo_atual__isnull=True).first(), cls.staff)
+
+    def verificar(self, usuario, metodo, url, permitidas=(), dados=None):
+        cache.get_cache().clear()
+        self.client.force_authenticate(usuario)
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, metodo)(url, dados, format='json')
+        self.assertLess(response.status_code, 400, response.content)
+        self.assertEqual(varreduras_completas(queries, permitidas), [])
+
+    def test_listagens_e_filtros_usam_indices(self):
+        categoria = Categoria.objects.first()
+        autor = Autor.objects.first()
+        for url, permitidas in (
+            ('/api/livros/', ()),
+            ('/api/livros/?page=2', ()),
+            ('/api/livros/?paginacao=cursor', ()),
+            ('/api/livros/?titulo=amor', ()),
+            (f'/api/livros/?categoria={categoria.nome[:4]}', ()),
+            (f'/api/livros/?autor={autor.nome[:4]}', ()),
+            ('/api/livros/?q=amor', ()),
+            ('/api/livros/?disponivel=true', ()),
+            ('/api/livros/?disponivel=false', ()),
+            (f'/api/livros/disponibilidade/?ids={self.livro.pk},{self.livro.pk + 1}', ()),
+            (f'/api/livros/{self.livro.pk}/', ()),
+            ('/api/async/livros/?titulo=amor', ()),
+            # Autores e categorias não são paginados: a listagem devolve a tabela inteira
+            ('/api/autores/', ('biblioteca_autor',)),
+            (f'/api/autores/?nome_autor={autor.nome[:3]}', ('biblioteca_autor',)),
+            (f'/api/autores/{autor.pk}/', ()),
+            ('/api/categorias/', ('biblioteca_categoria',)),
+            (f'/api/categorias/{categoria.pk}/', ()),
+            ('/api/emprestimos/?devolvido=false', ()),
+            ('/api/emprestimos/?devolvido=true', ()),
+            ('/api/emprestimos/?paginacao=cursor&devolvido=false', ()),
+        ):
+            with self.subTest(url=url):
+                self.verificar(self.admin, 'get', url, permitidas)
+
+    def test_emprestimos_do_usuario_usam_indice_composto(self):
+        for url in ('/api/emprestimos/', '/api/emprestimos/?devolvido=false'):
+            with self.subTest(url=url):
+                self.verificar(self.staff, 'get', url)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'EXPLAIN QUERY PLAN ' + str(Emprestimo.objects.filter(usuario=self.staff, devolvido__in=[False]).query)
+            )
+            self.assertIn('emprestimo_usuario_idx', ' '.join(linha[3] for linha in cursor.fetchall()))
+
+    def test_escritas_buscam_pela_chave(self):
+        livro = Livro.objects.filter(emprestimo_atual__isnull=True).last()
+        self.verificar(self.admin, 'post', '/api/emprestimos/', dados={
+            'livro': livro.pk, 'usuario': self.staff.pk,
+            'data_prevista_devolucao': str(datetime.date.today() + datetime.timedelta(days=7)),
+        })
+        self.verificar(self.admin, 'patch', f'/api/livros/{self.livro.pk}/', dados={'titulo': 'Título revisado'})
+
+
+class PerfilSQLiteTestCase(TestCase):
+    def test_pragmas_aplicados_na_conexao(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+
+    def test_router_manda_so_leituras_do_catalogo_para_a_replica(self):
+        router = routers.ReplicaDeLeituraRouter()
+        self.assertIsNone(router.db_for_read(Livro))
+        token = routers.leitura_replica.set(True)
+        try:
+            for modelo in (Livro, Autor, Categoria):
+                self.assertEqual(router.db_for_read(modelo), 'replica')
+            self.assertIsNone(router.db_for_read(Emprestimo))
+            self.assertIsNone(router.db_for_read(User))
+            self.assertEqual(router.db_for_write(Livro), 'default')
+        finally:
+            routers.leitura_replica.reset(token)
+        self.assertFalse(router.allow_migrate('replica', 'biblioteca'))
+
+    def test_middleware_liga_a_replica_so_nos_metodos_de_leitura(self):
+        vistos = []
+        middleware = routers.ReplicaDeLeituraMiddleware(lambda request: vistos.append(routers.leitura_replica.get()))
+        middleware(RequestFactory().get('/api/livros/'))
+        middleware(RequestFactory().post('/api/livros/'))
+        self.assertEqual(vistos, [True, False])
+        self.assertFalse(routers.leitura_replica.get())
+
+    def test_gets_que_escrevem_ficam_no_principal(self):
+        router = routers.ReplicaDeLeituraRouter()
+        cliente = APIClient()
+        cliente.force_authenticate(User.objects.create_superuser('admin'))
+        vistos = []
+
+        def relatorio(limite):
+            vistos.append(router.db_for_read(Livro))
+            return {}
+
+        token = routers.leitura_replica.set(True)
+        try:
+            with routers.usar_principal():
+                self.assertIsNone(router.db_for_read(Livro))
+            self.assertEqual(router.db_for_read(Livro), 'replica')
+            with mock.patch.object(atrasos, 'relatorio', relatorio):
+                self.assertEqual(cliente.get('/api/relatorios/atrasos/').status_code, 200)
+        finally:
+            routers.leitura_replica.reset(token)
+        self.assertEqual(vistos, [None])
+
+
+class SnapshotReplicaTestCase(TransactionTestCase):
+    def test_copia_o_que_foi_confirmado(self):
+        criar_livros(User.objects.create_user('leitor'), 3)
+        with tempfile.TemporaryDirectory() as diretorio:
+            destino = os.path.join(diretorio, 'replica.sqlite3')
+            call_command('snapshot_replica', destino=destino, stdout=StringIO())
+            with closing(sqlite3.connect(destino)) as replica:
+                self.assertEqual(replica.execute('SELECT COUNT(*) FROM biblioteca_livro').fetchone()[0], 3)
+
+
+class ResumoAtrasosTestCase(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', password='senha')
+        self.leitores = [User.objects.create_user(f'leitor{i}') for i in range(3)]
+        self.categoria = Categoria.objects.create(nome='Romance')
+        self.livros = criar_livros(self.admin, 6)
+        Livro.objects.filter(pk__in=[livro.pk for livro in self.livros[:3]]).update(categoria=self.categoria)
+        self.hoje = datetime.date.today()
+        atrasos.reconstruir(self.hoje)
+
+    def emprestar_ate(self, livro, usuario, dias):
+        return Emprestimo.objects.create(
+            livro=livro, usuario=usuario, data_inicio=self.hoje,
+            data_prevista_devolucao=self.hoje + datetime.timedelta(days=dias),
+        )
+
+    def no_dia(self, dias):
+        # Simula a passagem do tempo para o resumo (timezone.localdate)
+        return mock.patch('django.utils.timezone.localdate', return_value=self.hoje + datetime.timedelta(days=dias))
+
+    def resumo(self):
+        return {
+            (dimensao, chave): (quantidade, dias)
+            for dimensao, chave, quantidade, dias in ResumoAtraso.objects.values_list('dimensao', 'chave', 'quantidade', 'dias')
+        }
+
+    def test_devolucao_desconta_do_resumo(self):
+        emprestimo = self.emprestar_ate(self.livros[0], self.leitores[0], 1)
+        self.emprestar_ate(self.livros[4], self.leitores[0], 3)
+        self.emprestar_ate(self.livros[5], self.leitores[1], 20)  # no prazo: fica fora
+        with self.no_dia(5):
+            atrasos.virar_dia()
+            resumo = self.resumo()
+            self.assertEqual(resumo[('usuario', self.leitores[0].pk)], (2, 6))
+            self.assertEqual(resumo[('categoria', self.categoria.pk)], (1, 4))
+            self.assertEqual(resumo[('categoria', 0)], (1, 2))
+            self.assertNotIn(('usuario', self.leitores[1].pk), resumo)
+
+            emprestimo.devolvido = True
+            emprestimo.save()
+            self.assertNotIn(('livro', self.livros[0].pk), self.resumo())
+            self.assertEqual(self.resumo()[('usuario', self.leitores[0].pk)], (1, 2))
+            self.assertEqual(atrasos.divergencias(), [])
+
+    def test_virar_o_dia_envelhece_e_inclui_os_que_venceram(self):
+        self.emprestar_ate(self.livros[0], self.leitores[0], 1)
+        self.emprestar_ate(self.livros[1], self.leitores[1], 7)
+        with self.no_dia(2):
+            atrasos.virar_dia()
+            self.assertEqual(self.resumo()[('usuario', self.leitores[0].pk)], (1, 1))
+        with self.no_dia(10):
+            with CaptureQueriesContext(connection) as queries:
+                atrasos.virar_dia()
+            # Quantidade fixa de queries e os empréstimos que venceram buscados pelo índice
+            self.assertEqual(len(queries), 14)
+            self.assertEqual(varreduras_completas(queries), [])
+            resumo = self.resumo()
+            self.assertEqual(resumo[('usuario', self.leitores[0].pk)], (1, 9))
+            self.assertEqual(resumo[('usuario', self.leitores[1].pk)], (1, 3))
+            self.assertEqual(resumo[('categoria', self.categoria.pk)], (2, 12))
+            self.assertEqual(atrasos.divergencias(), [])
+
+    def test_mudanca_de_categoria_e_exclusao(self):
+        self.emprestar_ate(self.livros[0], self.leitores[0], 1)
+        with self.no_dia(4):
+            atrasos.virar_dia()
+            livro = Livro.objects.get(pk=self.livros[0].pk)
+            livro.categoria = None
+            livro.save()
+            self.assertEqual(self.resumo()[('categoria', 0)], (1, 3))
+            self.assertNotIn(('categoria', self.categoria.pk), self.resumo())
+            livro.delete()
+            self.assertEqual(self.resumo(), {})
+
+    def test_comando_reconstroi_o_resumo(self):
+        self.emprestar_ate(self.livros[0], self.leitores[0], 1)
+        with self.no_dia(4):
+            atrasos.virar_dia()
+            ResumoAtraso.objects.filter(dimensao='usuario').update(dias=99)
+            saida = StringIO()
+            call_command('reconstruir_atrasos', stdout=saida)
+            self.assertIn('1 divergências corrigidas', saida.getvalue())
+            self.assertEqual(atrasos.divergencias(), [])
+
+    def test_relatorio(self):
+        self.emprestar_ate(self.livros[0], self.leitores[0], 2)
+        self.emprestar_ate(self.livros[1], self.leitores[0], 1)
+        self.emprestar_ate(self.livros[4], self.leitores[2], 5)
+        self.client.force_authenticate(self.admin)
+        with self.no_dia(6):
+            atrasos.virar_dia()
+            with self.assertNumQueries(8):
+                response = self.client.get('/api/relatorios/atrasos/?limite=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['emprestimos'], 3)
+        self.assertEqual(response.data['dias_em_atraso'], 10)
+        self.assertEqual(response.data['usuarios'], [
+            {'id': self.leitores[0].pk, 'username': 'leitor0', 'emprestimos': 2, 'dias_em_atraso': 9},
+        ])
+        self.assertEqual(response.data['categorias'][0]['nome'], 'Romance')
+
+        self.assertEqual(self.client.get('/api/relatorios/atrasos/?limite=0').status_code, 400)
+        self.client.force_authenticate(User.objects.create_user('staff', is_staff=True))
+        self.assertEqual(self.client.get('/api/relatorios/atrasos/').status_code, 403)
+
+
+class EstatisticasTestCase(APITestCase):
+    def setUp(self):
+        self.usuario = User.objects.create_user('leitor', password='senha')
+        self.categoria = Categoria.objects.create(nome='Romance')
+        self.autor = Autor.objects.create(nome='Machado', biografia='Escritor.')
+        self.livros = criar_livros(self.usuario, 3)
+
+    def agregado(self, tipo, chave):
+        return AgregadoCatalogo.objects.filter(tipo=tipo, chave=chave).values_list('valor', flat=True).first() or 0
+
+    def test_agregados_acompanham_as_mudancas_dos_livros(self):
+        self.assertEqual(self.agregado('livros', 0), 3)
+        self.assertEqual(self.agregado('ano', 2020), 3)
+        self.assertEqual(self.agregado('categoria', 0), 3)
+
+        livro = Livro.objects.get(pk=self.livros[0].pk)
+        livro.categoria = self.categoria
+        livro.autor = self.autor
+        livro.data_publicacao = datetime.date(1899, 5, 1)
+        livro.save()
+        self.assertEqual(self.agregado('categoria', self.categoria.pk), 1)
+        self.assertEqual(self.agregado('categoria', 0), 2)
+        self.assertEqual(self.agregado('autor', self.autor.pk), 1)
+        self.assertEqual(self.agregado('ano', 1899), 1)
+        self.assertEqual(self.agregado('ano', 2020), 2)
+
+        # Salvar com campos adiados não pode contar a mudança duas vezes
+        livro = Livro.objects.only('titulo').get(pk=livro.pk)
+        livro.titulo = 'Dom Casmurro'
+        livro.save()
+        self.assertEqual(self.agregado('categoria', self.categoria.pk), 1)
+
+        livro.delete()
+        self.assertEqual(self.agregado('livros', 0), 2)
+        self.assertEqual(self.agregado('categoria', self.categoria.pk), 0)
+        self.assertEqual(agregados.divergencias(), [])
+
+    def test_emprestimos_por_mes_e_mais_emprestados(self):
+        emprestimo = emprestar(self.livros[0], self.usuario)
+        emprestimo.devolvido = True
+        emprestimo.save()
+        emprestar(self.livros[0], self.usuario)
+        emprestar(self.livros[1], self.usuario).delete()
+        hoje = datetime.date.today()
+        self.assertEqual(self.agregado('emprestimos', 0), 2)
+        self.assertEqual(self.agregado('mes', hoje.year * 100 + hoje.month), 2)
+        self.assertEqual(self.agregado('livro', self.livros[0].pk), 2)
+        self.assertEqual(self.agregado('livro', self.livros[1].pk), 0)
+        self.assertEqual(agregados.divergencias(), [])
+
+    def test_importacao_em_lote_soma_nos_agregados(self):
+        linhas = [
+            {
+                'titulo': f'Importado {i}', 'descricao': 'Descrição do livro importado.', 'data_publicacao': '2001-02-03',
+                'categoria_id': self.categoria.pk, 'autor_id': self.autor.pk,
+            }
+            for i in range(4)
+        ]
+        resumo = importacao.resumir(importacao.importar_livros(linhas, self.usuario))
+        self.assertEqual(resumo['criados'], 4)
+        self.assertEqual(self.agregado('livros', 0), 7)
+        self.assertEqual(self.agregado('categoria', self.categoria.pk), 4)
+        self.assertEqual(self.agregado('ano', 2001), 4)
+        self.assertEqual(agregados.divergencias(), [])
+
+    def test_comando_reconstroi_os_agregados(self):
+        AgregadoCatalogo.objects.filter(tipo='livros').update(valor=99)
+        saida = StringIO()
+        call_command('reconstruir_agregados', stdout=saida)
+        self.assertIn('1 divergências corrigidas', saida.getvalue())
+        self.assertEqual(agregados.divergencias(), [])
+
+    def test_endpoint_com_numero_fixo_de_queries(self):
+        self.assertEqual(self.client.get('/api/estatisticas/').status_code, 401)
+        self.client.force_authenticate(self.usuario)
+        Livro.objects.filter(pk=self.livros[0].pk).update(autor=self.autor)
+        agregados.reconstruir()
+        emprestar(self.livros[2], self.usuario)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/estatisticas/?limite=2')
+        # Sem categorias com livros, o in_bulk dos nomes nem chega ao banco
+        self.assertEqual(len(queries), 6)
+        self.assertEqual(varreduras_completas(queries), [])
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.data['atualizado_em'])
+        self.assertEqual(response.data['total_livros'], 3)
+        self.assertEqual(response.data['total_emprestimos'], 1)
+        # Livros sem autor ficam numa linha própria, com id None
+        self.assertEqual(response.data['livros_por_autor'], [
+            {'id': None, 'nome': None, 'livros': 2}, {'id': self.autor.pk, 'nome': 'Machado', 'livros': 1},
+        ])
+        self.assertEqual(response.data['livros_por_ano'], [{'ano': 2020, 'livros': 3}])
+        self.assertEqual(response.data['mais_emprestados'], [{'id': self.livros[2].pk, 'titulo': 'Livro 00002', 'emprestimos': 1}])
+
+        # Mais livros não mudam o custo da resposta
+        criar_livros(self.usuario, 5, prefixo='Outro')
+        with self.assertNumQueries(6):
+            self.client.get('/api/estatisticas/?limite=2')
+        self.assertEqual(self.client.get('/api/estatisticas/?limite=0').status_code, 400)
+        self.assertEqual(self.client.get('/api/estatisticas/?limite=abc').status_code, 400)
+
+
+@override_settings(BIBLIOTECA_THROTTLE_TAXAS={
+    'catalogo-ip': '3/min', 'catalogo-usuario': '5/min', 'leitura-usuario': '2/min', 'token-ip': '4/min', 'token-usuario': '2/min',
+})
+class ThrottleTestCase(APITestCase):
+    def setUp(self):
+        throttling.get_cache().clear()
+        throttling.janelas_fechadas.limpar()
+        self.usuario = User.objects.create_user('leitor', password='senha')
+
+    def test_leituras_anonimas_por_ip_e_autenticadas_por_usuario(self):
+        for _ in range(3):
+            self.assertEqual(self.client.get('/api/livros/').status_code, 200)
+        response = self.client.get('/api/autores/')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        # Outro IP e o usuário autenticado têm orçamentos próprios
+        self.assertEqual(self.client.get('/api/livros/', REMOTE_ADDR='10.0.0.2').status_code, 200)
+        self.client.force_authenticate(self.usuario)
+        self.assertEqual(self.client.get('/api/livros/').status_code, 200)
+
+    def test_token_limitado_por_ip_e_por_username(self):
+        for i in range(2):
+            response = self.client.post('/api/token/', {'username': 'leitor', 'password': 'errada'}, REMOTE_ADDR=f'10.0.1.{i}')
+            self.assertEqual(response.status_code, 401)
+        # Trocar de IP não dá mais tentativas para o mesmo username
+        response = self.client.post('/api/token/', {'username': 'leitor', 'password': 'senha'}, REMOTE_ADDR='10.0.1.9')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+        for i in range(4):
+            self.client.post('/api/token/', {'username': f'outro{i}', 'password': 'x'}, REMOTE_ADDR='10.0.2.1')
+        response = self.client.post('/api/token/', {'username': 'novo', 'password': 'x'}, REMOTE_ADDR='10.0.2.1')
+        self.assertEqual(response.status_code, 429)
+
+    def test_outras_leituras_nao_gastam_o_orcamento_do_catalogo(self):
+        self.client.force_authenticate(User.objects.create_user('balcao', is_staff=True))
+        for _ in range(2):
+            self.assertEqual(self.client.get('/api/emprestimos/').status_code, 200)
+        self.assertEqual(self.client.get('/api/tarefas/').status_code, 429)
+        for _ in range(5):
+            self.assertEqual(self.client.get('/api/livros/').status_code, 200)
+        self.assertEqual(self.client.get('/api/livros/').status_code, 429)
+
+    def test_tentativa_barrada_pelo_ip_nao_gasta_o_username(self):
+        for i in range(4):
+            self.client.post('/api/token/', {'username': f'outro{i}', 'password': 'x'}, REMOTE_ADDR='10.0.3.1')
+        for _ in range(3):
+            response = self.client.post('/api/token/', {'username': 'leitor', 'password': 'errada'}, REMOTE_ADDR='10.0.3.1')
+            self.assertEqual(response.status_code, 429)
+        for i in range(2):
+            response = self.client.post('/api/token/', {'username': 'leitor', 'password': 'errada'}, REMOTE_ADDR=f'10.0.4.{i}')
+            self.assertEqual(response.status_code, 401)
+
+    def test_janela_deslizante_e_espera(self):
+        # 10 por minuto; janela começando em t=600
+        for segundo in range(10):
+            self.assertEqual(throttling.consumir('teste', 10, 60, agora=600 + segundo), 0)
+        # Negada: espera até a janela seguinte andar o bastante para o peso da anterior cair
+        self.assertAlmostEqual(throttling.consumir('teste', 10, 60, agora=630), 30 + 6)
+        # Negadas não contam: a espera não aumenta
+        self.assertAlmostEqual(throttling.consumir('teste', 10, 60, agora=640), 20 + 6)
+        # Na metade da janela seguinte, a anterior pesa 5: cabem mais 5
+        for _ in range(5):
+            self.assertEqual(throttling.consumir('teste', 10, 60, agora=690), 0)
+        self.assertAlmostEqual(throttling.consumir('teste', 10, 60, agora=690), 6)
+        self.assertEqual(throttling.consumir('teste', 10, 60, agora=696), 0)
+
+
+class AutocompleteTestCase(APITestCase):
+    def setUp(self):
+        autocomplete.indice.descartar()
+        self.usuario = User.objects.create_user('leitor')
+        self.machado = Autor.objects.create(nome='Machado de Assis', biografia='Escritor.')
+        self.alencar = Autor.objects.create(nome='José de Alencar', biografia='Escritor.')
+        self.casmurro, self.memorias, self.iracema = [
+            Livro.objects.create(
+                titulo=titulo, descricao='Descrição do livro para os testes.', data_publicacao=datetime.date(1900, 1, 1),
+                criador=self.usuario, autor=autor,
+            )
+            for titulo, autor in (
+                ('Dom Casmurro', self.machado), ('Memórias Póstumas de Brás Cubas', self.machado), ('Iracema', self.alencar),
+            )
+        ]
+
+    def sugestoes(self, termo, tipo='livros'):
+        response = self.client.get('/api/autocomplete/', {'q': termo, 'tipo': tipo})
+        self.assertEqual(response.status_code, 200)
+        return [(sugestao['id'], sugestao['emprestimos']) for sugestao in response.data[tipo]]
+
+    def test_prefixo_sem_acentos_em_qualquer_palavra(self):
+        with self.assertNumQueries(3):
+            self.assertEqual(self.sugestoes('MEMO'), [(self.memorias.pk, 0)])  # carga
+        with self.assertNumQueries(0):
+            self.assertEqual(self.sugestoes('bras cu'), [(self.memorias.pk, 0)])
+            self.assertEqual(self.sugestoes('jose', tipo='autores'), [(self.alencar.pk, 0)])
+            self.assertEqual(self.sugestoes('zzz'), [])
+            self.assertEqual(self.sugestoes(''), [])
+
+    def test_ordena_pelos_emprestimos_e_recebe_ajustes_no_commit(self):
+        self.sugestoes('d')
+        with self.captureOnCommitCallbacks(execute=True):
+            emprestar(self.iracema, self.usuario)
+            outro = Livro.objects.create(
+                titulo='Dom Quixote', descricao='Descrição do livro para os testes.', data_publicacao=datetime.date(1900, 1, 1),
+                criador=self.usuario,
+            )
+        with self.assertNumQueries(0):
+            self.assertEqual(self.sugestoes('dom'), [(self.casmurro.pk, 0), (outro.pk, 0)])
+            self.assertEqual(self.sugestoes('de', tipo='autores'), [(self.alencar.pk, 1), (self.machado.pk, 0)])
+
+        # Trocar o autor leva junto os empréstimos do livro; renomear e excluir atualizam as chaves
+        with self.captureOnCommitCallbacks(execute=True):
+            self.iracema.autor = self.machado
+            self.iracema.titulo = 'Iracema, lenda do Ceará'
+            self.iracema.save()
+            outro.delete()
+        self.assertEqual(self.sugestoes('de', tipo='autores'), [(self.machado.pk, 1), (self.alencar.pk, 0)])
+        self.assertEqual(self.sugestoes('ceara'), [(self.iracema.pk, 1)])
+        self.assertEqual(self.sugestoes('dom q'), [])
+
+    def test_rollback_nao_altera_o_indice(self):
+        self.sugestoes('d')
+        with self.captureOnCommitCallbacks(execute=False):
+            Livro.objects.filter(pk=self.casmurro.pk).get().delete()
+        self.assertEqual(self.sugestoes('dom'), [(self.casmurro.pk, 0)])
+
+    def test_recarga_nao_reaplica_emprestimos_ja_lidos(self):
+        antigo = emprestar(self.casmurro, self.usuario)
+        ler_emprestimos, montar = autocomplete.indice.ler_emprestimos, autocomplete.indice.montar
+
+        def ler_com_emprestimo_antes():
+            # Confirmado antes da leitura, mas o ajuste do commit só chega durante a recarga
+            with self.captureOnCommitCallbacks() as callbacks:
+                emprestar(self.iracema, self.usuario)
+            lidos = ler_emprestimos()
+            for callback in callbacks:
+                callback()
+            return lidos
+
+        def montar_com_emprestimos_depois(emprestimos):
+            with self.captureOnCommitCallbacks(execute=True):
+                antigo.delete()
+                emprestar(self.memorias, self.usuario)
+            return montar(emprestimos)
+
+        with mock.patch.object(autocomplete.indice, 'ler_emprestimos', ler_com_emprestimo_antes), \
+                mock.patch.object(autocomplete.indice, 'montar', montar_com_emprestimos_depois):
+            self.sugestoes('d')
+        self.assertEqual(self.sugestoes('iracema'), [(self.iracema.pk, 1)])
+        self.assertEqual(self.sugestoes('dom'), [(self.casmurro.pk, 0)])
+        self.assertEqual(self.sugestoes('memorias'), [(self.memorias.pk, 1)])
+        self.assertEqual(self.sugestoes('de', tipo='autores'), [(self.alencar.pk, 1), (self.machado.pk, 1)])
+
+    def test_tamanho_limitado_fica_com_os_populares(self):
+        emprestar(self.iracema, self.usuario)
+        with override_settings(BIBLIOTECA_AUTOCOMPLETE_MAX_CHAVES=2):
+            self.sugestoes('i')
+        self.assertEqual(len(autocomplete.indice.livros.entradas), 1)
+        self.assertEqual(self.sugestoes('ira'), [(self.iracema.pk, 1)])
+        self.assertEqual(self.sugestoes('dom'), [])
+
+    def test_listas_prontas_dos_prefixos_curtos_acompanham_os_ajustes(self):
+        indice = autocomplete.IndicePrefixos(10_000)
+        indice.carregar((pk, f'Livro {pk:03}', pk % 7) for pk in range(300))
+
+        def esperado(prefixo):
+            ids = {pk for chave, pk in indice.entradas if chave.startswith(prefixo)}
+            return sorted(ids, key=indice.ordem)[:autocomplete.LIMITE_MAXIMO_SUGESTOES]
+
+        with mock.patch.object(autocomplete, 'INTERVALO_GRANDE', 10):
+            indice.buscar('livro', 5)
+            self.assertIn('livro', indice.melhores)
+            indice.somar(1, 100)
+            indice.somar(6, -6)
+            indice.remover(13)
+            indice.guardar(500, 'Livro novo')
+            indice.somar(500, 50)
+            for prefixo in ('l', 'livro', 'livro 0'):
+                self.assertEqual([pk for pk, _, _ in indice.buscar(prefixo, 50)], esperado(prefixo))
+
+    def test_parametros_invalidos(self):
+        self.assertEqual(self.client.get('/api/autocomplete/?q=a&limite=0').status_code, 400)
+        self.assertEqual(self.client.get('/api/autocomplete/?q=a&tipo=categorias').status_code, 400)
+
+
+class DisponibilidadeTestCase(APITestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.admin = User.objects.create_superuser('admin', password='senha')
+        self.leitor = User.objects.create_user('leitor')
+        self.livros = criar_livros(self.admin, 4)
+        self.emprestimo = emprestar(self.livros[1], self.leitor)
+
+    def disponibilidade(self, dados):
+        return {linha['id']: (linha['disponivel'], linha['data_prevista_retorno']) for linha in dados}
+
+    def test_listagem_anota_a_pagina_inteira(self):
+        prevista = str(self.emprestimo.data_prevista_devolucao)
+        # Agregação da ETag, COUNT e página
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/livros/')
+        self.assertEqual(self.disponibilidade(response.data['results']), {
+            self.livros[0].pk: (True, None), self.livros[1].pk: (False, prevista),
+            self.livros[2].pk: (True, None), self.livros[3].pk: (True, None),
+        })
+        response = self.client.get('/api/livros/?fields=id,disponivel,data_prevista_retorno')
+        self.assertEqual(response.data['results'][2], {'id': self.livros[1].pk, 'disponivel': False, 'data_prevista_retorno': prevista})
+        response = self.client.get(f'/api/livros/{self.livros[1].pk}/')
+        self.assertFalse(response.data['disponivel'])
+
+    def test_devolucao_invalida_cache_e_etag(self):
+        url = f'/api/livros/{self.livros[1].pk}/'
+        etag = self.client.get(url)['ETag']
+        self.emprestimo.devolvido = True
+        self.emprestimo.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['disponivel'])
+        self.assertIsNone(response.data['data_prevista_retorno'])
+
+    def test_emprestimo_muda_o_last_modified_da_listagem(self):
+        # Relógio à frente das escritas do setUp, como em RespostaCondicionalTestCase
+        inicio = time.time() + 10
+        with no_relogio(inicio):
+            primeira = self.client.get('/api/livros/')
+        with no_relogio(inicio + 1):
+            emprestar(self.livros[0], self.leitor)
+        with no_relogio(inicio + 3):
+            response = self.client.get('/api/livros/', HTTP_IF_MODIFIED_SINCE=primeira['Last-Modified'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.disponibilidade(response.data['results'])[self.livros[0].pk][0], False)
+
+    def test_emprestimos_em_lote_mudam_a_etag_do_livro(self):
+        url = f'/api/livros/{self.livros[2].pk}/'
+        etag = self.client.get(url)['ETag']
+        prevista = datetime.date.today() + datetime.timedelta(days=7)
+        list(emprestimos_lote.emprestar_em_lote([{'livro': self.livros[2].pk, 'usuario': self.leitor.pk, 'data_prevista_devolucao': prevista}]))
+        # Sem o cache, como num processo que não viu a escrita
+        cache.get_cache().clear()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.data['disponivel'])
+
+        list(emprestimos_lote.devolver_em_lote([Emprestimo.objects.get(livro=self.livros[2]).pk]))
+        cache.get_cache().clear()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_filtro_disponivel(self):
+        response = self.client.get('/api/livros/?disponivel=false')
+        self.assertEqual([livro['id'] for livro in response.data['results']], [self.livros[1].pk])
+        response = self.client.get('/api/livros/?disponivel=true')
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(self.client.get('/api/livros/?disponivel=talvez').data['count'], 4)
+
+    def test_cadastro_responde_com_a_disponibilidade(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.post('/api/livros/', {
+            'titulo': 'Livro novo', 'descricao': 'Descrição do livro para os testes.',
+            'data_publicacao': '2020-01-01', 'categoria_id': Categoria.objects.create(nome='Romance').pk,
+            'autor_id': Autor.objects.create(nome='Machado', biografia='Escritor.').pk,
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertTrue(response.data['disponivel'])
+        response = self.client.patch(f'/api/livros/{self.livros[1].pk}/', {'titulo': 'Livro renomeado'}, format='json')
+        self.assertFalse(response.data['disponivel'])
+
+    def test_disponibilidade_em_lote_numa_consulta(self):
+        ids = [self.livros[1].pk, 999999, self.livros[0].pk]
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/livros/disponibilidade/?ids={",".join(map(str, ids))}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['livros'], [
+            {'id': self.livros[1].pk, 'disponivel': False, 'data_prevista_retorno': self.emprestimo.data_prevista_devolucao},
+            {'id': self.livros[0].pk, 'disponivel': True, 'data_prevista_retorno': None},
+        ])
+        self.assertEqual(response.data['nao_encontrados'], [999999])
+
+        muitos = ','.join(str(i) for i in range(1, 1002))
+        self.assertEqual(self.client.get(f'/api/livros/disponibilidade/?ids={muitos}').status_code, 400)
+        self.assertEqual(self.client.get('/api/livros/disponibilidade/?ids=1,a').status_code, 400)
+        self.assertEqual(self.client.get('/api/livros/disponibilidade/').status_code, 400)
+
+
+class EmprestimoEmLoteTestCase(APITestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.admin = User.objects.create_superuser('admin', password='senha')
+        self.leitores = [User.objects.create_user(f'leitor{i}') for i in range(3)]
+        self.livros = criar_livros(self.admin, 12)
+        self.hoje = datetime.date.today()
+        self.prevista = str(self.hoje + datetime.timedelta(days=7))
+        self.client.force_authenticate(self.admin)
+
+    def emprestar_em_lote(self, itens):
+        return self.client.post('/api/emprestimos/bulk-checkout/', {'emprestimos': itens}, format='json')
+
+    def assertContadoresConsistentes(self):
+        abertos = Emprestimo.objects.filter(devolvido=False)
+        esperado = dict(abertos.values('usuario_id').annotate(total=Count('pk')).values_list('usuario_id', 'total'))
+        atual = dict(EmprestimosAbertos.objects.filter(quantidade__gt=0).values_list('usuario_id', 'quantidade'))
+        self.assertEqual(atual, esperado)
+        self.assertEqual(
+            set(LivroEmprestado.objects.values_list('livro_id', 'emprestimo_id')),
+            set(abertos.values_list('livro_id', 'id')),
+        )
+        self.assertEqual(agregados.divergencias(), [])
+
+    def test_checkout_em_lote(self):
+        emprestar(self.livros[0], self.leitores[1])
+        itens = [
+            {'livro': self.livros[1].pk, 'usuario': self.leitores[0].pk, 'data_prevista_devolucao': self.prevista},
+            {'livro': self.livros[0].pk, 'usuario': self.leitores[0].pk, 'data_prevista_devolucao': self.prevista},
+            {'livro': self.livros[1].pk, 'usuario': self.leitores[2].pk, 'data_prevista_devolucao': self.prevista},
+            {'livro': self.livros[2].pk, 'usuario': 999999, 'data_prevista_devolucao': str(self.hoje)},
+            {'livro': self.livros[3].pk, 'usuario': self.leitores[2].pk, 'data_prevista_devolucao': '07/10/2030'},
+            'texto',
+        ] + [
+            {'livro': livro.pk, 'usuario': self.leitores[2].pk, 'data_prevista_devolucao': self.prevista}
+            for livro in self.livros[4:4 + LIMITE_EMPRESTIMOS_ABERTOS + 1]
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.emprestar_em_lote(itens)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual((response.data['criados'], response.data['erros']), (1 + LIMITE_EMPRESTIMOS_ABERTOS, 6))
+        resultados = response.data['resultados']
+        self.assertEqual([resultado['linha'] for resultado in resultados], list(range(1, len(itens) + 1)))
+        self.assertEqual(resultados[0]['status'], 'criado')
+        self.assertIn('livro', resultados[1]['erros'])
+        self.assertIn('livro', resultados[2]['erros'])
+        self.assertEqual(set(resultados[3]['erros']), {'usuario', 'data_prevista_devolucao'})
+        self.assertIn('data_prevista_devolucao', resultados[4]['erros'])
+        self.assertIn('linha', resultados[5]['erros'])
+        self.assertIn('usuario', resultados[-1]['erros'])
+        emprestimo = Emprestimo.objects.get(pk=resultados[0]['id'])
+        self.assertEqual((emprestimo.livro_id, emprestimo.data_inicio), (self.livros[1].pk, self.hoje))
+        self.assertContadoresConsistentes()
+        self.assertFalse(self.client.get(f'/api/livros/{self.livros[1].pk}/').data['disponivel'])
+
+    def test_checkout_com_numero_fixo_de_queries(self):
+        def lote(livros, usuario):
+            return [{'livro': livro.pk, 'usuario': usuario.pk, 'data_prevista_devolucao': self.prevista} for livro in livros]
+
+        with CaptureQueriesContext(connection) as pequeno:
+            self.emprestar_em_lote(lote(self.livros[:1], self.leitores[0]))
+        with CaptureQueriesContext(connection) as grande:
+            self.emprestar_em_lote(lote(self.livros[1:5], self.leitores[1]) + lote(self.livros[5:9], self.leitores[2]))
+        self.assertEqual(len(grande), len(pequeno))
+        self.assertEqual(Emprestimo.objects.count(), 9)
+        self.assertContadoresConsistentes()
+
+    def test_devolucao_em_lote(self):
+        emprestimos = [emprestar(livro, self.leitores[i % 2]) for i, livro in enumerate(self.livros[:4])]
+        emprestimos[3].devolvido = True
+        emprestimos[3].save()
+        ids = [emprestimos[0].pk, emprestimos[1].pk, emprestimos[0].pk, emprestimos[3].pk, 999999, 'x', emprestimos[2].pk]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/emprestimos/bulk-return/', {'emprestimos': ids}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual((response.data['devolvidos'], response.data['erros']), (3, 4))
+        self.assertEqual(
+            [resultado['status'] for resultado in response.data['resultados']],
+            ['devolvido', 'devolvido', 'erro', 'erro', 'erro', 'erro', 'devolvido'],
+        )
+        self.assertEqual(Emprestimo.objects.filter(devolvido=False).count(), 0)
+        self.assertFalse([query['sql'] for query in queries if 'biblioteca_livroemprestado' in query['sql'] and query['sql'].startswith('SELECT')])
+        self.assertContadoresConsistentes()
+        # O livro volta a ficar disponível para um novo empréstimo
+        emprestar(self.livros[0], self.leitores[2])
+
+    def test_devolucao_em_lote_desconta_atrasos(self):
+        atrasos.reconstruir(self.hoje)
+        emprestimos = [
+            Emprestimo.objects.create(
+                livro=livro, usuario=self.leitores[0], data_inicio=self.hoje,
+                data_prevista_devolucao=self.hoje + datetime.timedelta(days=dias),
+            )
+            for livro, dias in zip(self.livros, (1, 2, 30))
+        ]
+        with mock.patch('django.utils.timezone.localdate', return_value=self.hoje + datetime.timedelta(days=5)):
+            atrasos.virar_dia()
+            response = self.client.post('/api/emprestimos/bulk-return/', [emprestimos[0].pk, emprestimos[2].pk], format='json')
+            self.assertEqual(response.data['devolvidos'], 2)
+            self.assertEqual(atrasos.divergencias(), [])
+            self.assertEqual(
+                ResumoAtraso.objects.filter(dimensao=ResumoAtraso.USUARIO).values_list('chave', 'quantidade', 'dias').get(),
+                (self.leitores[0].pk, 1, 3),
+            )
+            self.assertFalse(ResumoAtraso.objects.filter(dimensao=ResumoAtraso.LIVRO, chave=self.livros[0].pk).exists())
+
+    def test_staff_so_devolve_os_proprios_e_limites_do_corpo(self):
+        staff = User.objects.create_user('balcao', is_staff=True)
+        alheio = emprestar(self.livros[0], self.leitores[0])
+        proprio = emprestar(self.livros[1], staff)
+        self.client.force_authenticate(staff)
+        response = self.client.post('/api/emprestimos/bulk-return/', {'emprestimos': [alheio.pk, proprio.pk]}, format='json')
+        self.assertEqual([resultado['status'] for resultado in response.data['resultados']], ['erro', 'devolvido'])
+        alheio.refresh_from_db()
+        self.assertFalse(alheio.devolvido)
+
+        self.assertEqual(self.client.post('/api/emprestimos/bulk-return/', {'emprestimos': 1}, format='json').status_code, 400)
+        muitos = list(range(emprestimos_lote.MAX_ITENS_LOTE + 1))
+        self.assertEqual(self.client.post('/api/emprestimos/bulk-checkout/', muitos, format='json').status_code, 400)
+        self.client.force_authenticate(self.leitores[0])
+        self.assertEqual(self.client.post('/api/emprestimos/bulk-return/', [alheio.pk], format='json').status_code, 403)
+
+
+@override_settings(BIBLIOTECA_TAREFAS_BACKOFF=10, BIBLIOTECA_TAREFAS_BACKOFF_MAXIMO=600, BIBLIOTECA_TAREFAS_VISIBILIDADE=300)
+class TarefasTestCase(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', password='senha')
+        self.staff = User.objects.create_user('balcao', is_staff=True)
+        self.pasta = tempfile.TemporaryDirectory()
+        self.addCleanup(self.pasta.cleanup)
+        configuracao = override_settings(BIBLIOTECA_TAREFAS_DIR=self.pasta.name)
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+        self.client.force_authenticate(self.admin)
+
+    def daqui_a(self, segundos):
+        return mock.patch('django.utils.timezone.now', return_value=timezone.now() + datetime.timedelta(seconds=segundos))
+
+    def test_enfileirar_e_acompanhar_pela_api(self):
+        response = self.client.post('/api/tarefas/', {'tipo': 'reconstruir_agregados'}, format='json')
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertEqual((response.data['estado'], response.data['tentativas']), ('pendente', 0))
+        url = f'/api/tarefas/{response.data["id"]}/'
+        self.assertEqual(self.client.get(url + 'resultado/').status_code, 409)
+
+        tarefas.executar_proxima('teste')
+        self.assertEqual(self.client.get(url).data['estado'], 'concluida')
+        self.assertEqual(self.client.get(url + 'resultado/').data, {'divergencias': 0})
+
+        self.assertEqual(self.client.post('/api/tarefas/', {'tipo': 'nada'}, format='json').status_code, 400)
+        response = self.client.post('/api/tarefas/', {'tipo': 'excluir', 'parametros': {'modelo': 'usuario', 'id': 1}}, format='json')
+        self.assertIn('modelo', response.data['parametros'])
+        # Staff só enfileira exportações e importações e só vê as próprias tarefas
+        self.client.force_authenticate(self.staff)
+        self.assertEqual(self.client.post('/api/tarefas/', {'tipo': 'reconstruir_atrasos'}, format='json').status_code, 400)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get('/api/tarefas/').data['results'], [])
+
+    def test_exportacao_grava_arquivo_e_progresso(self):
+        criar_livros(self.admin, 5)
+        response = self.client.post(
+            '/api/tarefas/', {'tipo': 'exportar', 'parametros': {'recurso': 'livros', 'formato': 'ndjson'}}, format='json'
+        )
+        tarefa = tarefas.executar_proxima('teste')
+        self.assertEqual(tarefa.pk, response.data['id'])
+        self.assertEqual((tarefa.estado, tarefa.progresso, tarefa.total, tarefa.resultado['linhas']), ('concluida', 5, 5, 5))
+        response = self.client.get(f'/api/tarefas/{tarefa.pk}/resultado/')
+        self.assertEqual(response['Content-Type'], exportacao.FORMATOS['ndjson'])
+        linhas = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(linhas), 5)
+        self.assertEqual(os.listdir(self.pasta.name), [tarefa.resultado['arquivo']])
+
+    def test_importacao_e_exclusao_em_cascata(self):
+        categoria = Categoria.objects.create(nome='Romance')
+        autor = Autor.objects.create(nome='Machado de Assis', biografia='Escritor.')
+        linhas = [
+            dados_livro(f'Importado {i}', categoria_id=categoria.pk, autor_id=autor.pk) for i in range(3)
+        ] + [{'titulo': 'Sem data'}]
+        self.client.force_authenticate(self.staff)
+        self.client.post('/api/tarefas/', {'tipo': 'importar_livros', 'parametros': {'livros': linhas}}, format='json')
+        tarefa = tarefas.executar_proxima('teste')
+        self.assertEqual((tarefa.resultado['criados'], tarefa.resultado['erros'], tarefa.progresso), (3, 1, 4))
+        self.assertEqual(Livro.objects.filter(criador=self.staff).count(), 3)
+
+        tarefas.enfileirar('excluir', {'modelo': 'categoria', 'id': categoria.pk}, criador=self.admin)
+        tarefa = tarefas.executar_proxima('teste')
+        self.assertEqual(tarefa.resultado['por_modelo']['biblioteca.Livro'], 3)
+        self.assertFalse(Livro.objects.exists())
+        self.assertEqual(agregados.divergencias(), [])
+
+    def test_importacao_sem_criador_falha_de_vez(self):
+        tarefa = tarefas.enfileirar('importar_livros', {'livros': [dados_livro('Importado')]}, criador=self.staff)
+        self.staff.delete()
+        tarefa = tarefas.executar_proxima('teste')
+        self.assertEqual((tarefa.estado, tarefa.tentativas), ('falhou', 1))
+        self.assertEqual(tarefa.erro, 'O usuário que enfileirou a importação foi excluído.')
+        self.assertFalse(Livro.objects.exists())
+
+    def test_falhas_voltam_para_a_fila_com_backoff(self):
+        falhar = mock.Mock(side_effect=RuntimeError('falhou'))
+        with mock.patch.dict(tarefas.TIPOS, {'instavel': (falhar, None, True)}):
+            tarefa = tarefas.enfileirar('instavel', max_tentativas=3)
+            self.assertEqual(tarefas.executar_proxima('teste').estado, 'pendente')
+            tarefa.refresh_from_db()
+            self.assertIn('RuntimeError', tarefa.erro)
+            self.assertAlmostEqual((tarefa.disponivel_em - timezone.now()).total_seconds(), 10, delta=2)
+            self.assertIsNone(tarefas.executar_proxima('teste'))
+            with self.daqui_a(11):
+                self.assertEqual(tarefas.executar_proxima('teste').estado, 'pendente')
+            tarefa.refresh_from_db()
+            self.assertAlmostEqual((tarefa.disponivel_em - timezone.now()).total_seconds(), 31, delta=2)
+            with self.daqui_a(40):
+                tarefa = tarefas.executar_proxima('teste')
+        self.assertEqual((tarefa.estado, tarefa.tentativas, falhar.call_count), ('falhou', 3, 3))
+
+    def test_reserva_vencida_volta_para_outro_worker(self):
+        tarefa = tarefas.enfileirar('reconstruir_agregados', max_tentativas=2)
+        caiu = tarefas.reservar('worker-que-caiu')  # reservou e nunca terminou
+        self.assertIsNone(tarefas.executar_proxima('outro'))
+        with self.daqui_a(301):
+            self.assertEqual(tarefas.executar_proxima('outro').estado, 'concluida')
+        # O worker antigo não grava nada por cima da nova execução
+        self.assertFalse(caiu.concluir({'atrasado': True}))
+        with self.assertRaises(tarefas.TarefaPerdida):
+            caiu.progresso(1, 1)
+        tarefa.refresh_from_db()
+        self.assertEqual((tarefa.resultado, tarefa.tentativas, tarefa.worker), ({'divergencias': 0}, 2, 'outro'))
+
+        # Caiu em todas as tentativas: a próxima reserva marca como falha em vez de rodar de novo
+        tarefa = tarefas.enfileirar('reconstruir_agregados', max_tentativas=1)
+        tarefas.reservar('worker-que-caiu')
+        with self.daqui_a(301):
+            tarefa = tarefas.executar_proxima('outro')
+        self.assertEqual((tarefa.estado, tarefa.erro), ('falhou', 'O worker parou antes de concluir a tarefa.'))
+
+    def test_reserva_usa_os_indices_da_fila(self):
+        tarefas.enfileirar('reindex_livros')
+        with CaptureQueriesContext(connection) as queries:
+            tarefas.reservar('teste')
+        self.assertEqual(varreduras_completas(queries.captured_queries), [])
+
+
+class RunWorkersTestCase(TransactionTestCase):
+    def test_pool_de_threads_esvazia_a_fila(self):
+        for _ in range(4):
+            tarefas.enfileirar('reconstruir_atrasos')
+        saida = StringIO()
+        call_command('run_workers', '--workers', '2', '--uma-vez', '--intervalo', '0.1', stdout=saida)
+        self.assertEqual(Tarefa.objects.filter(estado=Tarefa.CONCLUIDA).count(), 4)
+        self.assertEqual(len(set(Tarefa.objects.values_list('reserva', flat=True))), 1)
+        self.assertIn('Workers encerrados.', saida.getvalue())
+
+    def test_processos_escrevem_no_stdout_do_comando(self):
+        for _ in range(2):
+            tarefas.enfileirar('reconstruir_atrasos')
+        # Arquivo de verdade: os filhos (fork) escrevem no mesmo descritor
+        with tempfile.TemporaryFile('w+') as saida:
+            call_command('run_workers', '--workers', '2', '--modo', 'processo', '--uma-vez', '--intervalo', '0.1', stdout=saida)
+            saida.seek(0)
+            linhas = saida.read().splitlines()
+        self.assertEqual(len([linha for linha in linhas if linha.endswith('(reconstruir_atrasos): concluida')]), 2)
+        self.assertEqual(linhas[-1], 'Workers encerrados.')
+
+
+class AdminTabelaGrandeTestCase(TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        autocomplete.indice.descartar()
+        self.admin = User.objects.create_superuser('admin', password='senha')
+        self.client.force_login(self.admin)
+        self.machado = Autor.objects.create(nome='Machado de Assis', biografia='Escritor.')
+        self.outros = [Autor.objects.create(nome=f'Autor {i}', biografia='Escritor.') for i in range(5)]
+        self.livros = criar_livros(self.admin, 12)
+        Livro.objects.filter(pk__in=[livro.pk for livro in self.livros[:3]]).update(autor=self.machado)
+        search.reconstruir_indice()
+
+    def listar(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, [query['sql'] for query in queries]
+
+    def test_listagem_sem_count_da_tabela_nem_autores_na_barra_lateral(self):
+        response, queries = self.listar('/admin/biblioteca/livro/')
+        self.assertEqual(response.context['cl'].result_count, 12)
+        self.assertIsNone(response.context['cl'].full_result_count)
+        self.assertContains(response, 'admin-autocomplete')
+        self.assertFalse([sql for sql in queries if sql.startswith('SELECT') and 'FROM "biblioteca_autor"' in sql and 'WHERE' not in sql])
+        # O total sem filtro fica no cache: a próxima página não conta de novo
+        _, queries = self.listar('/admin/biblioteca/livro/?p=2')
+        self.assertFalse([sql for sql in queries if 'COUNT(*)' in sql])
+        self.assertEqual(varreduras_completas([{'sql': sql} for sql in queries], permitidas=('django_session', 'sqlite_master')), [])
+
+    def test_contagem_pelas_estatisticas_do_sqlite(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+            cursor.execute("UPDATE sqlite_stat1 SET stat = '5000 1' WHERE tbl = 'biblioteca_livro'")
+        paginator = ContagemEstimadaPaginator(Livro.objects.order_by('-id'), 10)
+        self.assertEqual(paginator.count, 5000)
+        # Estatísticas antigas, abaixo do maior id: as últimas páginas sumiriam, vale o COUNT
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE sqlite_stat1 SET stat = '5 1' WHERE tbl = 'biblioteca_livro'")
+        self.assertEqual(ContagemEstimadaPaginator(Livro.objects.order_by('-id'), 10).count, 12)
+        with override_settings(BIBLIOTECA_ADMIN_CONTAGEM_MAXIMA=4):
+            self.assertEqual(ContagemEstimadaPaginator(Livro.objects.filter(autor=None).order_by('-id'), 10).count, 4)
+
+    def test_filtro_e_busca_pelos_indices(self):
+        response, _ = self.listar(f'/admin/biblioteca/livro/?autor__id__exact={self.machado.pk}')
+        self.assertEqual(response.context['cl'].result_count, 3)
+        self.assertContains(response, 'Machado de Assis')
+
+        response, queries = self.listar('/admin/biblioteca/livro/?q=machado')
+        self.assertEqual(response.context['cl'].result_count, 3)
+        self.assertTrue([sql for sql in queries if 'MATCH' in sql])
+        self.assertFalse([sql for sql in queries if 'LIKE' in sql])
+
+        response = self.client.get(
+            '/admin/autocomplete/?app_label=biblioteca&model_name=livro&field_name=autor&term=mach'
+        )
+        self.assertEqual(response.json()['results'], [{'id': str(self.machado.pk), 'text': 'Machado de Assis'}])
+
+    def test_busca_de_autores_completa_e_atual(self):
+        # Mais que o limite das sugestões e um autor que o índice em memória deste processo ainda não viu
+        autocomplete.indice.buscar('autor', 10)
+        Autor.objects.bulk_create([Autor(nome=f'Autor extra {i}', biografia='Escritor.') for i in range(60)])
+        response, queries = self.listar('/admin/biblioteca/autor/?q=autor')
+        self.assertEqual(response.context['cl'].result_count, 65)
+        response, _ = self.listar('/admin/biblioteca/autor/?q=assis')
+        self.assertEqual([autor.pk for autor in response.context['cl'].result_list], [self.machado.pk])
+        self.assertEqual(self.listar('/admin/biblioteca/autor/?q=achado')[0].context['cl'].result_count, 0)
+        self.assertEqual(varreduras_completas([{'sql': sql} for sql in queries], permitidas=('django_session',)), [])
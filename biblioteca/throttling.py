@@ -0,0 +1,135 @@
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+from biblioteca.authentication import CacheLRU
+from biblioteca.routers import METODOS_LEITURA
+
+PREFIXO = 'biblioteca:throttle'
+PERIODOS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+# Escopos das views que também recebem escritas (as ViewSets do catálogo): o throttle_scope vale só para as leituras
+ESCOPOS_DE_LEITURA = ('catalogo',)
+
+# Contagem das janelas que já fecharam não muda mais: cada processo lê uma vez por identidade e janela
+janelas_fechadas = CacheLRU(getattr(settings, 'BIBLIOTECA_THROTTLE_JANELAS_MAX', 10000))
+
+
+def get_cache():
+    return caches[getattr(settings, 'BIBLIOTECA_THROTTLE_CACHE_ALIAS', 'default')]
+
+
+def ler_taxa(taxa):
+    # '100/min' -> (100, 60); vazio desliga o limite
+    if not taxa:
+        return None
+    quantidade, periodo = taxa.split('/')
+    return int(quantidade), PERIODOS[periodo[0]]
+
+
+def taxa_do_escopo(escopo, tipo):
+    return ler_taxa(getattr(settings, 'BIBLIOTECA_THROTTLE_TAXAS', {}).get(f'{escopo}-{tipo}'))
+
+
+def incrementar(chave, periodo):
+    cache = get_cache()
+    try:
+        return cache.incr(chave)
+    except ValueError:
+        # Primeira requisição da janela. A chave vive duas janelas para ainda servir de janela anterior
+        if cache.add(chave, 1, timeout=2 * periodo + 1):
+            return 1
+        return cache.incr(chave)
+
+
+def espera(anterior, registradas, limite, periodo, decorrido):
+    # Segundos até caber mais uma requisição, se nenhuma outra chegar
+    livres = limite - 1 - registradas
+    if livres >= 0 and anterior:
+        # Ainda nesta janela, quando o peso da anterior cair o suficiente
+        return max(0.0, (1 - livres / anterior - decorrido) * periodo)
+    fracao = max(0.0, 1 - (limite - 1) / registradas) if registradas else 0.0
+    return (1 - decorrido + fracao) * periodo
+
+
+def consumir(identidade, limite, periodo, agora=None):
+    # Janela deslizante aproximada: as requisições desta janela mais as da anterior, com peso
+    # proporcional ao que ainda falta da janela atual. Devolve 0 se a requisição pode passar,
+    # senão os segundos de espera
+    agora = time.time() if agora is None else agora
+    janela = int(agora // periodo)
+    decorrido = agora % periodo / periodo
+    chave = f'{PREFIXO}:{identidade}:{periodo}'
+    # A única escrita no caminho comum: um incr atômico no contador da janela
+    atual = incrementar(f'{chave}:{janela}', periodo)
+
+    anterior = 0
+    if atual <= limite:
+        anterior = janelas_fechadas.obter((chave, janela - 1))
+        if anterior is None:
+            anterior = get_cache().get(f'{chave}:{janela - 1}', 0)
+            janelas_fechadas.guardar((chave, janela - 1), anterior, (janela + 1) * periodo)
+        if anterior * (1 - decorrido) + atual <= limite:
+            return 0
+
+    # Negada não conta: quem insiste depois do limite não empurra a liberação para frente
+    devolver(identidade, periodo, agora)
+    return espera(anterior, atual - 1, limite, periodo, decorrido)
+
+
+def devolver(identidade, periodo, agora):
+    # Desfaz o incr de consumir() na janela de `agora`
+    try:
+        get_cache().decr(f'{PREFIXO}:{identidade}:{periodo}:{int(agora // periodo)}')
+    except ValueError:
+        pass
+
+
+class ThrottlePorEscopo(BaseThrottle):
+    # Escopo da view (throttle_scope) ou, sem ele, leituras e escritas. Anônimos contam por IP e autenticados
+    # por usuário; no escopo token contam o IP e o username tentado
+    def __init__(self):
+        self.espera = None
+
+    def escopo(self, request, view):
+        escopo = getattr(view, 'throttle_scope', None)
+        leitura = request.method in METODOS_LEITURA
+        if escopo and (leitura or escopo not in ESCOPOS_DE_LEITURA):
+            return escopo
+        return 'leitura' if leitura else 'escrita'
+
+    def identidades(self, request, escopo):
+        if escopo == 'token':
+            dados = request.data if hasattr(request.data, 'get') else {}
+            username = dados.get('username')
+            if isinstance(username, str) and username:
+                yield 'usuario', hashlib.sha256(username.encode()).hexdigest()[:32]
+            yield 'ip', self.get_ident(request)
+        elif request.user and request.user.is_authenticated:
+            yield 'usuario', request.user.pk
+        else:
+            yield 'ip', self.get_ident(request)
+
+    def allow_request(self, request, view):
+        # A requisição só conta se passar em todas as identidades: negada por uma, desfaz as que já contaram
+        # (no token, uma tentativa barrada pelo IP não gasta o orçamento do username)
+        escopo = self.escopo(request, view)
+        agora = time.time()
+        consumidas = []
+        for tipo, identidade in self.identidades(request, escopo):
+            taxa = taxa_do_escopo(escopo, tipo)
+            if taxa is None:
+                continue
+            limite, periodo = taxa
+            chave = f'{escopo}:{tipo}:{identidade}'
+            segundos = consumir(chave, limite, periodo, agora)
+            if segundos:
+                for consumida, periodo_consumida in consumidas:
+                    devolver(consumida, periodo_consumida, agora)
+                self.espera = segundos
+                return False
+            consumidas.append((chave, periodo))
+        return True
+
+    def wait(self):
+        return self.espera
@@ -1,9 +1,8 @@
 from django.contrib import admin
 from django.urls import path, include
-from biblioteca import views
+from biblioteca import views, views_async
 from rest_framework.routers import SimpleRouter
 from rest_framework_simplejwt.views import (
-    TokenObtainPairView,
     TokenRefreshView,
     TokenVerifyView,
 )
@@ -13,11 +12,23 @@ biblioteca_router.register('api/livros', views.LivroViewSet, basename='api-livro
 biblioteca_router.register('api/categorias', views.CategoriaViewSet, basename='api-categoria')
 biblioteca_router.register('api/autores', views.AutorViewSet, basename='api-autores')
 biblioteca_router.register('api/emprestimos', views.EmprestimoViewSet, basename='api-emprestimos')
+biblioteca_router.register('api/tarefas', views.TarefaViewSet, basename='api-tarefas')
 
 urlpatterns = [
     path('', include(biblioteca_router.urls)),
     path('api/superuser/', views.SuperuserViewSet.as_view({'patch': 'partial_update', 'post': 'create'}), name='superuser-profile-update'),
-    path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('api/async/livros/', views_async.LivroAssincronoView.as_view(), name='api-async-livros-list'),
+    path('api/async/livros/<str:pk>/', views_async.LivroAssincronoView.as_view(), name='api-async-livros-detail'),
+    path('api/async/autores/', views_async.AutorAssincronoView.as_view(), name='api-async-autores-list'),
+    path('api/async/autores/<str:pk>/', views_async.AutorAssincronoView.as_view(), name='api-async-autores-detail'),
+    path('api/async/categorias/', views_async.CategoriaAssincronaView.as_view(), name='api-async-categoria-list'),
+    path('api/async/categorias/<str:pk>/', views_async.CategoriaAssincronaView.as_view(), name='api-async-categoria-detail'),
+    path('api/exportar/<str:recurso>/', views.ExportacaoView.as_view(), name='exportar'),
+    path('api/autocomplete/', views.AutocompleteView.as_view(), name='autocomplete'),
+    path('api/estatisticas/', views.EstatisticasView.as_view(), name='estatisticas'),
+    path('api/relatorios/atrasos/', views.RelatorioAtrasosView.as_view(), name='relatorio-atrasos'),
+    path('api/cache/', views.CacheEstatisticasView.as_view(), name='cache-estatisticas'),
+    path('api/token/', views.ObterTokenView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/token/verify/', TokenVerifyView.as_view(), name='token_verify'),
 ]
@@ -0,0 +1,14 @@
+import unicodedata
+
+
+def normalizar_titulo(titulo):
+    # Remove espaços extras e ignora maiúsculas/minúsculas para comparar títulos
+    if titulo is None:
+        return None
+    return ' '.join(titulo.split()).casefold()
+
+
+def dobrar_acentos(texto):
+    # "Açúcar" -> "acucar": compara sem acentos e sem maiúsculas/minúsculas
+    decomposto = unicodedata.normalize('NFKD', texto or '')
+    return ''.join(c for c in decomposto if not unicodedata.combining(c)).casefold()
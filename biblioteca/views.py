@@ -1,49 +1,82 @@
-from django.db.models.functions import Concat
-from django.db.models import F, Value
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
-from biblioteca.models import Livro, Categoria, Autor, Emprestimo
-from biblioteca.serializers import LivroSerializer, CategoriaSerializer, AuthorSerializer, SuperuserSerializer, EmprestimoSerializer
+from rest_framework.views import APIView
+from rest_framework.decorators import action
+from biblioteca.models import Livro, Categoria, Autor, Emprestimo, LivroEmprestado, Tarefa
+from biblioteca.serializers import LivroSerializer, CategoriaSerializer, AuthorSerializer, SuperuserSerializer, EmprestimoSerializer, TarefaSerializer, campos_da_requisicao, plano_de_leitura
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny 
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.renderers import BrowsableAPIRenderer
 from biblioteca.permissions import IsOwner
+from biblioteca.pagination import LivroViewPagination, EmprestimoViewPagination, IdCursorPagination
+from biblioteca.filters import CRIADOR_NOME, DATA_PREVISTA_RETORNO, DISPONIVEL, filtrar_livros_por_parametros
+from biblioteca.cache import RespostaEmCacheMixin, estatisticas
+from biblioteca.conditional import RespostaCondicionalMixin
+from biblioteca.importacao import importar_livros, resumir, MAX_LINHAS_REQUISICAO
+from biblioteca import emprestimos_lote
+from biblioteca import agregados, atrasos, autocomplete, exportacao, tarefas
+from biblioteca.routers import usar_principal
+from django.http import FileResponse, StreamingHttpResponse
 from django.contrib.auth.models import User
 from rest_framework.exceptions import PermissionDenied
+from rest_framework_simplejwt.views import TokenObtainPairView
 
 
-class LivroViewPagination(PageNumberPagination):
-    page_size = 50
-    page_size_query_param = 'page_size'
-    max_page_size = 100
+MAX_IDS_DISPONIBILIDADE = 1000
 
-class LivroViewSet(ModelViewSet):
+
+class CamposDinamicosViewMixin:
+    # Queryset sem joins/anotações de onde parte o plano quando há ?fields= ou ?expand=
+    queryset_planejavel = None
+    
+    def planejar_queryset(self, qs):
+        if self.request.method != 'GET':
+            return qs
+        campos, expandir = campos_da_requisicao(self.request)
+        if not campos and not expandir:
+            return qs
+        base = self.queryset_planejavel if self.queryset_planejavel is not None else qs
+        return self.get_serializer_class().planejar_queryset(base.all(), self.request)
+
+
+class ListagemRapidaMixin:
+    # list() montado a partir de .values() pelo plano de leitura do serializer (mesma saída, sem instâncias)
+    listagem_rapida = True
+
+    def plano_da_listagem(self):
+        if not self.listagem_rapida or isinstance(self.request.accepted_renderer, BrowsableAPIRenderer):
+            return None
+        return plano_de_leitura(self.get_serializer())
+
+    def list(self, request, *args, **kwargs):
+        plano = self.plano_da_listagem()
+        if plano is None:
+            return super().list(request, *args, **kwargs)
+        linhas = self.filter_queryset(self.get_queryset()).values(*plano.caminhos)
+        page = self.paginate_queryset(linhas)
+        if page is not None:
+            return self.get_paginated_response(plano.montar(page))
+        return Response(plano.montar(linhas))
+
+
+class LivroViewSet(CamposDinamicosViewMixin, RespostaCondicionalMixin, RespostaEmCacheMixin, ListagemRapidaMixin, ModelViewSet):
     queryset = Livro.objects.all().annotate(
-        criador_nome=Concat(
-            F('criador__first_name'), 
-            Value(' '), 
-            F('criador__last_name'), 
-            Value(' ('),
-            F('criador__username'),
-            Value(')'))).select_related('categoria', 'autor', 'criador').order_by('-id')
+        criador_nome=CRIADOR_NOME, disponivel=DISPONIVEL, data_prevista_retorno=DATA_PREVISTA_RETORNO,
+    ).select_related('categoria', 'autor', 'criador').order_by('-id')
     
+    throttle_scope = 'catalogo'
     serializer_class = LivroSerializer
     pagination_class = LivroViewPagination
+    # LivroEmprestado: empréstimos e devoluções mudam a disponibilidade
+    cache_modelos = (Livro, Autor, Categoria, User, LivroEmprestado)
+    condicional_campos = ('updated_at', 'autor__updated_at', 'categoria__updated_at')
     get_permissions = [IsAuthenticated]
     http_method_names = ['get', 'post', 'patch', 'delete', 'head', 'options']
 
+    queryset_planejavel = Livro.objects.order_by('-id')
+    
     def get_queryset(self):
-        qs = self.queryset
-        titulo = self.request.query_params.get('titulo', None)
-        categoria = self.request.query_params.get('categoria', None)
-        autor = self.request.query_params.get('autor', None)
-        if categoria:
-            qs = qs.filter(categoria__nome__icontains=categoria)
-        if autor:
-            qs = qs.filter(autor__nome__icontains=autor)
-        if titulo:
-            qs = qs.filter(titulo__icontains=titulo)
-        return qs
+        return filtrar_livros_por_parametros(self.planejar_queryset(self.queryset.all()), self.request.query_params)
     
     def get_permissions(self):
         if self.request.method == 'GET':
@@ -62,10 +95,52 @@ class LivroViewSet(ModelViewSet):
         serializer.save(criador=request.user)
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+    
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk(self, request):
+        linhas = request.data.get('livros') if isinstance(request.data, dict) else request.data
+        if not isinstance(linhas, list):
+            return Response({'error': 'Envie uma lista de livros.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(linhas) > MAX_LINHAS_REQUISICAO:
+            return Response(
+                {'error': f'Envie no máximo {MAX_LINHAS_REQUISICAO} livros por requisição.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(resumir(importar_livros(linhas, criador=request.user)), status=status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['get'], url_path='disponibilidade')
+    def disponibilidade(self, request):
+        # ?ids=1,2,3: disponibilidade de até MAX_IDS_DISPONIBILIDADE livros numa consulta só
+        try:
+            ids = list(dict.fromkeys(int(pk) for pk in request.query_params.get('ids', '').split(',') if pk.strip()))
+        except ValueError:
+            return Response({'error': 'Os ids devem ser números inteiros.'}, status=status.HTTP_400_BAD_REQUEST)
+        if not ids:
+            return Response({'error': 'Informe os ids dos livros em ?ids=.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(ids) > MAX_IDS_DISPONIBILIDADE:
+            return Response(
+                {'error': f'Informe no máximo {MAX_IDS_DISPONIBILIDADE} ids por requisição.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        encontrados = {
+            pk: {'id': pk, 'disponivel': disponivel, 'data_prevista_retorno': data_prevista}
+            for pk, disponivel, data_prevista in Livro.objects.filter(pk__in=ids).annotate(
+                disponivel=DISPONIVEL, data_prevista_retorno=DATA_PREVISTA_RETORNO,
+            ).values_list('id', 'disponivel', 'data_prevista_retorno')
+        }
+        return Response({
+            'livros': [encontrados[pk] for pk in ids if pk in encontrados],
+            'nao_encontrados': [pk for pk in ids if pk not in encontrados],
+        }, status=status.HTTP_200_OK)
 
-class CategoriaViewSet(ModelViewSet):
+class CategoriaViewSet(CamposDinamicosViewMixin, RespostaCondicionalMixin, RespostaEmCacheMixin, ListagemRapidaMixin, ModelViewSet):
     queryset = Categoria.objects.all()
+    throttle_scope = 'catalogo'
     serializer_class = CategoriaSerializer
+    cache_modelos = (Categoria, Livro)
+    
+    def get_queryset(self):
+        return self.planejar_queryset(self.queryset.all())
     
     def get_permissions(self):
         if self.request.method == 'GET':
@@ -76,12 +151,14 @@ class CategoriaViewSet(ModelViewSet):
             return [IsAdminUser()]
     
     
-class AutorViewSet(ModelViewSet):
+class AutorViewSet(CamposDinamicosViewMixin, RespostaCondicionalMixin, RespostaEmCacheMixin, ListagemRapidaMixin, ModelViewSet):
     queryset = Autor.objects.all()
+    throttle_scope = 'catalogo'
     serializer_class = AuthorSerializer
+    cache_modelos = (Autor,)
     
     def get_queryset(self):
-        qs = self.queryset
+        qs = self.planejar_queryset(self.queryset.all())
         nome = self.request.query_params.get('nome_autor', None)
         if nome:
             qs = qs.filter(nome__icontains=nome)
@@ -106,7 +183,8 @@ class SuperuserViewSet(ModelViewSet):
         user = self.request.user
         if not user.is_superuser:
             raise PermissionDenied("Você não tem permissão para acessar este recurso.")
-        return user
+        # request.user vem do cache da autenticação só com alguns campos; a atualização parte do registro completo
+        return User.objects.get(pk=user.pk)
     
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -122,21 +200,23 @@ class SuperuserViewSet(ModelViewSet):
         return Response({"success": "Os dados foram atualizados com sucesso."}, status=status.HTTP_200_OK)
 
 
-class EmprestimoViewSet(ModelViewSet):
+class EmprestimoViewSet(CamposDinamicosViewMixin, ListagemRapidaMixin, ModelViewSet):
     queryset = Emprestimo.objects.all()
     serializer_class = EmprestimoSerializer
+    pagination_class = EmprestimoViewPagination
     permission_classes = [IsAdminUser]
     http_method_names = ['get', 'post', 'patch', 'delete']
     
     def get_queryset(self):
-        qs = self.queryset
+        qs = self.planejar_queryset(self.queryset.all())
         if self.request.user.is_superuser:
             usuario = self.request.query_params.get('usuario', None)
             livro = self.request.query_params.get('livro', None)
             situacao = self.request.query_params.get('devolvido', None)
             if situacao:
                 situacao = True if situacao.lower() == 'true' else False
-                qs = qs.filter(devolvido=situacao)
+                # devolvido=False vira "NOT devolvido" no SQL, que não usa índice; o IN vira "devolvido IN (0)"
+                qs = qs.filter(devolvido__in=[situacao])
             if livro:
                 qs = qs.filter(livro__titulo__icontains=livro)
             if usuario:
@@ -147,10 +227,171 @@ class EmprestimoViewSet(ModelViewSet):
             situacao = self.request.query_params.get('devolvido', None)
             if situacao:
                 situacao = True if situacao.lower() == 'true' else False
-                qs = qs.filter(devolvido=situacao)
+                qs = qs.filter(devolvido__in=[situacao])
             if livro:
                 qs = qs.filter(livro__titulo__icontains=livro)
             qs = qs.filter(usuario=self.request.user)
             return qs
         
-        return qs
\ No newline at end of file
+        return qs
+
+    def _itens_do_lote(self, request):
+        itens = request.data.get('emprestimos') if isinstance(request.data, dict) else request.data
+        if not isinstance(itens, list):
+            return None, Response({'error': 'Envie uma lista de empréstimos.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(itens) > emprestimos_lote.MAX_ITENS_LOTE:
+            return None, Response(
+                {'error': f'Envie no máximo {emprestimos_lote.MAX_ITENS_LOTE} empréstimos por requisição.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return itens, None
+
+    @action(detail=False, methods=['post'], url_path='bulk-return')
+    def devolver_em_lote(self, request):
+        # Lista de ids; como no PATCH, quem não é superusuário só devolve os próprios empréstimos
+        ids, erro = self._itens_do_lote(request)
+        if erro:
+            return erro
+        usuario = None if request.user.is_superuser else request.user
+        resultados = emprestimos_lote.devolver_em_lote(ids, usuario=usuario)
+        return Response(emprestimos_lote.resumir(resultados, 'devolvido'), status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'], url_path='bulk-checkout')
+    def emprestar_em_lote(self, request):
+        # Lista de {livro, usuario, data_prevista_devolucao}
+        itens, erro = self._itens_do_lote(request)
+        if erro:
+            return erro
+        resultados = emprestimos_lote.emprestar_em_lote(itens)
+        return Response(emprestimos_lote.resumir(resultados, 'criado'), status=status.HTTP_200_OK)
+
+class RelatorioAtrasosView(APIView):
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        if not request.user.is_superuser:
+            raise PermissionDenied("Você não tem permissão para acessar este recurso.")
+        try:
+            limite = int(request.query_params.get('limite', atrasos.LIMITE_RELATORIO))
+        except ValueError:
+            return Response({'error': 'O limite deve ser um número inteiro.'}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= limite <= atrasos.LIMITE_MAXIMO_RELATORIO:
+            return Response({'error': f'O limite deve estar entre 1 e {atrasos.LIMITE_MAXIMO_RELATORIO}.'}, status=status.HTTP_400_BAD_REQUEST)
+        # O relatório vira o dia do resumo (escrita) antes de ler os nomes dos livros e categorias
+        with usar_principal():
+            return Response(atrasos.relatorio(limite), status=status.HTTP_200_OK)
+
+
+class EstatisticasView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request):
+        try:
+            limite = int(request.query_params.get('limite', agregados.LIMITE_RANKING))
+        except ValueError:
+            return Response({'error': 'O limite deve ser um número inteiro.'}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= limite <= agregados.LIMITE_MAXIMO_RANKING:
+            return Response({'error': f'O limite deve estar entre 1 e {agregados.LIMITE_MAXIMO_RANKING}.'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(agregados.resumo(limite), status=status.HTTP_200_OK)
+
+
+class AutocompleteView(APIView):
+    # Sugestões por prefixo do índice em memória: sem consulta ao banco depois da carga
+    permission_classes = [AllowAny]
+    throttle_scope = 'autocomplete'
+    
+    def get(self, request):
+        try:
+            limite = int(request.query_params.get('limite', autocomplete.LIMITE_SUGESTOES))
+        except ValueError:
+            return Response({'error': 'O limite deve ser um número inteiro.'}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= limite <= autocomplete.LIMITE_MAXIMO_SUGESTOES:
+            return Response({'error': f'O limite deve estar entre 1 e {autocomplete.LIMITE_MAXIMO_SUGESTOES}.'}, status=status.HTTP_400_BAD_REQUEST)
+        tipo = request.query_params.get('tipo')
+        if tipo not in (None, 'livros', 'autores'):
+            return Response({'error': 'Use tipo=livros ou tipo=autores.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        encontrados = autocomplete.indice.buscar(request.query_params.get('q', ''), limite, (tipo,) if tipo else ('livros', 'autores'))
+        campos = {'livros': 'titulo', 'autores': 'nome'}
+        return Response({
+            tipo: [{'id': pk, campos[tipo]: nome, 'emprestimos': total} for pk, nome, total in sugestoes]
+            for tipo, sugestoes in encontrados.items()
+        }, status=status.HTTP_200_OK)
+
+
+class CacheEstatisticasView(APIView):
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        return Response(estatisticas(), status=status.HTTP_200_OK)
+
+
+class ExportacaoView(APIView):
+    permission_classes = [IsAdminUser]
+    
+    def perform_content_negotiation(self, request, force=False):
+        # A resposta é um arquivo CSV/NDJSON, não passa pelos renderers do DRF
+        return super().perform_content_negotiation(request, force=True)
+    
+    def get(self, request, recurso):
+        if recurso not in exportacao.RECURSOS:
+            return Response({'error': 'Recurso de exportação inválido.'}, status=status.HTTP_404_NOT_FOUND)
+        formato = request.query_params.get('formato', 'csv')
+        if formato not in exportacao.FORMATOS:
+            return Response({'error': 'Use formato=csv ou formato=ndjson.'}, status=status.HTTP_400_BAD_REQUEST)
+        gzip = request.query_params.get('gzip', '').lower() in ('1', 'true')
+        
+        response = StreamingHttpResponse(
+            exportacao.exportar(recurso, request.query_params, formato=formato, gzip=gzip, usuario=request.user),
+            content_type='application/gzip' if gzip else exportacao.FORMATOS[formato],
+        )
+        response['Content-Disposition'] = f'attachment; filename="{exportacao.nome_arquivo(recurso, formato, gzip)}"'
+        return response
+
+
+class TarefaViewSet(ModelViewSet):
+    # Enfileira e acompanha as tarefas executadas pelo run_workers. Superusuários veem todas; staff, só as próprias
+    queryset = Tarefa.objects.all()
+    serializer_class = TarefaSerializer
+    pagination_class = IdCursorPagination
+    permission_classes = [IsAdminUser]
+    http_method_names = ['get', 'post']
+
+    def get_queryset(self):
+        qs = self.queryset.all()
+        if not self.request.user.is_superuser:
+            qs = qs.filter(criador=self.request.user)
+        for campo in ('estado', 'tipo'):
+            valor = self.request.query_params.get(campo, None)
+            if valor:
+                qs = qs.filter(**{campo: valor})
+        return qs
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'])
+    def resultado(self, request, pk=None):
+        tarefa = self.get_object()
+        if tarefa.estado != Tarefa.CONCLUIDA:
+            return Response(
+                {'error': 'A tarefa ainda não foi concluída.', 'estado': tarefa.estado, 'erro': tarefa.erro},
+                status=status.HTTP_409_CONFLICT
+            )
+        arquivo = tarefas.arquivo_do_resultado(tarefa)
+        if arquivo is None:
+            return Response(tarefa.resultado, status=status.HTTP_200_OK)
+        if not arquivo.exists():
+            return Response({'error': 'O arquivo da tarefa não existe mais.'}, status=status.HTTP_410_GONE)
+        return FileResponse(
+            open(arquivo, 'rb'), as_attachment=True, filename=arquivo.name,
+            content_type=tarefa.resultado.get('content_type', 'application/octet-stream'),
+        )
+
+
+class ObterTokenView(TokenObtainPairView):
+    # Cada tentativa roda o PBKDF2 da senha: escopo de throttling próprio, por IP e por username
+    throttle_scope = 'token'
@@ -0,0 +1,121 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import Http404
+from django.utils.cache import get_conditional_response
+from django.views import View
+from rest_framework import status
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.response import Response
+from biblioteca import cache
+from biblioteca.cache import RespostaEmCacheMixin
+from biblioteca.conditional import RespostaCondicionalMixin
+from biblioteca.pagination import cursor_solicitado
+from biblioteca.views import LivroViewSet, AutorViewSet, CategoriaViewSet
+
+CHUNK_SIZE = 500
+
+
+class LeituraAssincronaView(View):
+    # list/retrieve pelo ORM assíncrono (acount, aget, aiterator). Filtros, permissões, serializers,
+    # paginação, cache e ETag vêm da ViewSet síncrona, que continua servindo as mesmas rotas em /api/
+    viewset_class = None
+
+    async def get(self, request, pk=None):
+        acao = 'list' if pk is None else 'retrieve'
+        viewset = self.viewset_class(action_map={'get': acao, 'head': acao}, args=(), kwargs={} if pk is None else {'pk': pk})
+        viewset.format_kwarg = None
+        viewset.request = drf_request = viewset.initialize_request(request)
+        viewset.headers = viewset.default_response_headers
+
+        try:
+            # Autenticação (o JWT busca o usuário no banco), permissões e throttling do DRF
+            await sync_to_async(viewset.initial)(drf_request)
+            response = await self.responder(viewset, drf_request, pk)
+        except Exception as exc:
+            response = viewset.handle_exception(exc)
+
+        response = viewset.finalize_response(drf_request, response)
+        if not isinstance(response, Response):
+            return response
+        if isinstance(response.accepted_renderer, BrowsableAPIRenderer):
+            # A API navegável monta formulários com querysets: renderiza fora do loop
+            return await sync_to_async(response.render)()
+        return response.render()
+
+    async def responder(self, viewset, request, pk):
+        queryset = viewset.filter_queryset(viewset.get_queryset())
+        if pk is not None:
+            try:
+                queryset = queryset.filter(**{viewset.lookup_field: pk})
+            except (TypeError, ValueError, ValidationError):
+                raise Http404
+        handler = self.listar if pk is None else self.detalhar
+
+        etag = last_modified = None
+        if isinstance(viewset, RespostaCondicionalMixin) and not (pk is None and cursor_solicitado(request)):
+            etag, last_modified = viewset.validadores(request, *await viewset.aimpressao_digital(queryset))
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is not None:
+                return viewset.aplicar_validadores(response, etag, last_modified)
+
+        if isinstance(viewset, RespostaEmCacheMixin):
+            response = await self.responder_com_cache(viewset, request, handler, queryset)
+        else:
+            response = await handler(viewset, request, queryset)
+        if etag is not None and response.status_code == status.HTTP_200_OK:
+            viewset.aplicar_validadores(response, etag, last_modified)
+        return response
+
+    async def responder_com_cache(self, viewset, request, handler, queryset):
+        versoes_modelos = await cache.aversoes(viewset.cache_modelos)
+        chave = cache.montar_chave(request, viewset.cache_modelos, versoes_modelos)
+        dados = await cache.get_cache().aget(chave)
+        if dados is not None:
+            await cache.acontar(cache.CHAVE_ACERTOS)
+            response = Response(dados, status=status.HTTP_200_OK)
+            response['X-Cache'] = 'HIT'
+            return response
+
+        response = await handler(viewset, request, queryset)
+        if response.status_code == status.HTTP_200_OK:
+            await cache.get_cache().aset(chave, response.data, timeout=getattr(settings, 'BIBLIOTECA_CACHE_TIMEOUT', 300))
+        await cache.acontar(cache.CHAVE_FALHAS)
+        response['X-Cache'] = 'MISS'
+        return response
+
+    async def listar(self, viewset, request, queryset):
+        plano = viewset.plano_da_listagem()
+        if plano is not None:
+            queryset = queryset.values(*plano.caminhos)
+            serializar = plano.montar
+        else:
+            serializar = lambda objetos: viewset.get_serializer(objetos, many=True).data
+
+        paginator = viewset.paginator
+        if paginator is not None:
+            pagina = await paginator.apaginate_queryset(queryset, request, view=viewset)
+            if pagina is not None:
+                return viewset.get_paginated_response(serializar(pagina))
+        objetos = [obj async for obj in queryset.aiterator(chunk_size=CHUNK_SIZE)]
+        return Response(serializar(objetos))
+
+    async def detalhar(self, viewset, request, queryset):
+        try:
+            obj = await queryset.aget()
+        except queryset.model.DoesNotExist:
+            raise Http404(f'No {queryset.model._meta.object_name} matches the given query.')
+        viewset.check_object_permissions(request, obj)
+        return Response(viewset.get_serializer(obj).data)
+
+
+class LivroAssincronoView(LeituraAssincronaView):
+    viewset_class = LivroViewSet
+
+
+class AutorAssincronoView(LeituraAssincronaView):
+    viewset_class = AutorViewSet
+
+
+class CategoriaAssincronaView(LeituraAssincronaView):
+    viewset_class = CategoriaViewSet
@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'biblioteca.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,13 +80,78 @@ WSGI_APPLICATION = 'setup.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# Perfil do SQLite: "otimizado" aplica os pragmas abaixo em cada conexão nova; "padrao" mantém os do SQLite
+BIBLIOTECA_SQLITE_PERFIL = os.getenv('BIBLIOTECA_SQLITE_PERFIL', 'otimizado')
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',  # leitores não bloqueiam o escritor e vice-versa
+    'synchronous': 'NORMAL',  # com WAL o fsync fica para o checkpoint; um commit não vira uma escrita síncrona
+    'busy_timeout': int(os.getenv('BIBLIOTECA_SQLITE_BUSY_TIMEOUT', 5000)),  # ms esperando o lock antes do "database is locked"
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # negativo = KiB (64 MB por conexão)
+    'temp_store': 'MEMORY',
+}
+
+OPCOES_SQLITE = {}
+if BIBLIOTECA_SQLITE_PERFIL == 'otimizado':
+    OPCOES_SQLITE = {
+        'init_command': ';'.join(f'PRAGMA {nome}={valor}' for nome, valor in SQLITE_PRAGMAS.items()),
+        # BEGIN IMMEDIATE: a transação pega o lock de escrita no início. Com o BEGIN padrão, duas transações
+        # que leram e depois tentam escrever falham na hora com "database is locked", sem esperar o busy_timeout.
+        # Vale para todo atomic(), então um atomic() só de leitura também fila atrás das escritas: as leituras
+        # ficam fora de transação (autocommit, sem ATOMIC_REQUESTS) e os atomic() do projeto são todos de escrita
+        'transaction_mode': 'IMMEDIATE',
+    }
+
+# Conexões reaproveitadas entre requisições (segundos). O padrão é 0 porque sob ASGI cada requisição roda numa
+# thread diferente e as conexões persistentes se acumulam sem ser reaproveitadas; sob WSGI (threads fixas) vale ligar
+CONN_MAX_AGE = int(os.getenv('BIBLIOTECA_CONN_MAX_AGE', 0))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': OPCOES_SQLITE,
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {
+            # Banco de teste em arquivo para que os testes de concorrência usem várias conexões
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
+    }
+}
+
+# Réplica de leitura: um segundo arquivo SQLite, copiado do principal pelo comando snapshot_replica.
+# Com BIBLIOTECA_DB_REPLICA definido, os GETs do catálogo (livros, autores, categorias) leem da réplica
+BIBLIOTECA_DB_REPLICA = os.getenv('BIBLIOTECA_DB_REPLICA')
+if BIBLIOTECA_DB_REPLICA:
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BIBLIOTECA_DB_REPLICA,
+        'OPTIONS': OPCOES_SQLITE,
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    }
+    DATABASE_ROUTERS = ['biblioteca.routers.ReplicaDeLeituraRouter']
+    MIDDLEWARE.insert(1, 'biblioteca.routers.ReplicaDeLeituraMiddleware')
+
+# Cache
+# Respostas GET públicas do catálogo ficam em cache (ver biblioteca/cache.py).
+# Use CACHE_BACKEND=django.core.cache.backends.filebased.FileBasedCache e
+# CACHE_LOCATION=/caminho/do/diretorio para compartilhar o cache entre processos.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'biblioteca'),
     }
 }
 
+BIBLIOTECA_CACHE_TIMEOUT = int(os.getenv('BIBLIOTECA_CACHE_TIMEOUT', 300))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -130,10 +196,59 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'biblioteca.authentication.JWTAuthenticationEmCache',
+    ),
+    'DEFAULT_THROTTLE_CLASSES': (
+        'biblioteca.throttling.ThrottlePorEscopo',
     ),
 }
 
+# Limites por escopo (leituras do catálogo, demais leituras, escritas e obtenção de token): anônimos por IP e
+# autenticados por usuário; no token, por IP e pelo username tentado. Variável de ambiente vazia desliga o limite
+BIBLIOTECA_THROTTLE_TAXAS = {
+    escopo: os.getenv('BIBLIOTECA_THROTTLE_' + escopo.upper().replace('-', '_'), padrao)
+    for escopo, padrao in {
+        'catalogo-ip': '600/min',
+        'catalogo-usuario': '1200/min',
+        'autocomplete-ip': '1200/min',
+        'autocomplete-usuario': '2400/min',
+        'leitura-ip': '300/min',
+        'leitura-usuario': '600/min',
+        'escrita-ip': '60/min',
+        'escrita-usuario': '300/min',
+        'token-ip': '20/min',
+        'token-usuario': '10/min',
+    }.items()
+}
+BIBLIOTECA_THROTTLE_CACHE_ALIAS = os.getenv('BIBLIOTECA_THROTTLE_CACHE_ALIAS', 'default')
+
+# Índice do autocomplete (por processo): recarrega do banco depois do TTL, em segundos, e guarda no
+# máximo esse número de chaves (uma por palavra de título/nome) em cada índice
+BIBLIOTECA_AUTOCOMPLETE_TTL = int(os.getenv('BIBLIOTECA_AUTOCOMPLETE_TTL', 300))
+BIBLIOTECA_AUTOCOMPLETE_MAX_CHAVES = int(os.getenv('BIBLIOTECA_AUTOCOMPLETE_MAX_CHAVES', 300_000))
+
+# Fila de tarefas (comando run_workers): segundos de reserva de cada tarefa antes de outro worker poder
+# pegá-la, tentativas e espera entre elas (dobra a cada falha), e a pasta dos arquivos gerados
+BIBLIOTECA_TAREFAS_VISIBILIDADE = int(os.getenv('BIBLIOTECA_TAREFAS_VISIBILIDADE', 300))
+BIBLIOTECA_TAREFAS_TENTATIVAS = int(os.getenv('BIBLIOTECA_TAREFAS_TENTATIVAS', 3))
+BIBLIOTECA_TAREFAS_BACKOFF = int(os.getenv('BIBLIOTECA_TAREFAS_BACKOFF', 10))
+BIBLIOTECA_TAREFAS_BACKOFF_MAXIMO = int(os.getenv('BIBLIOTECA_TAREFAS_BACKOFF_MAXIMO', 600))
+BIBLIOTECA_TAREFAS_DIR = os.getenv('BIBLIOTECA_TAREFAS_DIR', BASE_DIR / 'arquivos_tarefas')
+
+# Admin das tabelas grandes: sem filtro, o total vem do sqlite_stat1 ou de um COUNT guardado no cache por
+# esse número de segundos; com filtro ou busca, o COUNT para no máximo de linhas
+BIBLIOTECA_ADMIN_CONTAGEM_TTL = int(os.getenv('BIBLIOTECA_ADMIN_CONTAGEM_TTL', 300))
+BIBLIOTECA_ADMIN_CONTAGEM_MAXIMA = int(os.getenv('BIBLIOTECA_ADMIN_CONTAGEM_MAXIMA', 10_000))
+
+# /metrics só responde com o token (Authorization: Bearer <token>) ou para os IPs da lista, separados por vírgula
+BIBLIOTECA_METRICS_TOKEN = os.getenv('BIBLIOTECA_METRICS_TOKEN') or None
+BIBLIOTECA_METRICS_IPS = [ip.strip() for ip in os.getenv('BIBLIOTECA_METRICS_IPS', '').split(',') if ip.strip()]
+
+# Cache em memória da autenticação JWT (por processo)
+BIBLIOTECA_AUTH_USUARIOS_TTL = int(os.getenv('BIBLIOTECA_AUTH_USUARIOS_TTL', 30))
+BIBLIOTECA_AUTH_USUARIOS_MAX = 10000
+BIBLIOTECA_AUTH_TOKENS_MAX = 4096
+
 
 from datetime import timedelta
 
@@ -1,7 +1,9 @@
 from django.contrib import admin
 from django.urls import path, include
+from biblioteca.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('', include('biblioteca.urls')),
 ]
\ No newline at end of file